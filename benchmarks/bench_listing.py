@@ -0,0 +1,146 @@
+"""
+    Directory Listing Benchmark
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compares the old double ``Path.iterdir()`` listing against the single
+    ``os.scandir`` pass used by :class:`~flfm.shell.paths.ShellPath`.
+
+    Usage: python benchmarks/bench_listing.py [NUM_ENTRIES]
+
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# pylint: disable=wrong-import-position
+from flfm.shell.paths import ShellPath
+
+class SyscallCounter:
+    """Counts the stat/opendir calls made thru the ``os`` module while active.
+
+    ``os.DirEntry`` is a C type, so entries coming out of ``os.scandir`` get
+    wrapped in order to count the ``lstat()`` each one performs when its
+    stat information is first requested.
+    """
+    def __init__(self):
+        self.calls = 0
+        self._saved = None
+
+    def _wrap(self, func):
+        def counted(*args, **kwargs):
+            self.calls += 1
+            return func(*args, **kwargs)
+        return counted
+
+    def _wrap_scandir(self, scandir):
+        counter = self
+
+        class CountedEntry:
+            def __init__(self, entry):
+                self._entry = entry
+                self._stat = None
+                self.name = entry.name
+                self.path = entry.path
+
+            def is_file(self, follow_symlinks=True):
+                if follow_symlinks and self._entry.is_symlink():
+                    counter.calls += 1
+                return self._entry.is_file(follow_symlinks=follow_symlinks)
+
+            def is_dir(self, follow_symlinks=True):
+                if follow_symlinks and self._entry.is_symlink():
+                    counter.calls += 1
+                return self._entry.is_dir(follow_symlinks=follow_symlinks)
+
+            def is_symlink(self):
+                return self._entry.is_symlink()
+
+            def stat(self, follow_symlinks=True):
+                if self._stat is None:
+                    counter.calls += 1
+                    self._stat = self._entry.stat(follow_symlinks=follow_symlinks)
+                return self._stat
+
+        class CountedScandir:
+            def __init__(self, path):
+                counter.calls += 1
+                self._it = scandir(path)
+
+            def __iter__(self):
+                return (CountedEntry(e) for e in self._it)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                self._it.close()
+
+        return CountedScandir
+
+    def __enter__(self):
+        self._saved = (os.stat, os.lstat, os.listdir, os.scandir)
+        os.stat = self._wrap(os.stat)
+        os.lstat = self._wrap(os.lstat)
+        os.listdir = self._wrap(os.listdir)
+        os.scandir = self._wrap_scandir(os.scandir)
+        return self
+
+    def __exit__(self, *args):
+        os.stat, os.lstat, os.listdir, os.scandir = self._saved
+        return False
+
+def legacy_listing(path_string):
+    """The listing as ``ShellPath`` used to perform it: two ``iterdir()``
+    passes, then an ``lstat()`` per item."""
+    path = Path(path_string)
+    files, dirs = [], []
+    if path.exists():
+        files = [(p.name, p.lstat().st_size) for p in path.iterdir() if p.is_file()]
+        dirs = [(p.name, p.lstat().st_size) for p in path.iterdir() if p.is_dir()]
+    return dirs + files
+
+def scandir_listing(path_string):
+    return ShellPath(path_string).children
+
+def make_tree(where, num_entries):
+    for i in range(num_entries):
+        if i % 10 == 0:
+            os.mkdir(os.path.join(where, 'dir{:06d}'.format(i)))
+        else:
+            with open(os.path.join(where, 'file{:06d}.bin'.format(i)), 'wb') as f:
+                f.write(b'\x00' * (i % 512))
+
+def run(name, func, path_string, repeat=5):
+    with SyscallCounter() as counter:
+        func(path_string)
+    calls = counter.calls
+
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(path_string)
+        best = min(best, time.perf_counter() - start)
+
+    print('{:<10} {:>10} calls {:>10.2f} ms'.format(name, calls, best * 1000))
+    return calls
+
+def main():
+    num_entries = int(sys.argv[1]) if len(sys.argv) > 1 else 40000
+    where = tempfile.mkdtemp(prefix='flfm-bench-')
+    try:
+        make_tree(where, num_entries)
+        print('Listing {} entries in {}'.format(num_entries, where))
+        old_calls = run('iterdir', legacy_listing, where)
+        new_calls = run('scandir', scandir_listing, where)
+        print('syscalls per entry: {:.2f} -> {:.2f}'.format(old_calls / num_entries,
+                                                           new_calls / num_entries))
+    finally:
+        shutil.rmtree(where, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""
+    MP4 Parser Benchmark
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Compares the old 4-bytes-at-a-time ``tkhd`` search against the box walker
+    used by :class:`~flfm.shell.video.MP4File`, over a generated corpus of
+    MP4 layouts.
+
+    Usage: python benchmarks/bench_mp4.py [SAMPLE_ENTRIES]
+
+"""
+import io
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# pylint: disable=wrong-import-position
+from flfm.shell.video import find_box, make_box, read_payload
+
+class CountingFileIO(io.FileIO):
+    """A ``FileIO`` counting its read & seek system calls."""
+    calls = 0
+
+    def read(self, *args):
+        CountingFileIO.calls += 1
+        return super().read(*args)
+
+    def readinto(self, *args):
+        CountingFileIO.calls += 1
+        return super().readinto(*args)
+
+    def seek(self, *args):
+        CountingFileIO.calls += 1
+        return super().seek(*args)
+
+def make_trak(handler, width, height, sample_entries):
+    matrix = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+    tkhd = make_box(b'tkhd', bytes([0, 0, 0, 3]) +
+                    struct.pack('>IIIII', 0, 0, 1, 0, 0) + bytes(16) + matrix +
+                    struct.pack('>II', width << 16, height << 16))
+    hdlr = make_box(b'hdlr', bytes(8) + handler + bytes(12) + b'\x00')
+    # sample tables are what make moov big
+    stsz = make_box(b'stsz', struct.pack('>III', 0, 0, sample_entries) +
+                    bytes(4 * sample_entries))
+    stco = make_box(b'stco', struct.pack('>II', 0, sample_entries) +
+                    bytes(4 * sample_entries))
+    stbl = make_box(b'stbl', stsz + stco)
+    mdia = make_box(b'mdia', hdlr + make_box(b'minf', stbl))
+    return make_box(b'trak', tkhd + mdia)
+
+def make_mp4(path, brands, moov_at_end, largesize, audio_first, cover_art,
+             sample_entries, mdat_size=64 * 1048576):
+    ftyp = make_box(b'ftyp', brands[0:4] + struct.pack('>I', 0x200) + brands)
+    traks = [make_trak(b'vide', 1920, 1080, sample_entries)]
+    if audio_first:
+        traks.insert(0, make_trak(b'soun', 0, 0, sample_entries))
+    # e.g. cover art, ahead of the tracks
+    udta = make_box(b'udta', make_box(b'covr', bytes(cover_art))) if cover_art else b''
+    moov = make_box(b'moov', make_box(b'mvhd', bytes(100)) + udta + b''.join(traks))
+
+    with open(path, 'wb') as f:
+        f.write(ftyp)
+        if not moov_at_end:
+            f.write(moov)
+        # a sparse mdat, only its header is ever read
+        if largesize:
+            f.write(struct.pack('>I4sQ', 1, b'mdat', mdat_size + 16))
+        else:
+            f.write(struct.pack('>I4s', mdat_size + 8, b'mdat'))
+        f.seek(mdat_size, os.SEEK_CUR)
+        if moov_at_end:
+            f.write(moov)
+        f.truncate()
+
+def legacy_parse(path):
+    """The ``tkhd`` search ``MP4File`` used to perform."""
+    supported_brands = (b'isommp42', b'isomiso2avc1mp41', b'isomisoavc1',
+                        b'isomavc1mp42')
+    with CountingFileIO(path, 'rb') as fio:
+        compat_brand_end = struct.unpack('>I', fio.read(4))[0]
+        fio.seek(0x10, io.SEEK_SET)
+        compat_brand = fio.read(compat_brand_end - 0x10)
+        if compat_brand not in supported_brands:
+            return None
+
+        fio.seek(compat_brand_end, io.SEEK_SET)
+        moov_size, moov_type = struct.unpack('>I4s', fio.read(8))
+        fio.seek(compat_brand_end, io.SEEK_SET)
+        if moov_type != b'moov':
+            return None
+
+        bytes_read = 0
+        alignment_corrected = False
+        while bytes_read < moov_size:
+            buffer = fio.read(4)
+            if not alignment_corrected and \
+            struct.pack('>L', struct.unpack('>L', buffer)[0]<<8&0xffffffff) == b'tkh\x00':
+                fio.seek(-4, io.SEEK_CUR)
+                fio.seek(1, io.SEEK_CUR)
+                alignment_corrected = True
+            if buffer == b'tkhd':
+                fio.seek(-8, io.SEEK_CUR)
+                tkhd_size = struct.unpack('>I', fio.read(4))[0]
+                fio.seek(-4, io.SEEK_CUR)
+                track_head = fio.read(tkhd_size)
+                return struct.unpack('>II', track_head[82:90])
+            bytes_read += 4
+    return None
+
+def walker_parse(path):
+    """The box walker, as ``MP4File`` uses it."""
+    with io.BufferedReader(CountingFileIO(path, 'rb'), 65536) as handle:
+        file_end = os.fstat(handle.fileno()).st_size
+        moov = find_box(handle, 0, file_end, b'moov')
+        if moov is None:
+            return None
+        tkhd = find_box(handle, moov.payload_offset, moov.end, b'trak', b'tkhd')
+        if tkhd is None:
+            return None
+        track_head = read_payload(handle, tkhd, 96)
+        w, h = struct.unpack('>II', track_head[76:84])
+        return w >> 16, h >> 16
+
+def run(func, path, repeat=5):
+    CountingFileIO.calls = 0
+    result = func(path)
+    calls = CountingFileIO.calls
+
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(path)
+        best = min(best, time.perf_counter() - start)
+    return result, calls, best
+
+def main():
+    sample_entries = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    # (name, ftyp brands, moov last, largesize mdat, audio first, cover art)
+    corpus = [
+        ('moov first', b'isomiso2avc1mp41', False, False, False, 0),
+        ('moov first, cover art', b'isomiso2avc1mp41', False, False, False, 262144),
+        ('audio track first', b'isomiso2avc1mp41', False, False, True, 0),
+        ('moov last', b'isomiso2avc1mp41', True, False, False, 0),
+        ('largesize mdat', b'isomiso2avc1mp41', True, True, False, 0),
+        ('M4V brand', b'M4V M4A mp42isom', False, False, False, 0),
+        ('mp42 brand', b'mp42mp41', False, False, False, 0),
+    ]
+    where = tempfile.mkdtemp(prefix='flfm-bench-')
+    try:
+        print('{:<22} {:>27} {:>27}'.format('', 'legacy', 'box walker'))
+        for i, (name, *layout) in enumerate(corpus):
+            path = os.path.join(where, 'sample{}.mp4'.format(i))
+            make_mp4(path, *layout, sample_entries)
+            results = [run(func, path) for func in (legacy_parse, walker_parse)]
+            print('{:<22} {}'.format(name, ' '.join(
+                '{!s:>12} {:>6}c {:>7.2f}ms'.format(r[0], r[1], r[2] * 1000)
+                for r in results)))
+    finally:
+        shutil.rmtree(where, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
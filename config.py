@@ -11,22 +11,51 @@ class Config:
     DB_PASSWORD = os.environ.get('DB_PASSWORD', '')
     DB_HOST = os.environ.get('DB_HOST', '')
     DB_DATABASE = os.environ.get('DB_DATABASE', '')
+    LISTING_CACHE_MAX_DIRS = 256
+    MEDIA_INDEX_FILE = os.environ.get('MEDIA_INDEX_FILE',
+                                      os.path.join(os.getcwd(),
+                                                   'media_index.sqlite3'))
+    SERVE_OFFLOAD = os.environ.get('SERVE_OFFLOAD', None)
+    SERVE_OFFLOAD_MAP = {}
     SESSION_TYPE = 'filesystem'
     SESSION_USE_SIGNER = True
     SESSION_KEY_PREFIX = 'flfm-session:'
     SESSION_FILE_DIR = os.environ.get('SESSION_FILE_DIR',
                                       os.path.join(os.getcwd(),
                                                    'flask_session'))
+    SHELL_PAGE_SIZE = 1000
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    THUMB_DIRECTORY = os.environ.get('THUMB_DIRECTORY',
+                                     os.path.join(os.getcwd(), 'thumbs'))
+    THUMB_MAX_BYTES = 1073741824
+    THUMB_QUALITY = 85
+    THUMB_SIZES = (160, 320, 640, 1280, 1920, 2560, 3840)
+    THUMB_WORKERS = 2
+    TYPE_CACHE_MAX_FILES = 4096
+    TYPE_SNIFF_WORKERS = 4
+    UPLOAD_CHUNK_SIZE = 5242880
+    UPLOAD_MAX_SIZE = None
+    UPLOAD_STAGING_DIR = os.environ.get('UPLOAD_STAGING_DIR', '.flfm-staging')
+    USER_RULES_MAX_USERS = 1024
+    USER_RULES_TTL = 60
     USERS_HOME_FOLDERS = os.environ.get('USERS_HOME_FOLDERS',
                                         os.path.join(os.getcwd(),
                                                      'homes'))
     RULES_FILE = os.environ.get('RULES_FILE', None)
+    RULES_CHECK_INTERVAL = 1
+    VCACHE_BACKEND = os.environ.get('VCACHE_BACKEND', 'memory')
+    VCACHE_DIRECTORY = os.environ.get('VCACHE_DIRECTORY',
+                                      os.path.join(os.getcwd(), 'vcache'))
+    VCACHE_MAX_BYTES = 67108864
     VCACHE_MAX_FILESIZE = 1048576
-    VCACHE_MAX_FILES = 16
     VIEWER_VIDEO_DIRECTORY = os.environ.get('VIEWER_VIDEO_DIRECTORY',
                                             os.path.join(os.getcwd(),
                                                          'videos'))
+    VIDEO_FAST_START = True
+    VIDEO_PROGRESS_INTERVAL = 0.5
+    VIDEO_STAGING_CHUNK_SIZE = 4194304
+    VIDEO_STAGING_MAX_BYTES = 10737418240
+    VIDEO_STAGING_MAX_FILES = 1024
 
     @classmethod
     def init_app(cls, app):
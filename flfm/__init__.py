@@ -5,8 +5,11 @@ from flask_login import LoginManager, current_user
 from flask_session import Session
 from flask_socketio import SocketIO
 from flask_sqlalchemy import SQLAlchemy
-from .shell import shell
-from .viewer import viewer, vcache
+from .shell import (
+    shell, listing_cache, media_index, rules_registry, thumbnails,
+    type_detector, upload_staging
+)
+from .viewer import viewer, vcache, video_staging
 from .accounts import accounts
 
 db = SQLAlchemy()
@@ -56,10 +59,22 @@ def create_app(config_object):
     bootstrap.init_app(app)
     login.init_app(app)
     e_session.init_app(app)
+    # SOCKET-IO STUFF GOES HERE
+    # Imports required as they cause the decorators to be trigg'd
+    # Before init_app, so that every app created gets the handlers
+    # pylint: disable=unused-import
+    from .sockets import prepare_video, received_video
     socketio.init_app(app)
 
     # Setup dependents
+    listing_cache.init_app(app)
+    media_index.init_app(app)
+    rules_registry.init_app(app)
+    thumbnails.init_app(app)
+    type_detector.init_app(app)
+    upload_staging.init_app(app)
     vcache.init_app(app)
+    video_staging.init_app(app)
 
     root = app.config.get('APPLICATION_ROOT', '/')
     app.register_blueprint(shell, url_prefix=format_root(root=root))
@@ -80,10 +95,6 @@ def create_app(config_object):
     # REGISTER CURRENT_USER TO JINJA2
     app.add_template_global(lambda cu=current_user: cu, 'the_cur_user')
 
-    # SOCKET-IO STUFF GOES HERE
-    # Imports required as they cause the decorators to be trigg'd
-    # pylint: disable=unused-import
-    from .sockets import prepare_video, received_video
     # DB models
     from flfm import models
     # USER LOGIN EVENTS
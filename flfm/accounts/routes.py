@@ -4,6 +4,7 @@ from flask import (
 )
 from flask_login import current_user, login_user, logout_user, login_required
 from flfm.misc import get_banner_string
+from flfm.shell.rules import rules_registry
 # i hate how flask-sqlalchemy forces me to do this >:(
 import flfm as f
 from .forms import (
@@ -165,8 +166,10 @@ def submit_my_shares(form):
         if form.stop_sharing_to.data is True:
             stop = f.models.Share.query.filter_by(id=form.sharing_to.data).first()
             if stop is not None:
+                receiver_id = stop.shared_to_id
                 f.db.session.delete(stop)
                 f.db.session.commit()
+                rules_registry.invalidate_user(receiver_id)
             else:
                 flash("Unable to remove share.")
         else:
@@ -179,6 +182,7 @@ def submit_my_shares(form):
                                        shared_to_id=user.id)
             f.db.session.add(new_share)
             f.db.session.commit()
+            rules_registry.invalidate_user(user.id)
             flash("Success! You are now sharing your files with: {}!".\
                   format(user.name))
         else:
@@ -1 +1,7 @@
 from .routes import shell
+from .filetypes import type_detector
+from .media import media_index
+from .paths import listing_cache
+from .rules import rules_registry
+from .thumbnails import thumbnails
+from .uploads import upload_staging
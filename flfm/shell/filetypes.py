@@ -0,0 +1,150 @@
+"""
+    File Types
+    ~~~~~~~~~~
+
+    Working out the mimetypes of files, reading them only when their names
+    aren't enough. Everything asking for a mimetype goes thru
+    :data:`type_detector`.
+
+"""
+import mimetypes
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import filetype
+from cachetools import LRUCache
+
+def _identity(stat_result):
+    return (stat_result.st_dev, stat_result.st_ino, stat_result.st_size,
+            stat_result.st_mtime_ns)
+
+class TypeDetector:
+    """Works out mimetypes by extension first. A file's contents are only
+    sniffed when its extension says nothing useful, and what's sniffed is
+    cached by the file's device, inode, size & modification time.
+
+    +---------------------------+-------------------------------------------------+
+    | Configuration Variables   | Description                                     |
+    +===========================+=================================================+
+    |``TYPE_CACHE_MAX_FILES``   | Max sniffed files to remember.                  |
+    +---------------------------+-------------------------------------------------+
+    |``TYPE_SNIFF_WORKERS``     | Threads sniffing files for :meth:`classify`.    |
+    +---------------------------+-------------------------------------------------+
+
+    :param app: The Flask application
+    :type app: Flask
+    """
+    #: Mimetypes that an extension can't be trusted with.
+    AMBIGUOUS = frozenset([None, 'application/octet-stream'])
+
+    max_files = 4096
+    workers = 4
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.cache = LRUCache(self.max_files)
+        self.pool = None
+        #: Number of files whose extension was enough.
+        self.extension_hits = 0
+        #: Number of sniffs answered by the cache.
+        self.sniff_hits = 0
+        #: Number of files that had to be read.
+        self.sniffs = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_files = app.config.get('TYPE_CACHE_MAX_FILES', 4096)
+        self.workers = app.config.get('TYPE_SNIFF_WORKERS', 4)
+        self.finish_setup()
+
+    def finish_setup(self):
+        with self.lock:
+            self.cache = LRUCache(self.max_files) if self.max_files > 0 else None
+            if self.pool is not None:
+                self.pool.shutdown(wait=False)
+            self.pool = None
+
+    @staticmethod
+    def by_extension(filename):
+        """The mimetype going by the extension alone.
+
+        :param filename: The name or path of the file.
+        :type filename: str
+        :returns: str -- or *None*
+        """
+        return mimetypes.guess_type(filename)[0]
+
+    def sniff(self, shell_file):
+        """The mimetype going by the contents of the file.
+
+        :param shell_file: The file.
+        :type shell_file: :class:`~flfm.shell.paths.ShellFile`
+        :returns: str -- or *None* if it can't be told.
+        """
+        key = None
+        if shell_file.stat_result is not None and self.cache is not None:
+            key = _identity(shell_file.stat_result)
+            with self.lock:
+                if key in self.cache:
+                    self.sniff_hits += 1
+                    return self.cache[key]
+
+        with self.lock:
+            self.sniffs += 1
+        try:
+            guessed = filetype.guess(shell_file.path)
+        except OSError:
+            return None
+        sniffed = guessed.mime if guessed is not None else None
+
+        if key is not None:
+            with self.lock:
+                self.cache[key] = sniffed
+        return sniffed
+
+    def mimetype(self, shell_file):
+        """The mimetype of a file.
+
+        :param shell_file: The file.
+        :type shell_file: :class:`~flfm.shell.paths.ShellFile`
+        :returns: str -- or *None*
+        """
+        guessed = self.by_extension(shell_file.name)
+        if guessed not in self.AMBIGUOUS:
+            with self.lock:
+                self.extension_hits += 1
+            return guessed
+        return self.sniff(shell_file) or guessed
+
+    def classify(self, shell_files):
+        """The mimetypes of many files at once, e.g. a whole directory. Only
+        the files with ambiguous extensions are read, several at a time.
+
+        :param shell_files: The files.
+        :type shell_files: list of :class:`~flfm.shell.paths.ShellFile`
+        :returns: list -- The mimetypes, in the order of ``shell_files``.
+        """
+        results = [self.by_extension(f.name) for f in shell_files]
+        ambiguous = [i for i, guessed in enumerate(results)
+                     if guessed in self.AMBIGUOUS]
+        with self.lock:
+            self.extension_hits += len(results) - len(ambiguous)
+        if not ambiguous:
+            return results
+
+        if len(ambiguous) == 1 or self.workers <= 1:
+            sniffed = [self.sniff(shell_files[i]) for i in ambiguous]
+        else:
+            with self.lock:
+                if self.pool is None:
+                    self.pool = ThreadPoolExecutor(max_workers=self.workers)
+                pool = self.pool
+            sniffed = list(pool.map(self.sniff, [shell_files[i] for i in ambiguous]))
+
+        for i, mimetype in zip(ambiguous, sniffed):
+            results[i] = mimetype or results[i]
+        return results
+
+###############################################################################
+type_detector = TypeDetector()
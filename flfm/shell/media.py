@@ -0,0 +1,213 @@
+"""
+    Media Information
+    ~~~~~~~~~~~~~~~~~
+
+    A persistent index of the metadata of videos, so each one is only ever
+    parsed once.
+
+"""
+import json
+import os
+import sqlite3
+import threading
+from cachetools import LRUCache
+from .video import MP4File
+
+#: Bump whenever :func:`read_media_info` starts returning something new, so
+#: that what's already indexed gets read again.
+MEDIA_INFO_VERSION = 4
+
+def read_media_info(shell_file):
+    """Reads the metadata of a file from the file itself.
+
+    :param shell_file: The file.
+    :type shell_file: :class:`~flfm.shell.paths.ShellFile`
+    :returns: dict -- *format* is *None* unless it's a supported video.
+    """
+    media_info = dict({
+        'mimetype': shell_file.mimetype,
+        'format': None,
+        'width': None,
+        'height': None,
+        'duration': None,
+        'codec': None,
+        'bitrate': None,
+        'rotation': 0,
+    })
+
+    if 'mp4' in (shell_file.mimetype or ''):
+        video = MP4File(shell_file.path)
+        media_info['format'] = video.video_format
+        media_info['width'], media_info['height'] = video.video_wxh
+        media_info['duration'] = video.video_duration
+        media_info['codec'] = video.video_codec
+        media_info['bitrate'] = video.video_bitrate
+        media_info['rotation'] = video.video_rotation
+
+    return media_info
+
+def read_seek_index(shell_file):
+    """Reads the keyframes of a video from the file itself. They're kept
+    out of :func:`read_media_info`, as they grow with the video's length.
+
+    :param shell_file: The file.
+    :type shell_file: :class:`~flfm.shell.paths.ShellFile`
+    :returns: dict -- See :meth:`~flfm.shell.video.SeekIndex.to_dict`, or
+              *None* unless it's a supported video.
+    """
+    if 'mp4' not in (shell_file.mimetype or ''):
+        return None
+    seek_index = MP4File(shell_file.path).seek_index
+    return seek_index.to_dict() if seek_index is not None else None
+
+def _file_identity(shell_file):
+    # a listing's stat_result outlives rewrites of the file, ask the file
+    the_stat = os.stat(shell_file.path)
+    return (the_stat.st_dev, the_stat.st_ino, the_stat.st_size,
+            the_stat.st_mtime_ns)
+
+class MediaIndex:
+    """Keeps what :func:`read_media_info` returns in an SQLite database,
+    keyed by path and validated by device, inode, size & modification time.
+    Files are read lazily, the first time they're asked about, and again only
+    once they've changed. The database is shared by every worker on the host,
+    each process opening its own connection the first time it's used.
+
+    +-------------------------+---------------------------------------------------+
+    | Configuration Variables | Description                                       |
+    +=========================+===================================================+
+    |``MEDIA_INDEX_FILE``     | The SQLite database. *None* disables the index.   |
+    +-------------------------+---------------------------------------------------+
+
+    :param app: The Flask application
+    :type app: Flask
+    """
+    index_file = None
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.connection = None
+        # the process the connection was opened in
+        self._pid = None
+        #: Number of files whose information came from the index.
+        self.hits = 0
+        #: Number of files that had to be read.
+        self.misses = 0
+        # the last few seek indexes asked for, by file identity
+        self.seek_indexes = LRUCache(32)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.index_file = app.config.get('MEDIA_INDEX_FILE', None)
+        self.finish_setup()
+
+    def finish_setup(self):
+        with self.lock:
+            if self.connection is not None and self._pid == os.getpid():
+                self.connection.close()
+            self.connection = None
+            self._pid = None
+
+    def _connect(self):
+        # opened lazily, in each process; a connection mustn't cross a fork
+        if self._pid == os.getpid():
+            return self.connection
+
+        self.connection = sqlite3.connect(self.index_file, timeout=10,
+                                          check_same_thread=False)
+        self._pid = os.getpid()
+        # let the other workers read while one writes
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS media_info ('
+            ' path TEXT PRIMARY KEY, directory TEXT NOT NULL,'
+            ' dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,'
+            ' version INTEGER, info TEXT)'
+        )
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS media_info_directory'
+            ' ON media_info (directory)'
+        )
+        self.connection.commit()
+        return self.connection
+
+    def get_info(self, shell_file):
+        """Get the metadata of a single file.
+
+        :param shell_file: The file.
+        :type shell_file: :class:`~flfm.shell.paths.ShellFile`
+        :returns: dict -- See :func:`read_media_info`.
+        """
+        return self.get_directory_info(os.path.dirname(shell_file.path),
+                                       [shell_file])[shell_file.name]
+
+    def get_seek_index(self, shell_file):
+        """Get the keyframes of a single video. Only the most recently asked
+        for are remembered, in memory.
+
+        :param shell_file: The file.
+        :type shell_file: :class:`~flfm.shell.paths.ShellFile`
+        :returns: dict -- See :func:`read_seek_index`.
+        """
+        key = (os.path.normpath(shell_file.path),) + _file_identity(shell_file)
+        with self.lock:
+            if key in self.seek_indexes:
+                return self.seek_indexes[key]
+        seek_index = read_seek_index(shell_file)
+        with self.lock:
+            self.seek_indexes[key] = seek_index
+        return seek_index
+
+    def get_directory_info(self, directory, shell_files):
+        """Get the metadata of files in the same directory, with one query.
+
+        :param directory: The directory the files are in.
+        :type directory: str
+        :param shell_files: The files.
+        :type shell_files: list of :class:`~flfm.shell.paths.ShellFile`
+        :returns: dict -- file names mapped to :func:`read_media_info`'s.
+        """
+        if not self.index_file:
+            return {f.name: read_media_info(f) for f in shell_files}
+
+        directory = os.path.normpath(directory)
+        with self.lock:
+            rows = self._connect().execute(
+                'SELECT path, dev, ino, size, mtime_ns, version, info'
+                ' FROM media_info WHERE directory = ?', (directory,)
+            ).fetchall()
+        indexed = {row[0]: row[1:] for row in rows}
+
+        media_infos = dict()
+        new_rows = []
+        for shell_file in shell_files:
+            path = os.path.normpath(shell_file.path)
+            identity = _file_identity(shell_file)
+            row = indexed.get(path)
+            if row is not None and tuple(row[0:4]) == identity and \
+               row[4] == MEDIA_INFO_VERSION:
+                media_infos[shell_file.name] = json.loads(row[5])
+                continue
+
+            media_info = read_media_info(shell_file)
+            media_infos[shell_file.name] = media_info
+            new_rows.append((path, directory) + identity +
+                            (MEDIA_INFO_VERSION, json.dumps(media_info)))
+
+        with self.lock:
+            self.hits += len(shell_files) - len(new_rows)
+            self.misses += len(new_rows)
+            if new_rows:
+                connection = self._connect()
+                connection.executemany(
+                    'INSERT OR REPLACE INTO media_info'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)', new_rows
+                )
+                connection.commit()
+
+        return media_infos
+
+###############################################################################
+media_index = MediaIndex()
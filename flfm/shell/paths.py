@@ -6,10 +6,14 @@
 
 """
 from pathlib import Path
-import mimetypes
-import re
+import os
 import stat
-import filetype
+import threading
+from cachetools import LRUCache
+from .filetypes import type_detector
+
+#: Names of entries left out of every listing, e.g. upload staging directories.
+hidden_names = set()
 
 def create_proper_shellitem(str_path):
     """Creates either a :class:`ShellFile` or a :class:`ShellDirectory`
@@ -20,14 +24,23 @@ def create_proper_shellitem(str_path):
     :returns: :class:`ShellFile` **OR** :class:`ShellDirectory`
     """
     untyped_path = Path(str_path)
-    its_mode = untyped_path.lstat().st_mode
+    its_stat = untyped_path.lstat()
 
     # It's a directory
-    if bool(stat.S_ISDIR(its_mode)):
-        return ShellDirectory(untyped_path)
+    if bool(stat.S_ISDIR(its_stat.st_mode)):
+        return ShellDirectory(untyped_path, its_stat)
 
     # It's gotta be a file
-    return ShellFile(untyped_path)
+    return ShellFile(untyped_path, its_stat)
+
+def _shell_path_string(path_obj):
+    # Rebuild the path w/ forward slashes, dropping any root or drive part
+    path = ''
+    for p in path_obj.parts:
+        if '\\' in p or '/' in p:
+            continue
+        path += '/{}'.format(p)
+    return path
 
 class ShellItem:
     """Base class for items contained within a
@@ -35,24 +48,56 @@ class ShellItem:
 
     :param path_obj: A **pathlib** *Path* object.
     :type path_obj: pathlib.Path
+    :param stat_result: The ``lstat()`` of ``path_obj``, if already known.
+    :type stat_result: os.stat_result
+
+    .. note::
+        When listing a directory, use :meth:`from_dir_entry` instead. It reuses
+        what ``os.scandir`` has already fetched.
+
     """
     file = False #: Boolean stating if object is a file
     directory = False #: Boolean stating if object is a directory
 
-    def __init__(self, path_obj):
-        path = ''
-        for p in path_obj.parts:
-            if '\\' in p or '/' in p:
-                continue
-            path += '/{}'.format(p)
-        self.name = path_obj.name
+    def __init__(self, path_obj, stat_result=None):
+        self._setup(path_obj.name, _shell_path_string(path_obj), stat_result,
+                    path_obj.lstat)
+
+    @classmethod
+    def from_dir_entry(cls, dir_entry, parent_path):
+        """Instantiates from an ``os.DirEntry`` yielded by ``os.scandir``.
+
+        :param dir_entry: The entry to create this item from.
+        :type dir_entry: os.DirEntry
+        :param parent_path: The :attr:`path` of the directory being scanned.
+        :type parent_path: str
+        """
+        item = cls.__new__(cls)
+        item._setup(dir_entry.name, '{}/{}'.format(parent_path, dir_entry.name),
+                    None, lambda: dir_entry.stat(follow_symlinks=False))
+        return item
+
+    def _setup(self, name, path, stat_result, lstat_func):
+        self.name = name
         self.path = path
         self.uri_path = self.path[1:len(self.path)]
 
-        try:
-            self.size = path_obj.lstat().st_size
-        except FileNotFoundError:
-            self.size = 0
+        if stat_result is None:
+            try:
+                stat_result = lstat_func()
+            except FileNotFoundError:
+                stat_result = None
+        #: The ``lstat()`` of this item. *None* if it has vanished.
+        self.stat_result = stat_result
+        self.size = stat_result.st_size if stat_result is not None else 0
+
+    @property
+    def mtime(self):
+        """The modification time of this item, in seconds since the epoch.
+        """
+        if self.stat_result is None:
+            return 0
+        return self.stat_result.st_mtime
 
     def parent_directory(self):
         """Returns the parent directory of this :class:`ShellItem`.
@@ -67,9 +112,13 @@ class ShellFile(ShellItem):
     """
     file = True
 
-    def __init__(self, path_obj):
-        super().__init__(path_obj)
+    def __init__(self, path_obj, stat_result=None):
+        super().__init__(path_obj, stat_result)
+
+    def _setup(self, name, path, stat_result, lstat_func):
+        super()._setup(name, path, stat_result, lstat_func)
         self._mimetype = None
+        self._mimetype_known = False
 
     def is_mimetype(self, want_type):
         """Check whether or not this file is a mimetype of ``want_type``.
@@ -95,20 +144,10 @@ class ShellFile(ShellItem):
             prior to the /.
 
         """
-        our_type = filetype.guess(self.path)
-
+        our_type = self.mimetype
         if our_type is None:
-            # sometimes, filetype fails horribly
-            # # like with text files. works great for images though
-            type, encoding = mimetypes.guess_type(self.path)
-            if type is None:
-                return False
-            if re.match(want_family, type) is not None:
-                return True
             return False
-        if re.match(want_family, our_type.mime) is not None:
-            return True
-        return False
+        return our_type.startswith(want_family)
 
     def __repr__(self):
         return '<{} \'{}\' at \'{}\'>'.format(self.__class__.__name__,
@@ -116,13 +155,12 @@ class ShellFile(ShellItem):
 
     @property
     def mimetype(self):
-        """The mimetype of this :class:`ShellFile`.
+        """The mimetype of this :class:`ShellFile`, as worked out by
+        :data:`~flfm.shell.filetypes.type_detector`. *None* if unknown.
         """
-        if self._mimetype is None:
-            try:
-                self._mimetype = filetype.guess(self.path).mime
-            except AttributeError:
-                self._mimetype = mimetypes.guess_type(self.path)[0]
+        if not self._mimetype_known:
+            self._mimetype = type_detector.mimetype(self)
+            self._mimetype_known = True
         return self._mimetype
 
 class ShellDirectory(ShellItem):
@@ -131,8 +169,8 @@ class ShellDirectory(ShellItem):
     """
     directory = True
 
-    def __init__(self, path_obj):
-        super().__init__(path_obj)
+    def __init__(self, path_obj, stat_result=None):
+        super().__init__(path_obj, stat_result)
 
     @classmethod
     def from_str_loc(cls, str_location):
@@ -163,45 +201,40 @@ class ShellPath:
         and will probably be removed in the future.
 
     """
-    def __init__(self, path_string, dir_mappings=None):
-        def get_files(dirs):
-            while True:
-                try:
-                    with next(dirs) as file:
-                        if file.is_file():
-                            yield file
-                except StopIteration:
-                    break
-        def get_dirs(dirs):
-            while True:
-                try:
-                    with next(dirs) as dirsss:
-                        if dirsss.is_dir():
-                            yield dirsss
-                except StopIteration:
-                    break
-
+    def __init__(self, path_string, dir_mappings=None, listing=None):
         #: A pathlib.Path object representing this class.
         self.path = Path(path_string)
         #: The string version of this path
         self.str_path = path_string
 
-        if self.path.exists():
-            #: A list of all :class:`ShellFile` at this path.
-            self.files = [ShellFile(file) for file in get_files(self.path.iterdir())]
-            #: A list of all :class:`ShellDirectory` at this path.
-            self.directories = [ShellDirectory(dir) for dir in get_dirs(self.path.iterdir())]
-            # Directories followed by files
-            #: Contains all children, both :attr:`files` & :attr:`directories`.
-            self.children = self.directories + self.files
-        else:
-            self.files = []
-            self.directories = []
-            self.children = []
+        if listing is None:
+            listing = self.scan_directory(path_string)
+
+        #: A list of all :class:`ShellDirectory` at this path.
+        self.directories = listing[0]
+        #: A list of all :class:`ShellFile` at this path.
+        self.files = listing[1]
+        # Directories followed by files
+        #: Contains all children, both :attr:`files` & :attr:`directories`.
+        self.children = self.directories + self.files
+
+        #: Index of the first child, when this is a page of a listing.
+        self.offset = 0
+        #: Maximum number of children, when this is a page of a listing.
+        self.limit = None
+        #: Number of children in the whole directory.
+        self.total = len(self.children)
 
         # So far, this used to let us get the allow/disallow properties from
         ## jinja
         self.mapping = None
+        self.apply_mappings(dir_mappings)
+
+    def apply_mappings(self, dir_mappings):
+        """Set :attr:`mapping` from a container of mapped directories.
+
+        :param dir_mappings: A reference to a :class:`~flfm.shell.rules.MappedDirectories`.
+        """
         if dir_mappings is not None:
             # check if MappedDirectories container is empty
             if not dir_mappings:
@@ -209,6 +242,74 @@ class ShellPath:
             else:
                 self.mapping = dir_mappings.get_mapped_dir(self.str_path)
 
+    @classmethod
+    def cached(cls, path_string, dir_mappings=None):
+        """Instantiates a :class:`ShellPath` whose listing comes from the
+        :class:`ListingCache`, only scanning the directory if it has changed.
+
+        :param path_string: See :class:`ShellPath`.
+        :type path_string: str
+        :param dir_mappings: See :class:`ShellPath`.
+        """
+        return cls(path_string, dir_mappings,
+                   listing_cache.get_listing(path_string))
+
+    @classmethod
+    def paginated(cls, path_string, offset=0, limit=None, sort_by='name',
+                  reverse=False, dir_mappings=None):
+        """Instantiates a :class:`ShellPath` holding only one page of the
+        directory, sorted server-side. See :class:`ListingPage`.
+
+        :param path_string: See :class:`ShellPath`.
+        :type path_string: str
+        :param dir_mappings: See :class:`ShellPath`.
+        """
+        page = ListingPage(path_string, offset, limit, sort_by, reverse)
+        directories = []
+        files = []
+        for item in page:
+            if item.directory:
+                directories.append(item)
+            else:
+                files.append(item)
+
+        shell_path = cls(path_string, dir_mappings, (directories, files))
+        shell_path.offset = offset
+        shell_path.limit = limit
+        shell_path.total = page.total
+        return shell_path
+
+    @staticmethod
+    def scan_directory(path_string):
+        """Lists a directory in a single pass.
+
+        :param path_string: A string containing a path on the local filesytem.
+        :type path_string: str
+        :returns: tuple -- (list of :class:`ShellDirectory`, list of :class:`ShellFile`)
+        """
+        directories = []
+        files = []
+        parent_path = _shell_path_string(Path(path_string))
+        # One pass over the directory; each DirEntry already knows its type
+        ## and caches its lstat() for the ShellItem
+        try:
+            with os.scandir(path_string) as entries:
+                for entry in entries:
+                    if entry.name in hidden_names:
+                        continue
+                    # is_file() & is_dir() come from d_type, no stat() needed
+                    if entry.is_file():
+                        files.append(ShellFile.from_dir_entry(entry,
+                                                              parent_path))
+                    elif entry.is_dir():
+                        directories.append(
+                            ShellDirectory.from_dir_entry(entry, parent_path)
+                        )
+        except FileNotFoundError:
+            return [], []
+
+        return directories, files
+
     @property
     def has_files(self):
         """Whether or not this path contains files.
@@ -224,3 +325,234 @@ class ShellPath:
         if not self.directories:
             return False
         return True
+
+def _entry_stat(entry):
+    # ShellItems keep their lstat(), DirEntry caches it after the first call
+    if isinstance(entry, ShellItem):
+        return entry.stat_result
+    try:
+        return entry.stat(follow_symlinks=False)
+    except FileNotFoundError:
+        return None
+
+def _sort_by_size(entry):
+    the_stat = _entry_stat(entry)
+    return the_stat.st_size if the_stat is not None else 0
+
+def _sort_by_mtime(entry):
+    the_stat = _entry_stat(entry)
+    return the_stat.st_mtime_ns if the_stat is not None else 0
+
+class ListingPage:
+    """A window onto a sorted directory listing. Directories come first, then
+    files, each sorted by ``sort_by``.
+
+    The listing comes from the :class:`ListingCache`, which scans the
+    directory only when it has changed, so paging thru a directory scans it
+    once. With the cache disabled, only the entries within the window become
+    :class:`ShellItem`'s, as they are iterated over, and sorting by *name*
+    requires no ``stat()`` calls.
+
+    :param path_string: The directory to list.
+    :type path_string: str
+    :param offset: Index of the first entry in the window.
+    :type offset: int
+    :param limit: Maximum entries in the window. *None* for no limit.
+    :type limit: int
+    :param sort_by: One of :attr:`SORT_KEYS`.
+    :type sort_by: str
+    :param reverse: Sort in descending order.
+    :type reverse: bool
+    :raises ValueError: ``sort_by`` is not a known key or ``offset`` is negative.
+    """
+    #: The keys a listing can be sorted by.
+    SORT_KEYS = {
+        'name': lambda entry: entry.name,
+        'size': _sort_by_size,
+        'mtime': _sort_by_mtime,
+    }
+
+    def __init__(self, path_string, offset=0, limit=None, sort_by='name',
+                 reverse=False):
+        if sort_by not in self.SORT_KEYS:
+            raise ValueError("Can't sort by '{}'.".format(sort_by))
+        if offset < 0 or (limit is not None and limit < 0):
+            raise ValueError("Bad window: {}, {}.".format(offset, limit))
+
+        self.path_string = path_string
+        self.offset = offset
+        self.limit = limit
+        self._parent_path = _shell_path_string(Path(path_string))
+
+        if listing_cache.enabled:
+            directories, files = listing_cache.get_listing(path_string)
+        else:
+            directories, files = self._scan_entries(path_string)
+
+        sort_key = self.SORT_KEYS[sort_by]
+        directories = sorted(directories, key=sort_key, reverse=reverse)
+        files = sorted(files, key=sort_key, reverse=reverse)
+
+        #: Number of entries in the whole directory.
+        self.total = len(directories) + len(files)
+
+        end = None if limit is None else offset + limit
+        self._window = (directories + files)[offset:end]
+
+    @staticmethod
+    def _scan_entries(path_string):
+        directories = []
+        files = []
+        try:
+            with os.scandir(path_string) as entries:
+                for entry in entries:
+                    if entry.name in hidden_names:
+                        continue
+                    if entry.is_file():
+                        files.append(entry)
+                    elif entry.is_dir():
+                        directories.append(entry)
+        except FileNotFoundError:
+            pass
+        return directories, files
+
+    def __len__(self):
+        return len(self._window)
+
+    def __iter__(self):
+        for entry in self._window:
+            if isinstance(entry, ShellItem):
+                yield entry
+            elif entry.is_dir():
+                yield ShellDirectory.from_dir_entry(entry, self._parent_path)
+            else:
+                yield ShellFile.from_dir_entry(entry, self._parent_path)
+
+class ListingCache:
+    """A process-wide cache of directory listings, shared across requests.
+
+    Entries are validated against the directory's device, inode & ``st_mtime_ns``
+    before being used, so an unchanged directory is never scanned twice.
+
+    +---------------------------+-------------------------------------------------+
+    | Configuration Variables   | Description                                     |
+    +===========================+=================================================+
+    |``LISTING_CACHE_MAX_DIRS`` | Max directories to cache. ``0`` disables it.    |
+    +---------------------------+-------------------------------------------------+
+
+    :param app: The Flask application
+    :type app: Flask
+
+    .. note::
+        Only changes to the directory itself are detected. A file being
+        rewritten in place will show its old size until the directory changes.
+
+    """
+    max_dirs = 0
+
+    def __init__(self, app=None):
+        self.lock = threading.RLock()
+        self.cache = None
+        #: Number of listings served from the cache.
+        self.hits = 0
+        #: Number of listings that required a scan.
+        self.misses = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_dirs = app.config.get('LISTING_CACHE_MAX_DIRS', 0)
+        self.finish_setup()
+
+    def finish_setup(self):
+        with self.lock:
+            self.cache = LRUCache(self.max_dirs) if self.max_dirs > 0 else None
+
+    @property
+    def enabled(self):
+        """Whether listings are being cached at all.
+
+        :returns: bool
+        """
+        return self.cache is not None
+
+    @staticmethod
+    def _key(path_string):
+        return os.path.normpath(path_string)
+
+    def get_listing(self, path_string):
+        """Get the listing of a directory, scanning it only when needed.
+
+        :param path_string: The directory to list.
+        :type path_string: str
+        :returns: See :meth:`ShellPath.scan_directory`.
+        """
+        if self.cache is None:
+            return ShellPath.scan_directory(path_string)
+
+        key = self._key(path_string)
+        try:
+            dir_stat = os.stat(path_string)
+        except FileNotFoundError:
+            self.invalidate(path_string)
+            return [], []
+        identity = (dir_stat.st_dev, dir_stat.st_ino, dir_stat.st_mtime_ns)
+
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None and entry[0] == identity:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        # stat() came first, a change during the scan shows up next time
+        listing = ShellPath.scan_directory(path_string)
+        with self.lock:
+            self.cache[key] = (identity, listing)
+        return listing
+
+    def peek(self, path_string):
+        """Get the cached listing of a directory, if it's still valid.
+        This never scans the directory.
+
+        :param path_string: The directory to list.
+        :type path_string: str
+        :returns: See :meth:`ShellPath.scan_directory`, or *None*.
+        """
+        if self.cache is None:
+            return None
+
+        try:
+            dir_stat = os.stat(path_string)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        identity = (dir_stat.st_dev, dir_stat.st_ino, dir_stat.st_mtime_ns)
+
+        with self.lock:
+            entry = self.cache.get(self._key(path_string))
+        if entry is not None and entry[0] == identity:
+            return entry[1]
+        return None
+
+    def invalidate(self, path_string):
+        """Drop the cached listing of a directory.
+
+        :param path_string: The directory that has been changed.
+        :type path_string: str
+        """
+        if self.cache is None:
+            return
+        with self.lock:
+            self.cache.pop(self._key(path_string), None)
+
+    def clear(self):
+        """Drop every cached listing.
+        """
+        if self.cache is None:
+            return
+        with self.lock:
+            self.cache.clear()
+
+###############################################################################
+listing_cache = ListingCache()
@@ -1,21 +1,26 @@
 import os
 import re
 import json
-import mimetypes
 import shutil
-import filetype
+from pathlib import Path
 from flask import (
-    Blueprint, render_template, g, request, send_file, session, abort, redirect,
-    url_for, current_app, make_response
+    Blueprint, render_template, g, request, session, abort, redirect, url_for,
+    current_app, make_response, Response, stream_with_context
 )
 from flask_login import login_required, current_user
 from flfm.misc import get_banner_string, make_arg_url, make_filepond_id
-import flfm.shell.video as vid_fmt
-from .paths import ShellPath, create_proper_shellitem
+from .filetypes import type_detector
+from .media import media_index
+from .paths import (
+    ShellPath, ShellFile, ListingPage, create_proper_shellitem, listing_cache
+)
 from .rules import (
-    enforce_mapped, needs_rules, MappedDirectories, MappedDirectory
+    enforce_mapped, enforce_visible, needs_rules, MappedDirectories,
+    MappedDirectory
 )
-from .uploads import UploadedFile
+from .serving import offload_file, send_conditional
+from .thumbnails import thumbnails
+from .uploads import UploadedFile, receive_upload
 
 shell = Blueprint('shell', __name__, template_folder='templates')
 
@@ -30,6 +35,15 @@ def is_viewable_mimetype(mimetype):
 
     return False
 
+def get_listing_args():
+    sort_by = request.args.get('sort', 'name')
+    reverse = request.args.get('order', 'asc') == 'desc'
+
+    if sort_by not in ListingPage.SORT_KEYS:
+        abort(400)
+
+    return sort_by, reverse
+
 def check_user_can_modify(operation_path):
     if current_user.is_admin:
         return
@@ -42,11 +56,10 @@ def check_user_can_modify(operation_path):
     abort(403)
 
 # Set cache-control header to no-store so the viewer will always work if enabled
+# Responses w/ an ETag are kept by the client, but revalidated every time
 @shell.after_request
 def add_header(response):
-    if 'Cache-Control' not in response.headers:
-        response.headers['Cache-Control'] = 'no-store'
-    else:
+    if 'ETag' not in response.headers:
         response.headers['Cache-Control'] = 'no-store'
     return response
 
@@ -65,36 +78,94 @@ def make_vars_available():
 @needs_rules
 def shell_default():
     return render_template('default.html',
-                           mapped_dirs=MappedDirectories.from_rules(g.fm_rules))
+                           mapped_dirs=g.fm_rules.mapped_dirs)
 
 @shell.route('/shell/<path:view_path>')
 @needs_rules
 def shell_view(view_path):
     view_path_fixed = '/{}'.format(view_path)
-    mapped_dirs = MappedDirectories.from_shell_path(ShellPath(view_path_fixed)).\
-                  apply_rule_map(MappedDirectories.from_rules(g.fm_rules))
+    sort_by, reverse = get_listing_args()
+    page = request.args.get('page', 1, type=int)
+    page_size = current_app.config.get('SHELL_PAGE_SIZE', 0)
+
+    if page < 1:
+        abort(400)
+
+    # Only the requested page is turned into ShellItems
+    if page_size > 0:
+        shell_path = ShellPath.paginated(view_path_fixed, (page-1)*page_size,
+                                         page_size, sort_by, reverse)
+    else:
+        shell_path = ShellPath.cached(view_path_fixed)
+    mapped_dirs = MappedDirectories.from_shell_path(shell_path).\
+                  apply_rule_map(g.fm_rules.mapped_dirs)
     enforce_mapped(mapped_dirs, view_path_fixed)
+    enforce_visible(view_path_fixed)
+    shell_path.apply_mappings(mapped_dirs)
+
+    num_pages = 1
+    if page_size > 0:
+        num_pages = max(1, -(-shell_path.total // page_size))
 
-    shell_path = ShellPath(view_path_fixed, mapped_dirs)
     return render_template('shell.html', whereami=shell_path.str_path,
                            folder_contents=shell_path.children,
-                           cwd_mapping=shell_path.mapping)
+                           cwd_mapping=shell_path.mapping,
+                           view_path=view_path, page=page, num_pages=num_pages,
+                           total_contents=shell_path.total, sort_by=sort_by,
+                           sort_order='desc' if reverse else 'asc')
+
+@shell.route('/listing')
+@needs_rules
+def listing():
+    # JSON listing of a directory, one page at a time
+    def gen_listing(the_page):
+        yield '{{"directory": {}, "offset": {}, "total": {}, "entries": ['.\
+              format(json.dumps(where_at), the_page.offset, the_page.total)
+        for i, item in enumerate(the_page):
+            yield '{}{}'.format(',' if i > 0 else '', json.dumps(dict({
+                'name': item.name,
+                'path': item.path,
+                'directory': item.directory,
+                'size': item.size,
+                'mtime': item.mtime,
+            })))
+        yield ']}'
+    #       #       #       #       #       #
+    where_at = request.args.get('d', None)
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', current_app.config.get('SHELL_PAGE_SIZE', 0),
+                             type=int)
+    sort_by, reverse = get_listing_args()
+
+    if where_at is None or offset < 0 or limit < 0:
+        abort(400)
+
+    # only the directory itself needs mapping, don't scan it for that
+    mapped_dirs = MappedDirectories.from_shell_path(
+        ShellPath(where_at, listing=([], []))
+    ).apply_rule_map(g.fm_rules.mapped_dirs)
+    enforce_mapped(mapped_dirs, where_at)
+    enforce_visible(where_at)
+
+    page = ListingPage(where_at, offset, limit if limit > 0 else None, sort_by,
+                       reverse)
+    return Response(stream_with_context(gen_listing(page)),
+                    mimetype='application/json')
 
 @shell.route('/serve')
 @needs_rules
 def serve_file():
     input_file = request.args['f']
     input_dir = os.path.dirname(input_file)
-    mapped_dirs = MappedDirectories.from_shell_path(ShellPath(input_dir)).\
-                  apply_rule_map(MappedDirectories.from_rules(g.fm_rules))
+    input_path = ShellPath.cached(input_dir)
+    mapped_dirs = MappedDirectories.from_shell_path(input_path).\
+                  apply_rule_map(g.fm_rules.mapped_dirs)
     enforce_mapped(mapped_dirs, input_dir)
+    enforce_visible(input_file)
 
-    mimetype = mimetypes.guess_type(input_file)[0]
-    if mimetype is None:
-        try:
-            mimetype = filetype.guess(input_file).mime
-        except AttributeError:
-            mimetype = 'application/octet-stream'
+    # the detector caches by the file's identity, so this is never stale
+    mimetype = type_detector.mimetype(ShellFile(Path(input_file))) or \
+               'application/octet-stream'
 
     force_download = request.args.get('dl', 0)
     # if the url contains dl=1 skip viewer check altogether
@@ -104,43 +175,104 @@ def serve_file():
             return redirect(make_arg_url(url_for('viewer.view_file'),
                                          {'f': input_file, 'mt': mimetype,}))
 
-    return send_file(input_file, mimetype=mimetype, as_attachment=True,
-                     attachment_filename=os.path.basename(input_file))
+    # let the web server in front of us send it, if configured
+    offloaded = offload_file(input_file, mimetype)
+    if offloaded is not None:
+        return offloaded
+
+    return send_conditional(input_file, mimetype)
+
+@shell.route('/thumb')
+@needs_rules
+def thumbnail():
+    input_file = request.args['f']
+    input_dir = os.path.dirname(input_file)
+    input_path = ShellPath.cached(input_dir)
+    mapped_dirs = MappedDirectories.from_shell_path(input_path).\
+                  apply_rule_map(g.fm_rules.mapped_dirs)
+    enforce_mapped(mapped_dirs, input_dir)
+    enforce_visible(input_file)
+
+    try:
+        width = int(request.args.get('w', 0))
+    except ValueError:
+        abort(400)
+
+    if not ShellFile(Path(input_file)).is_mimetype_family('image/'):
+        abort(415)
+
+    try:
+        variant = thumbnails.get_thumbnail(input_file, width)
+    except ValueError:
+        # e.g. SVGs, the browser can scale those itself
+        return redirect(make_arg_url(url_for('shell.serve_file'),
+                                     {'f': input_file, 'dl': 1}))
+    if variant is None:
+        # animated, or small enough already
+        return redirect(make_arg_url(url_for('shell.serve_file'),
+                                     {'f': input_file}))
+    thumb_file, mimetype = variant
+
+    offloaded = offload_file(thumb_file, mimetype, as_attachment=False)
+    if offloaded is not None:
+        return offloaded
+
+    return send_conditional(thumb_file, mimetype, as_attachment=False)
 
 @shell.route('/process', methods=['POST'])
 @needs_rules
 def process():
-    content_type = re.search(r"^.+;",
-                             request.headers['Content-Type']).group(0).strip(';')
+    content_type = request.mimetype
 
     # Important to Logic
     # pylint: disable=no-else-return
 
     # See: https://pqina.nl/filepond/docs/patterns/api/server/
     if content_type == 'multipart/form-data':
-        filename = request.files['filepond'].filename
         upload_path = request.headers['X-Uploadto']
         filepond_id = make_filepond_id()
-        mapped_dirs = MappedDirectories.from_shell_path(ShellPath(upload_path)).\
-                      apply_rule_map(MappedDirectories.from_rules(g.fm_rules))
+        mapped_dirs = MappedDirectories.from_shell_path(ShellPath.cached(upload_path)).\
+                      apply_rule_map(g.fm_rules.mapped_dirs)
         enforce_mapped(mapped_dirs, upload_path, True)
+        enforce_visible(upload_path)
 
         s_entry = 'tmp_{}'.format(filepond_id)
+        max_size = current_app.config.get('UPLOAD_MAX_SIZE', None)
+        if 'Upload-Length' in request.headers:
+            # a chunked upload; the file itself arrives thru `patch`
+            try:
+                upload_length = int(request.headers['Upload-Length'])
+            except ValueError:
+                abort(400)
+            if max_size is not None and upload_length > max_size:
+                abort(413)
+            session[s_entry] = (filepond_id, upload_path, None, upload_length)
+            return '{}'.format(filepond_id)
+
+        # the body goes straight into the staging file as it's parsed
+        try:
+            upload_file = receive_upload(request.environ, filepond_id,
+                                         upload_path, 'filepond', max_size)
+        except FileExistsError:
+            abort(400)
+        if upload_file is None:
+            abort(400)
+
         # we want the filepond id number to persist between request contexts
         # hence, the use of flask_session `session` object
-        session[s_entry] = (filepond_id, upload_path, filename)
-        upload_file = UploadedFile(filepond_id, upload_path, filename)
-        upload_file.create_temporary()
-        # check if it already exists
-        if upload_file.permanent:
-            abort(400)
-        request.files['filepond'].save(upload_file.file)
+        session[s_entry] = (filepond_id, upload_path, upload_file.filename)
 
         return '{}'.format(filepond_id)
     elif content_type == 'application/x-www-form-urlencoded':
         s_entry = 'tmp_{}'.format(request.form['id'])
-        filepond_id, upload_path, filename = session[s_entry]
+        filepond_id, upload_path, filename = session[s_entry][:3]
+        if filename is None:
+            return 'NOUPLOAD'
         uploaded_file = UploadedFile(filepond_id, upload_path, filename)
+        # a chunked upload is only done once all of it has arrived
+        if len(session[s_entry]) == 4 and \
+           uploaded_file.received_bytes != session[s_entry][3]:
+            return 'NOUPLOAD'
         try:
             uploaded_file.make_permanent()
         except FileExistsError:
@@ -152,6 +284,61 @@ def process():
 
     return ''
 
+@shell.route('/patch/<int:transfer_id>', methods=['HEAD', 'PATCH'])
+@needs_rules
+def patch(transfer_id):
+    # FilePond's chunked uploads; HEAD asks where to resume from
+    s_entry = 'tmp_{}'.format(transfer_id)
+    # only chunked uploads have an Upload-Length
+    if s_entry not in session or len(session[s_entry]) != 4:
+        abort(404)
+    filepond_id, upload_path, filename, upload_length = session[s_entry]
+    mapped_dirs = MappedDirectories.from_shell_path(ShellPath.cached(upload_path)).\
+                  apply_rule_map(g.fm_rules.mapped_dirs)
+    enforce_mapped(mapped_dirs, upload_path, True)
+    enforce_visible(upload_path)
+
+    if request.method == 'HEAD':
+        received = 0
+        if filename is not None:
+            received = UploadedFile(filepond_id, upload_path, filename).received_bytes
+        response = make_response('')
+        response.headers['Upload-Offset'] = str(received)
+        return response
+
+    try:
+        offset = int(request.headers['Upload-Offset'])
+    except (KeyError, ValueError):
+        abort(400)
+
+    if filename is None:
+        filename = request.headers.get('Upload-Name', '')
+        try:
+            # browsers send the name as UTF-8, werkzeug decodes as latin-1
+            filename = filename.encode('latin-1').decode('utf-8')
+        except UnicodeError:
+            pass
+        filename = os.path.basename(filename)
+        if not filename:
+            abort(400)
+        session[s_entry] = (filepond_id, upload_path, filename, upload_length)
+
+    upload_file = UploadedFile(filepond_id, upload_path, filename)
+    # check if it already exists
+    if upload_file.permanent:
+        abort(400)
+    if offset > upload_length:
+        abort(409)
+    try:
+        received = upload_file.write_chunk(offset, request.stream,
+                                           limit=upload_length - offset)
+    except ValueError:
+        abort(409)
+
+    response = make_response('')
+    response.headers['Upload-Offset'] = str(received)
+    return response
+
 @shell.route('/medialist', methods=['POST'])
 @needs_rules
 def medialist():
@@ -176,13 +363,17 @@ def medialist():
     if where_at is None or what_kind is None:
         abort(400)
 
-    this_path = ShellPath(where_at)
+    this_path = ShellPath.cached(where_at)
     mapped_dirs = MappedDirectories.from_shell_path(this_path).\
-                  apply_rule_map(MappedDirectories.from_rules(g.fm_rules))
+                  apply_rule_map(g.fm_rules.mapped_dirs)
     enforce_mapped(mapped_dirs, where_at)
+    enforce_visible(where_at)
 
-    matched_media = list(filter(lambda f: f.is_mimetype_family(what_kind),
-                                this_path.files))
+    # one pass over the directory, only reading what the names don't tell
+    the_files = this_path.files
+    matched_media = [f for f, mimetype in zip(the_files,
+                                              type_detector.classify(the_files))
+                     if mimetype is not None and mimetype.startswith(what_kind)]
 
     # create the linked-list like object for the frontend
     the_medialist = list(gen_ml(matched_media))
@@ -201,10 +392,11 @@ def mediainfo():
     if where_at is None or what_file is None:
         abort(400)
 
-    this_path = ShellPath(where_at)
+    this_path = ShellPath.cached(where_at)
     mapped_dirs = MappedDirectories.from_shell_path(this_path).\
-                  apply_rule_map(MappedDirectories.from_rules(g.fm_rules))
+                  apply_rule_map(g.fm_rules.mapped_dirs)
     enforce_mapped(mapped_dirs, where_at)
+    enforce_visible(where_at)
 
     # Fix `what_file` if it redundantly includes the path
     if where_at in what_file:
@@ -219,18 +411,40 @@ def mediainfo():
     except IndexError:
         abort(400)
 
+    media_info = media_index.get_info(shell_file)
+    if media_info['format'] is None:
+        abort(501)
     media_info['filename'] = shell_file.name
+    # keyframe times (ms) & offsets into the original file
+    media_info['seek_index'] = media_index.get_seek_index(shell_file)
 
-    if 'mp4' in shell_file.mimetype:
-        video = vid_fmt.MP4File(shell_file.path)
-        media_info['width'] = video.video_width
-        media_info['height'] = video.video_height
-    else:
-        abort(501)
+    resp = make_response(json.dumps(media_info))
+    resp.mimetype = 'application/json'
+    return resp
 
-    media_info['mimetype'] = shell_file.mimetype
+@shell.route('/mediainfo/directory', methods=['POST'])
+@needs_rules
+def mediainfo_directory():
+    # the mediainfo of every video in a directory, in one go
+    where_at = request.form.get('directory', None)
+    if where_at is None:
+        abort(400)
 
-    resp = make_response(json.dumps(media_info))
+    this_path = ShellPath.cached(where_at)
+    mapped_dirs = MappedDirectories.from_shell_path(this_path).\
+                  apply_rule_map(g.fm_rules.mapped_dirs)
+    enforce_mapped(mapped_dirs, where_at)
+    enforce_visible(where_at)
+
+    # go by the extension, only opening the files it says nothing about
+    the_files = this_path.files
+    videos = [f for f, mimetype in zip(the_files, type_detector.classify(the_files))
+              if mimetype is not None and mimetype.startswith('video/')]
+    media_infos = media_index.get_directory_info(where_at, videos)
+    for name, media_info in media_infos.items():
+        media_info['filename'] = name
+
+    resp = make_response(json.dumps(media_infos))
     resp.mimetype = 'application/json'
     return resp
 
@@ -255,9 +469,10 @@ def perform():
         # prevent people with curl & cookies from wreaking havoc
         check_user_can_modify(input_dir)
 
-        mapped_dirs = MappedDirectories.from_shell_path(ShellPath(input_dir)).\
-                      apply_rule_map(MappedDirectories.from_rules(g.fm_rules))
+        mapped_dirs = MappedDirectories.from_shell_path(ShellPath.cached(input_dir)).\
+                      apply_rule_map(g.fm_rules.mapped_dirs)
         enforce_mapped(mapped_dirs, input_dir)
+        enforce_visible(file.path if file is not None else dir.path)
 
     # # # # # # # # # # # # # # # # # # # # # # # # #
 
@@ -283,9 +498,12 @@ def perform():
         else:
             do_enforcement(target, None)
             shutil.rmtree(target.path, True)
+            listing_cache.invalidate(target.path)
+        listing_cache.invalidate(target.parent_directory())
     elif 'rename' in action:
         target = create_proper_shellitem(parameters[0])
         new_name = '{}/{}'.format(target.parent_directory(), parameters[1])
+        enforce_visible(new_name)
 
         if target.file:
             do_enforcement(None, target)
@@ -293,6 +511,8 @@ def perform():
         else:
             do_enforcement(target, None)
             os.rename(target.path, new_name)
+            listing_cache.invalidate(target.path)
+        listing_cache.invalidate(target.parent_directory())
 
     return 'SUCCESS'
 
@@ -309,13 +529,15 @@ def newdir():
     # prevent people with curl & cookies from wreaking havoc
     check_user_can_modify(where_at)
 
-    mapped_dirs = MappedDirectories.from_shell_path(ShellPath(where_at)).\
-                  apply_rule_map(MappedDirectories.from_rules(g.fm_rules))
+    mapped_dirs = MappedDirectories.from_shell_path(ShellPath.cached(where_at)).\
+                  apply_rule_map(g.fm_rules.mapped_dirs)
     enforce_mapped(mapped_dirs, where_at)
+    enforce_visible(os.path.join(where_at, new_dir))
 
     try:
         os.mkdir(os.path.join(where_at, new_dir))
     except (FileExistsError, PermissionError, OSError):
         return 'FAIL'
+    listing_cache.invalidate(where_at)
 
     return 'SUCCESS'
@@ -9,11 +9,14 @@ import collections.abc
 import copy
 import os
 import re
+import threading
+import time
 from functools import wraps
+from cachetools import TTLCache
 from werkzeug.datastructures import MultiDict
 from flask import current_app, g, flash, abort
 from flask_login import current_user
-from .paths import ShellDirectory
+from .paths import ShellDirectory, hidden_names
 
 def read_rules_file(rule_file):
     """Generate (key, value) tuples from the rules file.
@@ -54,6 +57,16 @@ def enforce_mapped(mapped_dirs, requested_path, for_upload=False):
     # Can't find a damn thing? Abort!
     abort(403)
 
+def enforce_visible(requested_path):
+    """Refuse paths thru entries left out of listings, e.g. the staging
+    directories of uploads in progress.
+
+    :param requested_path: The path of the file or directory.
+    :type requested_path: str
+    """
+    if any(part in hidden_names for part in _path_components(requested_path)):
+        abort(404)
+
 
 def needs_rules(needing_method):
     """A decorator to wrap around ``routes`` requiring rules.
@@ -62,18 +75,11 @@ def needs_rules(needing_method):
     def load_rules(*args, **kwargs):
         rules_file = current_app.config['RULES_FILE']
         if not hasattr(g, 'fm_rules'):
-            the_rules = Rules(rules_file)
+            the_rules = rules_registry.get_rules(rules_file)
 
             if current_user.is_authenticated:
-                users_rules = VirtualRules.make_virtual(the_rules)
-                users_rules.allowed(current_user.home_folder)
-                users_rules.allow_uploads(current_user.home_folder)
-                # Add shares
-                if current_user.shares_received.count() > 0:
-                    for share in current_user.shares_received.all():
-                        users_rules.allowed(share.owner.home_folder)
-
-                the_rules = users_rules
+                the_rules = rules_registry.get_user_rules(current_user,
+                                                          the_rules)
 
             g.fm_rules = the_rules
 
@@ -98,6 +104,7 @@ class Rules:
                 self._rules = MultiDict()
         except FileNotFoundError:
             self._rules = MultiDict()
+        self._mapped_dirs = None
 
     @property
     def rules(self):
@@ -119,9 +126,179 @@ class Rules:
 
         return count_o_rules
 
+    @property
+    def mapped_dirs(self):
+        """These rules as a :class:`MappedDirectories`. It's only created
+        (and compiled) once per set of rules.
+
+        .. note::
+            Treat it as read-only. Use :meth:`MappedDirectories.from_rules` for
+            a copy that can be changed.
+
+        """
+        if self._mapped_dirs is None:
+            self._mapped_dirs = MappedDirectories.from_rules(self)
+        return self._mapped_dirs
+
     def __len__(self):
         return self.num_rules
 
+class RulesRegistry:
+    """Keeps the parsed ``rules`` file for the whole process.
+
+    The file is parsed once. Afterwards, it's ``stat()``'d at most once every
+    ``RULES_CHECK_INTERVAL`` seconds and re-parsed only if it has changed. The
+    new :class:`Rules` is swapped in atomically, so requests only ever read a
+    reference.
+
+    +-------------------------+---------------------------------------------------+
+    | Configuration Variables | Description                                       |
+    +=========================+===================================================+
+    |``RULES_CHECK_INTERVAL`` | Seconds between checks for a changed rules file.  |
+    +-------------------------+---------------------------------------------------+
+    |``USER_RULES_MAX_USERS`` | Max users whose rules are kept at one time.       |
+    +-------------------------+---------------------------------------------------+
+    |``USER_RULES_TTL``       | Seconds a user's rules are kept. This bounds how  |
+    |                         | long other processes take to notice new shares.   |
+    +-------------------------+---------------------------------------------------+
+
+    :param app: The Flask application
+    :type app: Flask
+    """
+    check_interval = 0
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        # (rules file, its identity, Rules, monotonic time of last check)
+        self._current = None
+        #: Number of times the rules file has been parsed.
+        self.reloads = 0
+        #: Seconds spent parsing the rules file the last time.
+        self.last_parse_time = 0.0
+        #: Seconds spent parsing the rules file in total.
+        self.total_parse_time = 0.0
+        self.user_lock = threading.RLock()
+        self.user_rules = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.check_interval = app.config.get('RULES_CHECK_INTERVAL', 0)
+        self._current = None
+        with self.user_lock:
+            self.user_rules = TTLCache(app.config.get('USER_RULES_MAX_USERS', 1024),
+                                       app.config.get('USER_RULES_TTL', 60))
+
+    @staticmethod
+    def _identity(rule_file):
+        if rule_file is None:
+            return None
+        try:
+            the_stat = os.stat(rule_file)
+        except OSError:
+            return None
+        return (the_stat.st_dev, the_stat.st_ino, the_stat.st_size,
+                the_stat.st_mtime_ns)
+
+    def get_rules(self, rule_file):
+        """Get the current :class:`Rules` for ``rule_file``.
+
+        :param rule_file: Path to the ``rules`` file
+        :type rule_file: str
+        :returns: A :class:`Rules` that **must not** be modified.
+        """
+        current = self._current
+        now = time.monotonic()
+
+        if current is not None and current[0] == rule_file:
+            if now - current[3] < self.check_interval:
+                return current[2]
+            identity = self._identity(rule_file)
+            if identity == current[1]:
+                self._current = (rule_file, identity, current[2], now)
+                return current[2]
+
+        with self.lock:
+            # someone else may have just reloaded it
+            current = self._current
+            identity = self._identity(rule_file)
+            if current is not None and current[0] == rule_file \
+            and current[1] == identity:
+                return current[2]
+
+            start = time.perf_counter()
+            the_rules = Rules(rule_file)
+            # compile now, instead of during someone's request
+            the_rules.mapped_dirs.compiled # pylint: disable=pointless-statement
+            self.last_parse_time = time.perf_counter() - start
+            self.total_parse_time += self.last_parse_time
+            self.reloads += 1
+
+            self._current = (rule_file, identity, the_rules, now)
+            return the_rules
+
+    def invalidate(self):
+        """Force the rules file to be parsed again on the next request.
+        """
+        self._current = None
+
+    @staticmethod
+    def make_user_rules(user, base_rules):
+        """Create the effective rules of a user: ``base_rules``, plus their home
+        folder, plus the home folders shared with them.
+
+        :param user: The user.
+        :type user: :class:`~flfm.models.User`
+        :param base_rules: The rules from the ``rules`` file.
+        :type base_rules: A :class:`Rules` instance.
+        :returns: A :class:`VirtualRules`.
+        """
+        users_rules = VirtualRules.make_virtual(base_rules)
+        users_rules.allowed(user.home_folder)
+        users_rules.allow_uploads(user.home_folder)
+        # Add shares
+        for share in user.shares_received.all():
+            users_rules.allowed(share.owner.home_folder)
+        return users_rules
+
+    def get_user_rules(self, user, base_rules):
+        """Get the effective rules of a user, see :meth:`make_user_rules`.
+        They are only created again when ``base_rules`` has been reloaded,
+        the user's shares have changed, or they have expired.
+
+        :param user: The user.
+        :type user: :class:`~flfm.models.User`
+        :param base_rules: The rules from the ``rules`` file.
+        :type base_rules: A :class:`Rules` instance.
+        :returns: A :class:`VirtualRules` that **must not** be modified.
+        """
+        if self.user_rules is None:
+            return self.make_user_rules(user, base_rules)
+
+        with self.user_lock:
+            entry = self.user_rules.get(user.id)
+        if entry is not None and entry[0] is base_rules:
+            return entry[1]
+
+        users_rules = self.make_user_rules(user, base_rules)
+        # compile now, the next requests get it for free
+        users_rules.mapped_dirs.compiled # pylint: disable=pointless-statement
+        with self.user_lock:
+            self.user_rules[user.id] = (base_rules, users_rules)
+        return users_rules
+
+    def invalidate_user(self, user_id):
+        """Drop the cached rules of a user, ie: when their shares change.
+
+        :param user_id: The id of the user.
+        :type user_id: int
+        """
+        if self.user_rules is None:
+            return
+        with self.user_lock:
+            self.user_rules.pop(user_id, None)
+
 # C'mon pylint VirtualRules derives from Rules
 # Derived classes get them juicy protecteds
 # pylint: disable=protected-access
@@ -168,6 +345,7 @@ class VirtualRules(Rules):
         :param remove: Remove this rule for ``directory``. **Default:** *False*.
         :type remove: bool
         """
+        self._mapped_dirs = None
         if remove:
             self._remove_item('Allowed', directory)
             return
@@ -181,6 +359,7 @@ class VirtualRules(Rules):
         :param remove: Remove this rule for ``directory``. **Default:** *False*.
         :type remove: bool
         """
+        self._mapped_dirs = None
         if remove:
             self._remove_item('AllowUploads', directory)
             return
@@ -194,6 +373,7 @@ class VirtualRules(Rules):
         :param remove: Remove this rule for ``directory``. **Default:** *False*.
         :type remove: bool
         """
+        self._mapped_dirs = None
         if remove:
             self._remove_item('Disallowed', directory)
             return
@@ -287,6 +467,88 @@ class MappedDirectory:
         """
         return ShellDirectory.from_str_loc(self.dir_path)
 
+def _path_components(path):
+    # Split like os.path.commonpath does: empty & '.' components are dropped
+    return [c for c in path.split('/') if c and c != '.']
+
+class _RuleNode:
+    __slots__ = ('children', 'rule', 'order')
+
+    def __init__(self):
+        self.children = dict()
+        self.rule = None
+        self.order = -1
+
+class RuleTrie:
+    """Rules from a :class:`MappedDirectories` compiled into a tree of path
+    components, so that resolving the permissions of a path is O(depth).
+
+    Resolution is identical to what :meth:`MappedDirectories.apply_rule_map`
+    has always done:
+
+    * A path that is itself a ruled directory takes that directory's rule.
+    * Otherwise, if any ruled directory above it is disallowed, it's disallowed.
+    * Otherwise, it takes the rule of the *outermost* allowed directory above it.
+
+    :param rule_map: The rules to compile.
+    :type rule_map: An instance of :class:`MappedDirectories`
+    """
+    def __init__(self, rule_map):
+        self._exact = dict(rule_map.D)
+        self._roots = dict({True: _RuleNode(), False: _RuleNode()})
+
+        for order, (dir_path, rule) in enumerate(self._exact.items()):
+            components = _path_components(dir_path)
+            is_abs = dir_path.startswith('/')
+            normalized = '/'.join(components)
+            if is_abs:
+                normalized = '/' + normalized
+            # A directory is only ever `in tree` when written in normal form
+            if dir_path != normalized or not dir_path:
+                continue
+
+            node = self._roots[is_abs]
+            for component in components:
+                node = node.children.setdefault(component, _RuleNode())
+            node.rule = rule
+            node.order = order
+
+    def resolve(self, dir_path):
+        """Get the permissions that apply to ``dir_path``.
+
+        :param dir_path: The path to resolve.
+        :type dir_path: str
+        :returns: tuple -- (ALLOWED??, UPLOAD_ALLOWED??) or *None* if no rule
+                  applies.
+        """
+        rule = self._exact.get(dir_path)
+        if rule is not None:
+            return rule
+
+        outermost_allowed = None
+        first_disallowed = None
+        node = self._roots[dir_path.startswith('/')]
+        components = iter(_path_components(dir_path))
+        while node is not None:
+            if node.rule is not None:
+                if not node.rule[0]:
+                    # the first disallowed rule, in rule order, takes it
+                    if first_disallowed is None or \
+                    node.order < first_disallowed.order:
+                        first_disallowed = node
+                elif outermost_allowed is None:
+                    outermost_allowed = node
+            component = next(components, None)
+            if component is None:
+                break
+            node = node.children.get(component)
+
+        if first_disallowed is not None:
+            return first_disallowed.rule
+        if outermost_allowed is not None:
+            return outermost_allowed.rule
+        return None
+
 # `D` is an inherited property
 # pylint: disable=invalid-name
 
@@ -303,6 +565,7 @@ class MappedDirectories(collections.abc.Mapping):
     """
     def __init__(self, some_dict):
         self.D = some_dict
+        self._compiled = None
 
     @classmethod
     def from_rules(cls, rules):
@@ -360,6 +623,7 @@ class MappedDirectories(collections.abc.Mapping):
         return self.D.get(key)
 
     def __setitem__(self, key, item):
+        self._compiled = None
         if isinstance(item, MappedDirectory):
             new_item = (item.dir_allowed, item.dir_allowuploads)
             self.D[key] = new_item
@@ -408,6 +672,15 @@ class MappedDirectories(collections.abc.Mapping):
         """
         return MappedDirectory.create_from_mapping(self, dir_path)
 
+    @property
+    def compiled(self):
+        """This container's rules compiled into a :class:`RuleTrie`.
+        It's only compiled once, unless this container is changed.
+        """
+        if self._compiled is None:
+            self._compiled = RuleTrie(self)
+        return self._compiled
+
     def apply_rule_map(self, rule_map):
         """Merge the rules of this :class:`MappedDirectories` and another.
 
@@ -415,42 +688,12 @@ class MappedDirectories(collections.abc.Mapping):
         :type rule_map: Another :class:`MappedDirectories`
         :returns: ``self``, this instance but updated.
         """
-        def length_paths(other_map):
-            for md in other_map:
-                yield len(md.dir_path)
-        def difference_length(my_length, all_lengths):
-            for length in all_lengths:
-                yield abs(length-my_length)
-
-        # the length of each path in the rule mapping
-        rule_map_lens = list(length_paths(rule_map))
-
-        for my_dir in self:
-            # apply rule directly on top
-            # iterate, because it's been explicitly set
-            if my_dir in rule_map:
-                self[my_dir.dir_path] = rule_map.get_mapped_dir(my_dir.dir_path)
-                continue
-            for rule_dir in rule_map:
-                # are we in the tree of a ruled directory?
-                if rule_dir.is_in_tree(my_dir.dir_path):
-                    # we are in a tree of a disallowed directory
-                    # prevent overwriting permissions
-                    if not rule_dir.dir_allowed:
-                        self[my_dir.dir_path] = rule_dir
-                        break
-                    my_length = len(my_dir.dir_path)
-                    rd_length = len(rule_dir.dir_path)
-                    # only lengths of what's in tree
-                    rule_map_lens = list(filter(lambda x, l=rd_length: x <= l,
-                                                rule_map_lens))
-                    # apply rules to subdirectories of a ruled directory
-                    # the most-common parent path from the rule mapping is the
-                    # # one whose permissions shall be applied to the subdirectory
-                    if my_length == min(difference_length(my_length, rule_map_lens))+rd_length:
-                        self[my_dir.dir_path] = rule_dir
-            # reset for next iteration
-            rule_map_lens = list(length_paths(rule_map))
+        rule_trie = rule_map.compiled
+
+        for dir_path in list(self.D):
+            rule = rule_trie.resolve(dir_path)
+            if rule is not None:
+                self[dir_path] = rule
 
         return self
 
@@ -471,3 +714,6 @@ class MappedDirectories(collections.abc.Mapping):
         for md in self:
             count_disallowed += 1 if not md.dir_allowed else 0
         return count_disallowed
+
+###############################################################################
+rules_registry = RulesRegistry()
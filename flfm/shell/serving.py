@@ -0,0 +1,153 @@
+"""
+    Serving Files
+    ~~~~~~~~~~~~~
+
+    Handing the bytes of files over to the client, or to the web server in
+    front of FLFM.
+
+"""
+import os
+import unicodedata
+from flask import current_app, request, send_file, Response
+from werkzeug.urls import url_quote
+
+#: Values of ``SERVE_OFFLOAD`` & the header each one uses.
+OFFLOAD_HEADERS = {
+    'x-accel-redirect': 'X-Accel-Redirect',
+    'x-sendfile': 'X-Sendfile',
+}
+
+def make_etag(stat_result):
+    """Create a strong ETag from a file's identity: inode, size & mtime.
+
+    :param stat_result: The ``stat()`` of the file.
+    :type stat_result: os.stat_result
+    :returns: str
+    """
+    return '{:x}-{:x}-{:x}'.format(stat_result.st_ino, stat_result.st_size,
+                                   stat_result.st_mtime_ns)
+
+def revalidate_privately(response):
+    """Let the client keep ``response``, but only after revalidating it.
+
+    The response can differ with the viewer cookie (a file or a redirect to
+    the viewer), so it also varies on ``Cookie``.
+
+    :param response: A response with an ETag.
+    :returns: ``response``
+    """
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.cache_control.max_age = None
+    response.vary.add('Cookie')
+    return response
+
+def send_conditional(filepath, mimetype, as_attachment=True):
+    """Send a file, honoring ``Range``, ``If-Range``, ``If-None-Match`` and
+    ``If-Modified-Since``. Partial requests get a *206*, unchanged files a *304*.
+
+    :param filepath: The path of the file, already checked against the rules.
+    :type filepath: str
+    :param mimetype: The mimetype to send the file as.
+    :type mimetype: str
+    :param as_attachment: Send as an attachment. **Default: True**
+    :type as_attachment: bool
+    """
+    the_stat = os.stat(filepath)
+    response = send_file(filepath, mimetype=mimetype,
+                         as_attachment=as_attachment,
+                         attachment_filename=os.path.basename(filepath),
+                         add_etags=False, conditional=False)
+    response.set_etag(make_etag(the_stat))
+    revalidate_privately(response)
+    return response.make_conditional(request, accept_ranges=True,
+                                     complete_length=the_stat.st_size)
+
+def attachment_headers(filename):
+    """Generate the parameters of a ``Content-Disposition: attachment`` header
+    the same way **Flask**'s ``send_file`` does.
+
+    :param filename: The name the client should save the file as.
+    :type filename: str
+    :returns: dict -- keyword arguments for ``Headers.add``.
+    """
+    try:
+        filename.encode('ascii')
+    except UnicodeEncodeError:
+        return dict({
+            'filename': unicodedata.normalize('NFKD', filename).\
+                        encode('ascii', 'ignore').decode('ascii'),
+            'filename*': "UTF-8''{}".format(url_quote(filename, safe=b'')),
+        })
+    return dict({'filename': filename})
+
+def map_offload_path(filepath, offload_map):
+    """Map a local file to where the web server knows it by, using the longest
+    matching directory in ``offload_map``.
+
+    :param filepath: The absolute path of the file.
+    :type filepath: str
+    :param offload_map: Local directories mapped to internal locations.
+    :type offload_map: dict
+    :returns: str -- The internal location, or *None* if nothing matched.
+    """
+    filepath = os.path.normpath(filepath)
+    best = None
+    for local_dir, location in offload_map.items():
+        local_dir = local_dir.rstrip('/')
+        if filepath.startswith(local_dir + '/'):
+            if best is None or len(local_dir) > len(best[0]):
+                best = (local_dir, location)
+
+    if best is None:
+        return None
+
+    relative = filepath[len(best[0])+1:]
+    return '{}/{}'.format(best[1].rstrip('/'), relative)
+
+def offload_file(filepath, mimetype, as_attachment=True):
+    """Create a response telling the web server in front of FLFM to send
+    ``filepath`` itself, without its bytes going through this worker.
+
+    +-------------------------+---------------------------------------------------+
+    | Configuration Variables | Description                                       |
+    +=========================+===================================================+
+    |``SERVE_OFFLOAD``        | ``x-accel-redirect`` (nginx), ``x-sendfile``      |
+    |                         | (Apache, lighttpd) or *None* to disable.          |
+    +-------------------------+---------------------------------------------------+
+    |``SERVE_OFFLOAD_MAP``    | Local directories mapped to the web server's      |
+    |                         | internal locations. Required for nginx.           |
+    +-------------------------+---------------------------------------------------+
+
+    :param filepath: The absolute path of the file, already checked against
+                     the rules.
+    :type filepath: str
+    :param mimetype: The mimetype to send the file as.
+    :type mimetype: str
+    :param as_attachment: Send as an attachment. **Default: True**
+    :type as_attachment: bool
+    :returns: A response, or *None* if the file can't be offloaded.
+    """
+    mode = current_app.config.get('SERVE_OFFLOAD', None)
+    if not mode or mode.lower() not in OFFLOAD_HEADERS:
+        return None
+    mode = mode.lower()
+
+    offload_map = current_app.config.get('SERVE_OFFLOAD_MAP', None) or dict()
+    location = map_offload_path(filepath, offload_map)
+    if location is None:
+        # nginx can only serve what an internal location exposes
+        if mode == 'x-accel-redirect':
+            return None
+        location = os.path.normpath(filepath)
+
+    if mode == 'x-accel-redirect':
+        location = url_quote(location, safe='/')
+
+    response = Response(mimetype=mimetype)
+    response.headers[OFFLOAD_HEADERS[mode]] = location
+    if as_attachment:
+        response.headers.add('Content-Disposition', 'attachment',
+                             **attachment_headers(os.path.basename(filepath)))
+    return response
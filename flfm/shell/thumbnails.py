@@ -0,0 +1,323 @@
+"""
+    Thumbnails
+    ~~~~~~~~~~
+
+    Downscaled variants of images, rendered in worker processes and kept on
+    disk by the identity of their source.
+
+"""
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageOps
+from flfm.viewer.staging import run_directly, run_in_tpool
+
+#: Output formats, by what they're saved as.
+THUMB_FORMATS = {
+    '.jpg': ('JPEG', 'image/jpeg'),
+    '.png': ('PNG', 'image/png'),
+}
+
+def render_thumbnail(source, destination, size, quality=85):
+    """Render a variant of ``source`` fitting in ``size`` x ``size``. Images
+    with transparency become PNGs, everything else becomes a JPEG. This is
+    what the worker processes run.
+
+    :param source: The path of the image.
+    :type source: str
+    :param destination: The path to save to, less the extension.
+    :type destination: str
+    :param size: The bounding box, in pixels.
+    :type size: int
+    :param quality: The JPEG quality.
+    :type quality: int
+    :returns: str -- The path it was saved to.
+    :raises ValueError: ``source`` can't be read as an image.
+    """
+    try:
+        with Image.open(source) as image:
+            # let the JPEG decoder do most of the downscaling
+            image.draft('RGB', (size, size))
+            variant = ImageOps.exif_transpose(image)
+            variant.thumbnail((size, size), Image.LANCZOS)
+    except (OSError, Image.DecompressionBombError) as err:
+        raise ValueError("{} is not a readable image.".format(source)) from err
+
+    if variant.mode in ('RGBA', 'LA') or \
+       (variant.mode == 'P' and 'transparency' in variant.info):
+        extension = '.png'
+        save_args = dict({'optimize': True})
+    else:
+        extension = '.jpg'
+        variant = variant.convert('RGB')
+        save_args = dict({'quality': quality, 'optimize': True,
+                          'progressive': True})
+
+    where = os.path.dirname(destination)
+    os.makedirs(where, exist_ok=True)
+    temp_fd, temp_path = tempfile.mkstemp(dir=where, prefix='.thumb-')
+    try:
+        with os.fdopen(temp_fd, 'wb') as temp_file:
+            variant.save(temp_file, THUMB_FORMATS[extension][0], **save_args)
+        os.replace(temp_path, destination + extension)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return destination + extension
+
+def wants_original(source, size):
+    """Whether ``source`` is better served as it is than as a variant fitting
+    in ``size`` x ``size``: animations would be flattened to their first
+    frame, and images already that small would only be re-encoded.
+
+    :param source: The path of the image.
+    :type source: str
+    :param size: The bounding box, in pixels.
+    :type size: int
+    :returns: bool
+    :raises ValueError: ``source`` can't be read as an image.
+    """
+    try:
+        # only reads the header, the pixels are left alone
+        with Image.open(source) as image:
+            if getattr(image, 'is_animated', False):
+                return True
+            return max(image.size) <= size
+    except (OSError, Image.DecompressionBombError) as err:
+        raise ValueError("{} is not a readable image.".format(source)) from err
+
+class Thumbnails:
+    """Renders & caches downscaled variants of images. Variants are named by
+    a digest of the source's device, inode, size & modification time along
+    with the variant's size, so a changed image gets new variants and the old
+    ones are never served again. Requested widths are rounded up to one of
+    ``THUMB_SIZES``, keeping the number of variants per image small.
+
+    Serving a variant touches its modification time. Once the variants add up
+    to more than ``THUMB_MAX_BYTES``, the least recently used ones are removed,
+    old ones of changed images included.
+
+    +-------------------------+---------------------------------------------------+
+    | Configuration Variables | Description                                       |
+    +=========================+===================================================+
+    |``THUMB_DIRECTORY``      | Where to keep the variants. *None* disables them. |
+    +-------------------------+---------------------------------------------------+
+    |``THUMB_MAX_BYTES``      | The total size of all the variants.               |
+    +-------------------------+---------------------------------------------------+
+    |``THUMB_SIZES``          | The sizes of the variants, in pixels.             |
+    +-------------------------+---------------------------------------------------+
+    |``THUMB_QUALITY``        | JPEG quality of the variants.                     |
+    +-------------------------+---------------------------------------------------+
+    |``THUMB_WORKERS``        | Processes rendering variants. *0* renders them in |
+    |                         | the requesting thread.                            |
+    +-------------------------+---------------------------------------------------+
+
+    :param app: The Flask application
+    :type app: Flask
+    """
+    directory = None
+    max_bytes = 1073741824
+    sizes = (160, 320, 640, 1280, 1920, 2560, 3840)
+    quality = 85
+    workers = 2
+    #: Seconds before an unfinished render's temporary file is collected.
+    stale_after = 3600
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.pool = None
+        #: Variants being rendered, by their destination.
+        self.pending = dict()
+        #: Number of variants that were already on disk.
+        self.hits = 0
+        #: Number of variants that had to be rendered.
+        self.renders = 0
+        #: Number of variants removed to stay within the budget.
+        self.evictions = 0
+        # bytes on disk as of the last scan, plus what's been rendered since
+        self.usage = None
+        self.blocking = run_directly
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.directory = app.config.get('THUMB_DIRECTORY', None)
+        self.sizes = tuple(sorted(app.config.get('THUMB_SIZES', self.sizes)))
+        self.quality = app.config.get('THUMB_QUALITY', 85)
+        self.workers = app.config.get('THUMB_WORKERS', 2)
+        self.max_bytes = app.config.get('THUMB_MAX_BYTES', 1073741824)
+
+        # like the video staging, keep blocking waits off eventlet's hub
+        socketio = app.extensions.get('socketio')
+        if socketio is not None and socketio.async_mode == 'eventlet':
+            self.blocking = run_in_tpool
+        else:
+            self.blocking = run_directly
+        self.finish_setup()
+
+    def finish_setup(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown(wait=False)
+            self.pool = None
+            self.usage = None
+
+    def fit_size(self, width):
+        """The smallest of :attr:`sizes` covering ``width``.
+
+        :param width: The width wanted. *0* for the largest.
+        :type width: int
+        :returns: int
+        """
+        for size in self.sizes:
+            if width and size >= width:
+                return size
+        return self.sizes[-1]
+
+    def variant_path(self, path, size):
+        """Where the variant of an image is kept, less the extension.
+
+        :param path: The path of the image.
+        :type path: str
+        :param size: See :meth:`fit_size`.
+        :type size: int
+        :returns: str
+        """
+        the_stat = os.stat(path)
+        digest = hashlib.sha1('{}:{}:{}:{}:{}'.format(
+            the_stat.st_dev, the_stat.st_ino, the_stat.st_size,
+            the_stat.st_mtime_ns, size
+        ).encode('ascii')).hexdigest()
+        return os.path.join(self.directory, digest[0:2], digest)
+
+    def _get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                # forking a process full of threads & sockets isn't safe
+                self.pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            return self.pool
+
+    def get_thumbnail(self, path, width):
+        """Get a variant of an image no larger than ``width``, rendering it if
+        it isn't on disk yet. Requests for a variant already being rendered
+        wait for that render. Animations & images already within the size have
+        no variants, see :func:`wants_original`.
+
+        :param path: The path of the image, already checked against the rules.
+        :type path: str
+        :param width: The width wanted.
+        :type width: int
+        :returns: tuple -- (path of the variant, its mimetype), or *None* when
+                  the original should be served instead.
+        :raises ValueError: The image can't be read, or variants are disabled.
+        """
+        if not self.directory:
+            raise ValueError("THUMB_DIRECTORY isn't set.")
+
+        size = self.fit_size(width)
+        destination = self.variant_path(path, size)
+        for extension, (_, mimetype) in THUMB_FORMATS.items():
+            try:
+                # the modification time orders the least recently used
+                os.utime(destination + extension)
+            except FileNotFoundError:
+                continue
+            with self.lock:
+                self.hits += 1
+            return destination + extension, mimetype
+
+        blocking = self.blocking
+        if blocking(wants_original, path, size):
+            return None
+
+        if self.workers <= 0:
+            with self.lock:
+                self.renders += 1
+            rendered = blocking(render_thumbnail, path, destination, size,
+                                self.quality)
+        else:
+            pool = self._get_pool()
+            with self.lock:
+                future = self.pending.get(destination)
+                if future is None:
+                    self.renders += 1
+                    future = pool.submit(render_thumbnail, path, destination,
+                                         size, self.quality)
+                    self.pending[destination] = future
+            try:
+                # waiting on the pool blocks, unlike waiting on a green thread
+                rendered = blocking(future.result)
+            finally:
+                with self.lock:
+                    if self.pending.get(destination) is future:
+                        del self.pending[destination]
+
+        self._account(os.path.getsize(rendered), blocking)
+        return rendered, THUMB_FORMATS[os.path.splitext(rendered)[1]][1]
+
+    def _account(self, num_bytes, blocking):
+        with self.lock:
+            if self.usage is not None:
+                self.usage += num_bytes
+            over = self.usage is None or self.usage > self.max_bytes
+        # only rescan the directory once it might be over budget
+        if over:
+            self.trim(blocking)
+
+    def trim(self, blocking=None):
+        """Remove the least recently used variants until they're within
+        :attr:`max_bytes`, along with temporary files left by renders that
+        never finished.
+
+        :param blocking: Runs the scan. Defaults to :attr:`blocking`.
+        :type blocking: callable
+        :returns: int -- The bytes left in :attr:`directory`.
+        """
+        usage, evicted = (blocking or self.blocking)(self._trim)
+        with self.lock:
+            self.usage = usage
+            self.evictions += evicted
+        return usage
+
+    def _trim(self):
+        # runs in the tpool under eventlet, so it mustn't take the lock
+        variants = []
+        total_bytes = 0
+        stale = time.time() - self.stale_after
+        for dirpath, _, filenames in os.walk(self.directory):
+            for name in filenames:
+                variant_path = os.path.join(dirpath, name)
+                try:
+                    the_stat = os.stat(variant_path)
+                    if name.startswith('.'):
+                        if the_stat.st_mtime < stale:
+                            os.remove(variant_path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                variants.append((the_stat.st_mtime_ns, variant_path,
+                                 the_stat.st_size))
+                total_bytes += the_stat.st_size
+
+        evicted = 0
+        for _, variant_path, size in sorted(variants):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(variant_path)
+            except FileNotFoundError:
+                pass
+            evicted += 1
+            total_bytes -= size
+        return total_bytes, evicted
+
+###############################################################################
+thumbnails = Thumbnails()
@@ -5,11 +5,16 @@
     Files in the process of being uploaded and copied to their destination.
 
 """
+import errno
 import os
 import shutil
 import tempfile as tf
+import threading
+import time
 from pathlib import Path
-from .paths import ShellFile
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.formparser import default_stream_factory, parse_form_data
+from .paths import ShellFile, listing_cache, hidden_names
 
 class UploadedShellFileMeta(type):
     """Metaclass for meshing of the :class:`UploadedFile` and
@@ -50,9 +55,12 @@ class UploadedFile(ShellFile, metaclass=UploadedShellFileMeta):
         if not isinstance(dir_id, str):
             temp_dir = str(dir_id)
 
-        self.temporary_dir = os.path.join(tf.gettempdir(), temp_dir)
+        self.temporary_dir = os.path.join(upload_staging.staging_root(upload_dest),
+                                          temp_dir)
         self.destination_dir = upload_dest
         self.filename = dest_filename
+        #: Seconds spent receiving the file, when streamed by :func:`receive_upload`.
+        self.receive_time = None
         self._file = None
 
     def __del__(self):
@@ -94,24 +102,324 @@ class UploadedFile(ShellFile, metaclass=UploadedShellFileMeta):
         """
         return os.path.exists(os.path.join(self.temporary_dir, self.filename))
 
+    def _make_temporary_dir(self):
+        # the staging directory only exists while something's in it
+        for _ in range(3):
+            try:
+                os.makedirs(self.temporary_dir, 0o770, exist_ok=True)
+                return
+            except FileNotFoundError:
+                # another upload just removed the emptied staging directory
+                continue
+        os.makedirs(self.temporary_dir, 0o770, exist_ok=True)
+
+    def _remove_temporary_dir(self):
+        shutil.rmtree(self.temporary_dir, ignore_errors=True)
+        upload_staging.remove_root(self.destination_dir)
+
     def create_temporary(self):
         """Creates and opens the temporary file for writing.
         """
-        if not os.path.exists(self.temporary_dir):
-            os.mkdir(self.temporary_dir, 0o774)
+        self._make_temporary_dir()
 
         if self._file is not None:
             self._file.close()
         self._file = open(os.path.join(self.temporary_dir, self.filename), 'wb')
 
+    @property
+    def received_bytes(self):
+        """How much of the temporary file has been received so far.
+
+        :returns: int
+        """
+        try:
+            return os.path.getsize(os.path.join(self.temporary_dir, self.filename))
+        except FileNotFoundError:
+            return 0
+
+    def write_chunk(self, offset, stream, buffer_size=65536, limit=None):
+        """Writes a chunk of an upload directly at ``offset`` in the temporary
+        file, reading ``stream`` a buffer at a time.
+
+        :param offset: Where in the file the chunk begins.
+        :type offset: int
+        :param stream: A file-like object with the chunk's contents.
+        :param buffer_size: How much of ``stream`` is read at once.
+        :type buffer_size: int
+        :param limit: Most bytes the chunk may hold. *None* for no limit.
+        :type limit: int
+        :raises ValueError: If ``offset`` would leave a hole in the file.
+        :raises RequestEntityTooLarge: If the chunk holds more than ``limit``.
+                                       None of it is kept.
+        :returns: int -- The number of bytes received so far.
+        """
+        if offset < 0 or offset > self.received_bytes:
+            raise ValueError('chunk at {} does not follow {}'.\
+                             format(offset, self.received_bytes))
+
+        self._make_temporary_dir()
+
+        temp_path = os.path.join(self.temporary_dir, self.filename)
+        mode = 'r+b' if os.path.exists(temp_path) else 'wb'
+        with open(temp_path, mode) as temp_file:
+            temp_file.seek(offset)
+            if limit is None:
+                shutil.copyfileobj(stream, temp_file, buffer_size)
+            else:
+                left = limit
+                while left > 0:
+                    buffer = stream.read(min(buffer_size, left))
+                    if not buffer:
+                        break
+                    temp_file.write(buffer)
+                    left -= len(buffer)
+                # stop at the limit, and drop the chunk if it went past it
+                if left == 0 and stream.read(1):
+                    temp_file.truncate(offset)
+                    raise RequestEntityTooLarge()
+
+        return self.received_bytes
+
+    def close(self):
+        """Closes the file handle, if it's open.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def discard(self):
+        """Closes & removes the temporary file.
+        """
+        self.close()
+        self._remove_temporary_dir()
+
+    @property
+    def throughput(self):
+        """Bytes per second the file was received at, when streamed by
+        :func:`receive_upload`.
+
+        :returns: float -- or *None*
+        """
+        if not self.receive_time:
+            return None
+        return self.received_bytes / self.receive_time
+
     def make_permanent(self):
         """Moves the temporary file to where it's supposed to go.
+
+        This is an atomic rename when staging is on the destination's
+        filesystem; otherwise the file is copied & synced to disk first.
         """
         if self.permanent:
             raise FileExistsError
         if not self.temporary:
             raise FileNotFoundError
 
-        shutil.move(os.path.join(self.temporary_dir, self.filename),
-                    os.path.join(self.destination_dir, self.filename))
-        shutil.rmtree(self.temporary_dir, ignore_errors=True)
+        temp_path = os.path.join(self.temporary_dir, self.filename)
+        dest_path = os.path.join(self.destination_dir, self.filename)
+        try:
+            os.rename(temp_path, dest_path)
+            upload_staging.count_rename()
+        except OSError as err:
+            if err.errno != errno.EXDEV:
+                raise
+            upload_staging.count_copy(_copy_durably(temp_path, dest_path))
+        self._remove_temporary_dir()
+        listing_cache.invalidate(self.destination_dir)
+
+def _copy_durably(src, dest):
+    # copy beside the destination, so the final step is still a rename
+    dest_dir = os.path.dirname(dest)
+    with open(src, 'rb') as src_file, \
+         tf.NamedTemporaryFile(dir=dest_dir, prefix='.flfm-', delete=False) as part:
+        try:
+            shutil.copyfileobj(src_file, part, 1048576)
+            part.flush()
+            os.fsync(part.fileno())
+        except BaseException:
+            os.remove(part.name)
+            raise
+    copied = os.path.getsize(part.name)
+    shutil.copymode(src, part.name)
+    os.rename(part.name, dest)
+    os.remove(src)
+
+    dir_fd = os.open(dest_dir, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    return copied
+
+def receive_upload(environ, dir_id, upload_dest, field_name='filepond',
+                   max_size=None):
+    """Parses a ``multipart/form-data`` request body as it arrives, writing the
+    uploaded file straight into its staging file. The body is never spooled
+    elsewhere first, so the upload touches the disk once.
+
+    :param environ: The WSGI environment of the request. Its body mustn't
+                    have been read yet.
+    :type environ: dict
+    :param dir_id: A random identifier for the temporary directory.
+    :type dir_id: int / str
+    :param upload_dest: The destination folder.
+    :type upload_dest: str
+    :param field_name: The form field holding the file.
+    :type field_name: str
+    :param max_size: Largest body accepted, in bytes. *None* for no limit.
+    :type max_size: int
+    :raises FileExistsError: The file already exists in ``upload_dest``.
+    :raises RequestEntityTooLarge: The body is larger than ``max_size``.
+    :returns: :class:`UploadedFile` -- or *None* if ``field_name`` held no file.
+    """
+    staged = []
+
+    def stream_factory(total_content_length, filename, content_type,
+                       content_length=None):
+        filename = os.path.basename(filename or '')
+        if staged or not filename:
+            return default_stream_factory(total_content_length, filename,
+                                          content_type, content_length)
+        upload_file = UploadedFile(dir_id, upload_dest, filename)
+        # refuse before receiving any of it
+        if upload_file.permanent:
+            raise FileExistsError(filename)
+        upload_file.create_temporary()
+        staged.append(upload_file)
+        return upload_file.file
+
+    start = time.perf_counter()
+    try:
+        files = parse_form_data(environ, stream_factory=stream_factory,
+                                max_content_length=max_size, silent=False)[2]
+    except BaseException:
+        for upload_file in staged:
+            upload_file.discard()
+        raise
+    elapsed = time.perf_counter() - start
+
+    if not staged:
+        return None
+    upload_file = staged[0]
+    field = files.get(field_name)
+    if field is None or field.stream is not upload_file.file:
+        upload_file.discard()
+        return None
+    upload_file.close()
+
+    # without a Content-Length, the size is only known now
+    if max_size is not None and upload_file.received_bytes > max_size:
+        upload_file.discard()
+        raise RequestEntityTooLarge()
+
+    upload_file.receive_time = elapsed
+    upload_staging.count_received(upload_file.received_bytes, elapsed)
+    return upload_file
+
+class UploadStaging:
+    """Decides where uploads are written while they're in progress, and keeps
+    count of how they were moved into place.
+
+    A relative ``UPLOAD_STAGING_DIR`` is created inside each destination
+    directory, putting it on the same filesystem, so :meth:`UploadedFile.make_permanent`
+    is a single ``rename()``. It only exists while an upload is in progress,
+    is left out of directory listings and is never served.
+
+    +-------------------------+---------------------------------------------------+
+    | Configuration Variables | Description                                       |
+    +=========================+===================================================+
+    |``UPLOAD_STAGING_DIR``   | A name relative to the destination directory, an  |
+    |                         | absolute path, or *None* for the system's temp    |
+    |                         | directory. **Default: .flfm-staging**             |
+    +-------------------------+---------------------------------------------------+
+
+    :param app: The Flask application
+    :type app: Flask
+    """
+    staging_dir = None
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        #: Uploads finished with an atomic rename.
+        self.renames = 0
+        #: Uploads that had to be copied across filesystems.
+        self.copies = 0
+        #: Bytes copied across filesystems.
+        self.bytes_copied = 0
+        #: Uploads streamed by :func:`receive_upload`.
+        self.uploads_received = 0
+        #: Bytes streamed by :func:`receive_upload`.
+        self.bytes_received = 0
+        #: Seconds spent streaming uploads.
+        self.receive_time = 0.0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.staging_dir = app.config.get('UPLOAD_STAGING_DIR', None)
+        if self.staging_dir and not os.path.isabs(self.staging_dir):
+            hidden_names.add(os.path.basename(os.path.normpath(self.staging_dir)))
+
+    def staging_root(self, upload_dest):
+        """Get the directory uploads to ``upload_dest`` are staged in. It
+        isn't created here, only once something is written to it.
+
+        Falls back to the system's temp directory when the staging directory
+        couldn't be created.
+
+        :param upload_dest: The destination directory.
+        :type upload_dest: str
+        :returns: str
+        """
+        if not self.staging_dir:
+            return tf.gettempdir()
+        if os.path.isabs(self.staging_dir):
+            return self.staging_dir
+        if not os.path.isdir(upload_dest) or \
+           not os.access(upload_dest, os.W_OK | os.X_OK):
+            return tf.gettempdir()
+        return os.path.join(upload_dest, self.staging_dir)
+
+    def remove_root(self, upload_dest):
+        """Remove the staging directory of ``upload_dest`` if nothing else is
+        being staged in it.
+
+        :param upload_dest: The destination directory.
+        :type upload_dest: str
+        """
+        if not self.staging_dir or os.path.isabs(self.staging_dir):
+            return
+        try:
+            os.rmdir(os.path.join(upload_dest, self.staging_dir))
+        except OSError:
+            pass
+
+    def count_rename(self):
+        with self.lock:
+            self.renames += 1
+
+    def count_copy(self, num_bytes):
+        with self.lock:
+            self.copies += 1
+            self.bytes_copied += num_bytes
+
+    def count_received(self, num_bytes, seconds):
+        with self.lock:
+            self.uploads_received += 1
+            self.bytes_received += num_bytes
+            self.receive_time += seconds
+
+    @property
+    def throughput(self):
+        """Average bytes per second uploads have been received at.
+
+        :returns: float -- or *None*
+        """
+        if not self.receive_time:
+            return None
+        return self.bytes_received / self.receive_time
+
+###############################################################################
+
+upload_staging = UploadStaging()
@@ -5,10 +5,16 @@
     Objects for representing Video files in FLFM.
 
 """
+import array
+import bisect
+import io
+import math
+import os
 import struct
+import sys
 from abc import ABCMeta, abstractmethod
 from pathlib import Path
-from io import FileIO, SEEK_SET, SEEK_CUR
+from io import SEEK_SET
 from .paths import ShellFile
 
 class NoMoovAtomException(Exception):
@@ -21,6 +27,118 @@ class NoReadVideoHeaderException(Exception):
     """
     pass
 
+class MP4Box:
+    """A box (or atom) of an ISO base media file, e.g. an MP4. Only its header
+    has been read.
+
+    :param box_type: The four character type, e.g. ``b'moov'``.
+    :type box_type: bytes
+    :param offset: Where the box begins in the file.
+    :type offset: int
+    :param size: The size of the whole box, header included.
+    :type size: int
+    :param header_size: *8*, or *16* when the size is a 64-bit ``largesize``.
+    :type header_size: int
+    """
+    __slots__ = ('type', 'offset', 'size', 'header_size')
+
+    def __init__(self, box_type, offset, size, header_size):
+        self.type = box_type
+        self.offset = offset
+        self.size = size
+        self.header_size = header_size
+
+    def __repr__(self):
+        return "<MP4Box {} @{} size={}>".format(self.type, self.offset, self.size)
+
+    @property
+    def payload_offset(self):
+        """Where the box's contents begin.
+        """
+        return self.offset + self.header_size
+
+    @property
+    def end(self):
+        """Where the next box begins.
+        """
+        return self.offset + self.size
+
+def iter_boxes(handle, start, end):
+    """Iterates over the boxes from ``start`` up to ``end``, reading only their
+    headers. Contents, e.g. ``mdat``, are skipped over by their size.
+
+    Iteration stops at the first box that can't be valid; a box running past
+    ``end`` is the last one.
+
+    :param handle: The file, opened in binary mode.
+    :param start: Offset of the first box.
+    :type start: int
+    :param end: Offset where the boxes end, e.g. the size of the file.
+    :type end: int
+    """
+    offset = start
+    while offset + 8 <= end:
+        handle.seek(offset, SEEK_SET)
+        header = handle.read(8)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack('>I4s', header)
+        header_size = 8
+        if size == 1:
+            largesize = handle.read(8)
+            if len(largesize) < 8:
+                return
+            size = struct.unpack('>Q', largesize)[0]
+            header_size = 16
+        elif size == 0:
+            # the box extends to the end
+            size = end - offset
+        if size < header_size:
+            return
+
+        yield MP4Box(box_type, offset, size, header_size)
+        offset += size
+
+def find_box(handle, start, end, *box_path):
+    """Find the first box along ``box_path``, descending into each one.
+
+    :param handle: The file, opened in binary mode.
+    :param start: Offset of the first box.
+    :type start: int
+    :param end: Offset where the boxes end.
+    :type end: int
+    :param box_path: The types of the boxes, outermost first, e.g.
+                     ``b'moov', b'trak', b'tkhd'``.
+    :returns: :class:`MP4Box` -- or *None* if there isn't one.
+    """
+    found = None
+    for box_type in box_path:
+        found = None
+        for box in iter_boxes(handle, start, end):
+            if box.type == box_type:
+                found = box
+                break
+        if found is None:
+            return None
+        start, end = found.payload_offset, found.end
+    return found
+
+def read_payload(handle, box, max_size=None):
+    """Read the contents of a box.
+
+    :param handle: The file, opened in binary mode.
+    :param box: The box.
+    :type box: :class:`MP4Box`
+    :param max_size: Read no more than this many bytes.
+    :type max_size: int
+    :returns: bytes
+    """
+    size = box.end - box.payload_offset
+    if max_size is not None:
+        size = min(size, max_size)
+    handle.seek(box.payload_offset, SEEK_SET)
+    return handle.read(size)
+
 class VideoFile(ShellFile, metaclass=ABCMeta):
     """Abstract Base Class for video files. Inherits from
     :class:`~flfm.shell.paths.ShellFile`.
@@ -68,27 +186,293 @@ class VideoFile(ShellFile, metaclass=ABCMeta):
         """
         pass
 
+    @property
+    @abstractmethod
+    def video_duration(self):
+        """Length of the video in seconds
+        """
+        pass
+
+    @property
+    @abstractmethod
+    def video_codec(self):
+        """The codec of the video, e.g. *avc1*
+        """
+        pass
+
     @abstractmethod
     def parse_file(self):
         """Method that is overridden by children to parse the video.
         """
         pass
 
+def _read_duration(payload):
+    # mvhd & mdhd share the layout: times are 64-bit in version 1
+    try:
+        if payload[0:1] == b'\x01':
+            timescale, duration = struct.unpack('>IQ', payload[20:32])
+            unknown = 0xffffffffffffffff
+        else:
+            timescale, duration = struct.unpack('>II', payload[12:20])
+            unknown = 0xffffffff
+    except struct.error:
+        return None
+    if timescale == 0 or duration == unknown:
+        return None
+    return duration / timescale
+
+def _read_timescale(payload):
+    # units per second of a track's times, from its mdhd
+    at = 20 if payload[0:1] == b'\x01' else 12
+    try:
+        return struct.unpack('>I', payload[at:at+4])[0] or None
+    except struct.error:
+        return None
+
+def _be_array(code, payload, offset, count, fields=1):
+    # tables are big-endian, arrays are native. Files cut short hold fewer
+    # entries than they claim, so only whole entries that are there are read
+    table = array.array(code)
+    entry_size = table.itemsize * fields
+    count = min(count, max(len(payload) - offset, 0) // entry_size)
+    table.frombytes(payload[offset:offset + count * entry_size])
+    if sys.byteorder == 'little':
+        table.byteswap()
+    return table
+
+class SeekIndex:
+    """The keyframes of a track: when each one is shown & where its data
+    begins. Both are kept in arrays, in order.
+
+    .. note::
+        The offsets are into the file the index was read from. A copy staged
+        by :class:`~flfm.viewer.staging.VideoStaging` with its ``moov`` moved
+        up front has its media further along; see
+        :func:`fast_start_plan`.
+
+    :param times: Seconds into the video.
+    :type times: array.array
+    :param offsets: Offsets into the file.
+    :type offsets: array.array
+    """
+    def __init__(self, times, offsets):
+        self.times = times
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.times)
+
+    def lookup(self, seconds):
+        """The keyframe to start from in order to show ``seconds``.
+
+        :param seconds: Seconds into the video.
+        :type seconds: float
+        :returns: tuple -- (seconds, offset) of the keyframe, or *None*.
+        """
+        if not self.times:
+            return None
+        i = max(bisect.bisect_right(self.times, seconds) - 1, 0)
+        return self.times[i], self.offsets[i]
+
+    def to_dict(self):
+        """For JSON, times in milliseconds.
+
+        :returns: dict -- *times* & *offsets*, as lists.
+        """
+        return dict({
+            'times': [int(round(t * 1000)) for t in self.times],
+            'offsets': self.offsets.tolist(),
+        })
+
+def read_seek_index(handle, stbl, timescale, min_interval=1.0):
+    """Build a :class:`SeekIndex` from a track's sample tables: ``stts`` for
+    the times, ``stss`` for the keyframes, and ``stsc``, ``stsz`` & ``stco`` or
+    ``co64`` for where their data is. Without an ``stss``, every sample is a
+    keyframe.
+
+    :param handle: The file, opened in binary mode.
+    :param stbl: The track's ``stbl`` box.
+    :type stbl: :class:`MP4Box`
+    :param timescale: Units per second of the track's times.
+    :type timescale: int
+    :param min_interval: Keyframes closer than this many seconds to the one
+                         before are left out, keeping the index small.
+    :type min_interval: float
+    :returns: :class:`SeekIndex` -- or *None* if a table is missing or
+              unreadable.
+    """
+    tables = dict()
+    for box in iter_boxes(handle, stbl.payload_offset, stbl.end):
+        if box.type in (b'stts', b'stss', b'stsc', b'stsz', b'stco', b'co64'):
+            tables[box.type] = read_payload(handle, box)
+    chunk_table = tables.get(b'stco', tables.get(b'co64'))
+    if not timescale or chunk_table is None or \
+       any(t not in tables for t in (b'stts', b'stsc', b'stsz')):
+        return None
+
+    try:
+        # decode time of each sample, run-length encoded
+        count = struct.unpack_from('>I', tables[b'stts'], 4)[0]
+        stts = _be_array('I', tables[b'stts'], 8, count, 2)
+        # sample sizes, unless they're all the same
+        sample_size, sample_count = struct.unpack_from('>II', tables[b'stsz'], 4)
+        sizes = None
+        if sample_size == 0:
+            sizes = _be_array('I', tables[b'stsz'], 12, sample_count)
+            sample_count = len(sizes)
+        count = struct.unpack_from('>I', tables[b'stsc'], 4)[0]
+        stsc = _be_array('I', tables[b'stsc'], 8, count, 3)
+        count = struct.unpack_from('>I', chunk_table, 4)[0]
+        chunks = _be_array('I' if b'stco' in tables else 'Q', chunk_table, 8, count)
+        if b'stss' in tables:
+            count = struct.unpack_from('>I', tables[b'stss'], 4)[0]
+            keyframes = _be_array('I', tables[b'stss'], 8, count)
+        else:
+            keyframes = range(1, sample_count + 1)
+    except (struct.error, ValueError):
+        return None
+    if not stsc:
+        return None
+
+    times = array.array('d')
+    offsets = array.array('Q')
+    # walk the samples once, along with each table
+    stts_at, stts_left, decode_time = 0, 0, 0
+    stsc_at, chunk, chunk_offset, left_in_chunk = 0, -1, 0, 0
+    sample = 0
+    try:
+        for keyframe in keyframes:
+            keyframe -= 1
+            if keyframe < sample or keyframe >= sample_count:
+                continue
+            while sample < keyframe or left_in_chunk == 0:
+                if left_in_chunk == 0:
+                    chunk += 1
+                    if chunk >= len(chunks):
+                        return SeekIndex(times, offsets)
+                    while stsc_at + 3 < len(stsc) and \
+                          stsc[stsc_at + 3] - 1 <= chunk:
+                        stsc_at += 3
+                    left_in_chunk = stsc[stsc_at + 1]
+                    chunk_offset = chunks[chunk]
+                    continue
+                if sample == keyframe:
+                    break
+                # step over one sample
+                while stts_left == 0 and stts_at < len(stts):
+                    stts_left, stts_at = stts[stts_at], stts_at + 2
+                decode_time += stts[stts_at - 1] if stts_at else 0
+                stts_left -= 1
+                chunk_offset += sizes[sample] if sizes is not None else sample_size
+                left_in_chunk -= 1
+                sample += 1
+
+            seconds = decode_time / timescale
+            if not times or seconds - times[-1] >= min_interval:
+                times.append(seconds)
+                offsets.append(chunk_offset)
+    except (IndexError, ValueError):
+        # tables that don't agree with each other
+        return None
+
+    return SeekIndex(times, offsets)
+
+class MP4Track:
+    """A track (``trak``) of an MP4 file.
+
+    :param handle: The file, opened in binary mode.
+    :param trak: The track's box.
+    :type trak: :class:`MP4Box`
+    """
+    def __init__(self, handle, trak):
+        #: The track's box.
+        self.box = trak
+        #: The handler type, e.g. *vide* or *soun*.
+        self.handler = None
+        self.width = 0
+        self.height = 0
+        #: Clockwise rotation in degrees, from the track's matrix.
+        self.rotation = 0
+        #: Length in seconds, from ``mdhd``.
+        self.duration = None
+        #: The fourcc of the first sample entry in ``stsd``, e.g. *avc1*.
+        self.codec = None
+        #: Units per second of the track's times, from ``mdhd``.
+        self.timescale = None
+        #: The track's sample tables, see :func:`read_seek_index`.
+        self.stbl = None
+
+        tkhd = find_box(handle, trak.payload_offset, trak.end, b'tkhd')
+        if tkhd is not None:
+            self._read_tkhd(read_payload(handle, tkhd, 96))
+
+        mdia = find_box(handle, trak.payload_offset, trak.end, b'mdia')
+        if mdia is None:
+            return
+        for box in iter_boxes(handle, mdia.payload_offset, mdia.end):
+            if box.type == b'hdlr':
+                handler = read_payload(handle, box, 12)[8:12]
+                self.handler = handler.decode('latin-1') if len(handler) == 4 else None
+            elif box.type == b'mdhd':
+                mdhd = read_payload(handle, box, 32)
+                self.duration = _read_duration(mdhd)
+                self.timescale = _read_timescale(mdhd)
+
+        self.stbl = find_box(handle, mdia.payload_offset, mdia.end,
+                             b'minf', b'stbl')
+        if self.stbl is None:
+            return
+        stsd = find_box(handle, self.stbl.payload_offset, self.stbl.end, b'stsd')
+        if stsd is not None:
+            codec = read_payload(handle, stsd, 16)[12:16]
+            if len(codec) == 4:
+                self.codec = codec.decode('latin-1')
+
+    def __repr__(self):
+        return "<MP4Track {} {} {}x{}>".format(self.handler, self.codec,
+                                               self.width, self.height)
+
+    def _read_tkhd(self, track_head):
+        # the matrix follows 64-bit times in v1
+        matrix_at = 52 if track_head[0:1] == b'\x01' else 40
+        if len(track_head) < matrix_at + 44:
+            return
+        a, b = struct.unpack('>ii', track_head[matrix_at:matrix_at+8])
+        self.rotation = int(round(math.degrees(math.atan2(b, a)))) % 360
+        # width & height follow the matrix, both are 16.16 fixed point
+        w, h = struct.unpack('>II', track_head[matrix_at+36:matrix_at+44])
+        self.width = w >> 16
+        self.height = h >> 16
+
 class MP4File(VideoFile):
     """Videos that are within an MP4 container. See :class:`VideoFile`.
+
+    The container is parsed as a tree of boxes: only box headers & the few
+    small boxes needed are read, ``mdat`` is skipped over by its size and
+    ``moov`` may come before or after it. The video's properties come from
+    its video track, found by handler type, rather than the first track.
     """
+    #: Size of the read buffer. Box headers near each other share a read.
+    buffer_size = 65536
+
     def __init__(self, path_to_file):
         super().__init__(path_to_file)
 
         self._width = -1
         self._height = -1
+        self._duration = None
+        self._bitrate = None
+        self._seek_index = None
         self._parsed_header = False
+        #: The :class:`MP4Track`'s, once parsed.
+        self.tracks = []
+        #: The video :class:`MP4Track`, or the first track if there isn't one.
+        self.video_track = None
 
-        #: The **ftyp____** that are supported.
-        self.supported_ftypes = (b'ftypmp42', b'ftypisom')
-        #: The **compat_brands** that are supported.
-        self.supported_brands = (b'isommp42', b'isomiso2avc1mp41',
-                                 b'isomisoavc1', b'isomavc1mp42')
+    def _parsed(self):
+        if not self._parsed_header:
+            self.parse_file()
+        return self
 
     @property
     def video_format(self):
@@ -96,71 +480,68 @@ class MP4File(VideoFile):
 
     @property
     def video_width(self):
-        if self._parsed_header:
-            return self._width
-        self.parse_file()
-        return self._width
+        return self._parsed()._width
 
     @property
     def video_height(self):
-        if self._parsed_header:
-            return self._height
-        self.parse_file()
-        return self._height
+        return self._parsed()._height
 
     @property
     def video_wxh(self):
-        if self._parsed_header:
-            return self._width, self._height
-        self.parse_file()
+        self._parsed()
         return self._width, self._height
 
-    def _read_moov_size(self, fio_handle, start_at):
-        cur_offset = fio_handle.tell()
-        fio_handle.seek(start_at, SEEK_SET)
-        moov_atom = fio_handle.read(8)
-        # fetch a tuple of (Atom Size, Atom Name)
-        moov_atom = struct.unpack('>I4s', moov_atom)
-
-        fio_handle.seek(cur_offset, SEEK_SET)
-
-        if moov_atom[1] != b'moov':
-            raise NoMoovAtomException
-        return moov_atom[0]
-
-    def _read_mp4_container(self, fio_handle, compat_brand_end):
-        track_head = b''
-        alignment_corrected = False
-        # Find our search limit from the moov atom's size
-        total_bytes = self._read_moov_size(fio_handle, compat_brand_end)
-        bytes_read = 0
-        # Search for MP4 track header
-        while bytes_read < total_bytes:
-            buffer = fio_handle.read(4)
-            # Check for & correct misalignment
-            if not alignment_corrected and \
-            struct.pack('>L', struct.unpack('>L', buffer)[0]<<8&0xffffffff) == b'tkh\x00':
-                fio_handle.seek(-4, SEEK_CUR)
-                fio_handle.seek(1, SEEK_CUR)
-                alignment_corrected = True
-            # Found the track_head, extract information
-            if buffer == b'tkhd':
-                fio_handle.seek(-8, SEEK_CUR)
-                tkhd_size = fio_handle.read(4)
-                tkhd_size = struct.unpack('>I', tkhd_size)[0]
-                fio_handle.seek(-4, SEEK_CUR)
-                track_head = fio_handle.read(tkhd_size)
-                break
-            bytes_read += 4
+    @property
+    def video_duration(self):
+        return self._parsed()._duration
+
+    @property
+    def video_codec(self):
+        self._parsed()
+        return self.video_track.codec if self.video_track is not None else None
+
+    @property
+    def video_bitrate(self):
+        """Estimated bits per second: the size of the media data over the
+        duration.
+        """
+        return self._parsed()._bitrate
+
+    @property
+    def video_rotation(self):
+        """Clockwise rotation in degrees the video should be displayed with.
+        """
+        self._parsed()
+        return self.video_track.rotation if self.video_track is not None else 0
+
+    @property
+    def seek_index(self):
+        """The :class:`SeekIndex` of the video track, read from its sample
+        tables the first time it's asked for. *None* if it can't be read.
+        """
+        track = self._parsed().video_track
+        if self._seek_index is None and track is not None and \
+           track.stbl is not None:
+            with open(self.path, 'rb', buffering=self.buffer_size) as the_file:
+                self._seek_index = read_seek_index(the_file, track.stbl,
+                                                   track.timescale)
+        return self._seek_index
+
+    def _read_moov(self, handle, moov):
+        for box in iter_boxes(handle, moov.payload_offset, moov.end):
+            if box.type == b'mvhd':
+                self._duration = _read_duration(read_payload(handle, box, 32))
+            elif box.type == b'trak':
+                self.tracks.append(MP4Track(handle, box))
 
-        if track_head == b'':
+        if not self.tracks:
             raise NoReadVideoHeaderException
-        # We now have the track header for the video file
-        # Time to get important information like the width & height...
-        # W & H = offset 0x52-0x5A ~ 82 & 90
-        w, h = struct.unpack('>II', track_head[82:90])
-        self._width = w
-        self._height = h
+        video_tracks = [t for t in self.tracks if t.handler == 'vide']
+        self.video_track = video_tracks[0] if video_tracks else self.tracks[0]
+        self._width = self.video_track.width
+        self._height = self.video_track.height
+        if self._duration is None:
+            self._duration = self.video_track.duration
 
     def parse_file(self):
         """Parses the video file, obtaining metadata that can be accessed thru
@@ -168,45 +549,155 @@ class MP4File(VideoFile):
 
         :raises ValueError: File is not an MP4 format video.
         """
-        the_file = FileIO(self.path, 'rb')
-
-        # the mimetype could be incorrect
-        # we'll let the file decide
-        if not self.video_format in self.mimetype:
-            the_file.seek(0x00, SEEK_SET)
-            first_12 = the_file.read(12)
-            # split the dword and the ftyp
-            size_dword = struct.unpack('>I', first_12[0:4])[0]
-            ftyp_val = first_12[4:]
-            # validate if mp4
-            if size_dword > 0:
-                if ftyp_val not in self.supported_ftypes:
-                    the_file.close()
+        with open(self.path, 'rb', buffering=self.buffer_size) as the_file:
+            file_end = os.fstat(the_file.fileno()).st_size
+            top_level = list(iter_boxes(the_file, 0, file_end))
+
+            # the mimetype could be incorrect
+            # we'll let the file decide
+            if not self.video_format in self.mimetype:
+                if not top_level or top_level[0].type != b'ftyp':
                     raise ValueError("{} is not an MP4 video.".format(self.name))
-            else:
-                the_file.close()
-                raise ValueError("{} is not an MP4 video.".format(self.name))
-
-        # determine the size of the `compatible_brand` field
-        # this is the very first DWORD of the file
-        the_file.seek(0x00, SEEK_SET)
-        compat_brand_end = the_file.read(4)
-        compat_brand_end = struct.unpack('>I', compat_brand_end)[0]
-        compat_brand_size = compat_brand_end - 0x10
-        # get the `compatible_brand` field
-        the_file.seek(0x10, SEEK_SET)
-        compat_brand = the_file.read(compat_brand_size)
-
-        # PARSE THE FILE!!!
-        try:
-            if compat_brand in self.supported_brands:
-                self._read_mp4_container(the_file, compat_brand_end)
-        except NoMoovAtomException:
-            #TODO: ADD LOGGING
-            #FIXME: MAKE THIS INTO A LOGGER
-            print("WARNING: {} has no moov atom!".format(self.name))
-        except NoReadVideoHeaderException:
-            print("WARNING: Couldn't get information from {}!".format(self.name))
-
-        the_file.close()
+
+            # PARSE THE FILE!!!
+            try:
+                moov = next((b for b in top_level if b.type == b'moov'), None)
+                if moov is None:
+                    raise NoMoovAtomException
+                self._read_moov(the_file, moov)
+            except NoMoovAtomException:
+                #TODO: ADD LOGGING
+                #FIXME: MAKE THIS INTO A LOGGER
+                print("WARNING: {} has no moov atom!".format(self.name))
+            except NoReadVideoHeaderException:
+                print("WARNING: Couldn't get information from {}!".format(self.name))
+
+        media_bytes = sum(b.end - b.payload_offset for b in top_level
+                          if b.type == b'mdat')
+        if self._duration:
+            self._bitrate = int((media_bytes or file_end) * 8 / self._duration)
         self._parsed_header = True
+
+#: Boxes that lead from ``moov`` down to the chunk offset tables.
+CHUNK_OFFSET_PATH = frozenset([b'moov', b'trak', b'mdia', b'minf', b'stbl'])
+
+def make_box(box_type, payload=b'', largesize=False):
+    """Create a box around ``payload``, using a ``largesize`` only if needed.
+
+    :param box_type: The four character type, e.g. ``b'moov'``.
+    :type box_type: bytes
+    :param payload: The contents of the box.
+    :type payload: bytes
+    :param largesize: Use a ``largesize`` even if it isn't needed.
+    :type largesize: bool
+    :returns: bytes
+    """
+    if largesize or len(payload) + 8 > 0xffffffff:
+        return struct.pack('>I4sQ', 1, box_type, len(payload) + 16) + payload
+    return struct.pack('>I4s', len(payload) + 8, box_type) + payload
+
+def relocate_chunks(box_type, payload, relocate):
+    """Rebuild a box, passing every chunk offset in its ``stco`` & ``co64``
+    tables thru ``relocate``. ``stco`` tables whose offsets no longer fit in
+    32 bits become ``co64`` tables.
+
+    :param box_type: The type of the box, e.g. ``b'moov'``.
+    :type box_type: bytes
+    :param payload: The contents of the box.
+    :type payload: bytes
+    :param relocate: Maps an old offset to its new one.
+    :type relocate: callable
+    :returns: bytes -- The whole box.
+    """
+    if box_type in CHUNK_OFFSET_PATH:
+        handle = io.BytesIO(payload)
+        children = [(b.type, read_payload(handle, b)) for b in
+                    iter_boxes(handle, 0, len(payload))]
+        return make_box(box_type, b''.join(
+            relocate_chunks(t, p, relocate) for t, p in children
+        ))
+
+    if box_type in (b'stco', b'co64'):
+        count = struct.unpack_from('>I', payload, 4)[0]
+        code = 'I' if box_type == b'stco' else 'Q'
+        offsets = [relocate(o) for o in struct.unpack_from(
+            '>{}{}'.format(count, code), payload, 8
+        )]
+        if offsets and max(offsets) > 0xffffffff:
+            box_type, code = b'co64', 'Q'
+        return make_box(box_type, payload[0:8] +
+                        struct.pack('>{}{}'.format(count, code), *offsets))
+
+    return make_box(box_type, payload)
+
+def needs_fast_start(path):
+    """Whether an MP4's media comes before its ``moov``. Only the headers of
+    the top-level boxes up to the first ``moov`` or ``mdat`` are read.
+
+    :param path: The path of the video.
+    :type path: str
+    :returns: bool
+    """
+    with open(path, 'rb') as handle:
+        file_end = os.fstat(handle.fileno()).st_size
+        for i, box in enumerate(iter_boxes(handle, 0, file_end)):
+            if i == 0 and box.type != b'ftyp':
+                return False
+            if box.type in (b'moov', b'mdat'):
+                return box.type == b'mdat'
+    return False
+
+def fast_start_plan(path):
+    """Plan a copy of an MP4 with its ``moov`` moved in front of the media, so
+    players can begin before fetching the end of the file.
+
+    :param path: The path of the video.
+    :type path: str
+    :returns: list -- The copy, piece by piece: *bytes* to write, or
+              *(offset, length)* ranges of ``path`` to copy. *None* if the
+              ``moov`` is already in front or the video can't be remuxed.
+    """
+    with open(path, 'rb', buffering=65536) as handle:
+        file_end = os.fstat(handle.fileno()).st_size
+        top_level = list(iter_boxes(handle, 0, file_end))
+        types = [b.type for b in top_level]
+        if not types or types[0] != b'ftyp' or b'moof' in types or \
+           types.count(b'moov') != 1 or b'mdat' not in types or \
+           types.index(b'moov') < types.index(b'mdat'):
+            return None
+        # boxes must cover the whole file, or something would go missing
+        if top_level[-1].end != file_end:
+            return None
+
+        moov = top_level[types.index(b'moov')]
+        moov_payload = read_payload(handle, moov)
+
+    first_mdat = types.index(b'mdat')
+    order = top_level[0:first_mdat]
+    order += [b for b in top_level[first_mdat:] if b.type != b'moov']
+
+    new_moov = None
+    moov_size = moov.size
+    while new_moov is None or len(new_moov) != moov_size:
+        if new_moov is not None:
+            # an stco grew into a co64, so everything moves a bit more
+            moov_size = len(new_moov)
+        moved = dict()
+        new_offset = 0
+        for i, box in enumerate(order):
+            if i == first_mdat:
+                new_offset += moov_size
+            moved[box.offset] = new_offset
+            new_offset += box.size
+        starts = sorted(moved)
+
+        def relocate(offset):
+            i = bisect.bisect_right(starts, offset) - 1
+            return offset - starts[i] + moved[starts[i]]
+
+        new_moov = relocate_chunks(b'moov', moov_payload, relocate)
+
+    pieces = [(b.offset, b.size) for b in order[0:first_mdat]]
+    pieces.append(new_moov)
+    pieces += [(b.offset, b.size) for b in order[first_mdat:]]
+    return pieces
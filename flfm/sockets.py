@@ -1,28 +1,54 @@
-import os
 import json
-import shutil
-from flask import current_app, url_for
+from flask import current_app, request, url_for
 from flask_socketio import emit, disconnect
 from . import socketio
+from .viewer.staging import video_staging
+
+def _emit_progress(job):
+    for client in list(job.clients):
+        socketio.emit('video progress', json.dumps(dict({
+            'copied': job.copied,
+            'total': job.total,
+        })), room=client)
+
+def _stage_in_background(job, video_url):
+    copied = video_staging.run(job, _emit_progress)
+    for client in list(job.clients):
+        if copied:
+            socketio.emit('video ready', json.dumps(dict({
+                'video_url': video_url,
+            })), room=client)
+        elif not job.cancelled:
+            socketio.emit('video failed', json.dumps(dict({
+                'error': str(job.error),
+            })), room=client)
 
 @socketio.on('prepare video')
 def prepare_video(data):
-    vid_dir = current_app.config['VIEWER_VIDEO_DIRECTORY']
-    stream_video = os.path.join(vid_dir, data['data']['filename'])
     source_video = data['data']['shell_location']
 
-    if not os.path.exists(stream_video):
-        try:
-            os.symlink(source_video, stream_video)
-        except (OSError, NotImplementedError, AttributeError):
-            shutil.copyfile(source_video, stream_video)
-
-    video_url = url_for('static', filename=data['data']['filename'],
+    # copies happen in the background, the client hears about their progress
+    try:
+        filename, job, is_new = video_staging.stage(source_video, request.sid)
+    except OSError as err:
+        emit('video failed', json.dumps(dict({
+            'error': str(err),
+        })))
+        return
+    video_url = url_for('static', filename=filename,
                         _external=True).replace('static', 'videos')
+    if job is None:
+        if is_new:
+            socketio.start_background_task(video_staging.trim)
+        emit('video ready', json.dumps(dict({
+            'video_url': video_url,
+        })))
+    elif is_new:
+        socketio.start_background_task(_stage_in_background, job, video_url)
 
-    emit('video ready', json.dumps(dict({
-        'video_url': video_url,
-    })))
+@socketio.on('disconnect')
+def stop_preparing():
+    video_staging.cancel(request.sid)
 
 @socketio.on('received video')
 def received_video():
@@ -1,4 +1,4 @@
-(function ($, _flfm_root, _uploads_allowed, _upload_where) {
+(function ($, _flfm_root, _uploads_allowed, _upload_where, _chunk_size) {
     /* Code unrelated to uploads goes here */
     /* All functionality should go in here */
     function shell_user_interface($, _flfm_root, _uploads_allowed, _upload_where) {
@@ -219,6 +219,8 @@
             allowPaste: false,
             allowReplace: false,
             allowRevert: false,
+            chunkUploads: true,
+            chunkSize: _chunk_size,
             server: {
                 url: `${wl.protocol}//${wl.host}`,
                 process: {
@@ -228,6 +230,12 @@
                         'X-Uploadto': _upload_where
                     },
                 },
+                patch: {
+                    url: make_url(null, _flfm_root, '/patch/'),
+                    headers: {
+                        'X-Uploadto': _upload_where
+                    },
+                },
             },
             onprocessfile: function(err,file) {
                 if (!err) {
@@ -284,4 +292,4 @@
     });
 
     return shell_user_interface($, _flfm_root, _uploads_allowed, _upload_where);
-}(jQuery, flfm_root, uploads_allowed, upload_where));
+}(jQuery, flfm_root, uploads_allowed, upload_where, upload_chunk_size));
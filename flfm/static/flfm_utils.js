@@ -24,6 +24,15 @@ function serve_params(serve_url, the_file) {
     return `${serve_url}?f=${the_file}&dl=1`;
 }
 
+function thumb_params(thumb_url, the_file, width) {
+    return `${thumb_url}?f=${the_file}&w=${width}`;
+}
+
+function screen_width() {
+    var sw = window.parent.parent.screen.width;
+    return Math.round(sw * (window.devicePixelRatio || 1));
+}
+
 function viewer_params(viewer_url, file, mimetype) {
     return `${viewer_url}?f=${file}&mt=${mimetype}`;
 }
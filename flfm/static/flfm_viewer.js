@@ -1,4 +1,4 @@
-(function ($, _viewer_type, _viewer_srv_cache, _flfm_root, _viewer_current_file, _current_dir, _serve_url, _image_url) {
+(function ($, _viewer_type, _viewer_srv_cache, _flfm_root, _viewer_current_file, _current_dir, _serve_url, _image_url, _thumb_url) {
     resize_location_bar("#location-bar", "#commands");
 
     let media_list = new Promise(function(resolve, reject) {
@@ -37,7 +37,7 @@
                     _viewer_current_file = current[0].next;
                 }
                 let wl = window.location;
-                var new_url = serve_params(make_url(`${wl.protocol}//${wl.host}`, _flfm_root, _serve_url), _viewer_current_file);
+                var new_url = thumb_params(make_url(`${wl.protocol}//${wl.host}`, _flfm_root, _thumb_url), _viewer_current_file, screen_width());
                 $("img.viewer-image").cacheImages({url: new_url});
                 $(document).trigger("slideshowEvent");
             });
@@ -62,11 +62,9 @@
         }
         else if (t === 'image') {
             if (!c) {
-                var img_url = _image_url;
-                img_url = img_url.trim();
-                img_url = img_url.replace(/&\w+;/, '&');
+                /* a screen-sized variant, not the original */
                 let wl = window.location;
-                var full_url = make_url(`${wl.protocol}//${wl.host}`, _flfm_root, img_url);
+                var full_url = thumb_params(make_url(`${wl.protocol}//${wl.host}`, _flfm_root, _thumb_url), _viewer_current_file, screen_width());
                 $("img.viewer-image").cacheImages({url: full_url});
             }
 
@@ -82,7 +80,7 @@
                     if (current[0].prev != null) {
                         _viewer_current_file = current[0].prev;
                         let wl = window.location;
-                        var new_url = serve_params(make_url(`${wl.protocol}//${wl.host}`, _flfm_root, _serve_url), _viewer_current_file);
+                        var new_url = thumb_params(make_url(`${wl.protocol}//${wl.host}`, _flfm_root, _thumb_url), _viewer_current_file, screen_width());
                         $("img.viewer-image").cacheImages({url: new_url});
                     }
                 });
@@ -93,7 +91,7 @@
                     if (current[0].next != null) {
                         _viewer_current_file = current[0].next;
                         let wl = window.location;
-                        var new_url = serve_params(make_url(`${wl.protocol}//${wl.host}`, _flfm_root, _serve_url), _viewer_current_file);
+                        var new_url = thumb_params(make_url(`${wl.protocol}//${wl.host}`, _flfm_root, _thumb_url), _viewer_current_file, screen_width());
                         $("img.viewer-image").cacheImages({url: new_url});
                     }
                 });
@@ -160,7 +158,17 @@
                     });
                 });
             });
+            socket.on("video progress", function(d) {
+                var progress = JSON.parse(d);
+                var percent = Math.floor(100 * progress.copied / Math.max(progress.total, 1));
+                $(".viewer-video-controls p").text(`${percent}%`);
+            });
+            socket.on("video failed", function(d) {
+                $(".viewer-video-controls p").text('Failed to prepare the video.');
+                socket.close();
+            });
             socket.on("video ready", function(d) {
+                $(".viewer-video-controls p").html('&nbsp;');
                 var source_string = JSON.parse(d).video_url;
                 vid.src(source_string.concat('?start=0'));
                 socket.emit('received_video');
@@ -200,4 +208,4 @@
             });
         }
     })(_viewer_type, _viewer_srv_cache);
-}(jQuery, viewer_type, viewer_srv_cache, flfm_root, viewer_current_file, current_dir, serve_url, image_url));
+}(jQuery, viewer_type, viewer_srv_cache, flfm_root, viewer_current_file, current_dir, serve_url, image_url, thumb_url));
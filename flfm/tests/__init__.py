@@ -1,6 +1,10 @@
 from .test_accounts import AccountsTesting
 from .test_media import MediaTest
-from .test_rules import RulesTest, VirtualRulesTest
+from .test_paths import ShellPathTest
+from .test_rules import (
+    RulesTest, VirtualRulesTest, RuleTrieTest, RulesRegistryTest
+)
+from .test_serving import ServingTest
 from .test_sockets import SocketsWorkingTest
 from .test_uploads import UploadsTest
 from .test_video import VideoFormatTests
@@ -12,6 +12,7 @@ class TestConfig(Config):
     BYPASS_DOTENV = True
     TESTING = True
     PROPAGATE_EXCEPTIONS = True
+    MEDIA_INDEX_FILE = None
     DB_SCHEMA = 'mysql'
     DB_USERNAME = 'flfm_user'
     DB_PASSWORD = 'drowssap'
@@ -1,13 +1,19 @@
 import os
+import pathlib
+import shutil
+import tempfile
 from flask import current_app, url_for
 from flask_testing import TestCase
 from flfm import create_app
-from flfm.shell.paths import ShellDirectory
+from flfm.shell.filetypes import type_detector
+from flfm.shell.media import media_index
+from flfm.shell.paths import ShellDirectory, ShellFile, ShellPath
 from .config import Config
 
 class TestConfig(Config):
     TESTING = True
     PROPAGATE_EXCEPTIONS = True
+    MEDIA_INDEX_FILE = None
 
 class MediaTest(TestConfig, TestCase):
     def __init__(self, *args, **kwargs):
@@ -159,3 +165,135 @@ class MediaTest(TestConfig, TestCase):
         response = self.client.post(url, data=dict(directory=root_dir,
                                                    file=malformed_file_name))
         self.assert400(response)
+
+    def test_media_index(self):
+        current_app.config['RULES_FILE'] = self.sample_rules
+        root_dir = self.samples_dir
+        video = 'test_mp4_file2.mp4'
+
+        index_fd, index_file = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(index_fd)
+        media_index.index_file = index_file
+        media_index.finish_setup()
+        # nothing's opened until it's used
+        self.assertIsNone(media_index.connection)
+
+        print("\n\nTEST MEDIAINFO INDEX:\n")
+        try:
+            url = url_for('shell.mediainfo')
+            misses, hits = media_index.misses, media_index.hits
+            response = self.client.post(url, data=dict(directory=root_dir,
+                                                       file=video))
+            self.assert200(response)
+            r_data = response.get_json(False, True, False)
+            self.assertEqual(r_data['filename'], video)
+            self.assertEqual(r_data['format'], 'mp4')
+            self.assertEqual((r_data['width'], r_data['height']), (1920, 1080))
+            self.assertEqual(r_data['codec'], 'avc1')
+            self.assertEqual(r_data['rotation'], 90)
+            self.assertEqual(r_data['seek_index']['offsets'], [1063])
+            self.assertEqual(media_index.misses, misses + 1)
+
+            # the second time, it comes from the index
+            response = self.client.post(url, data=dict(directory=root_dir,
+                                                       file=video))
+            self.assertEqual(response.get_json(False, True, False), r_data)
+            self.assertEqual(media_index.misses, misses + 1)
+            self.assertEqual(media_index.hits, hits + 1)
+
+            url = url_for('shell.mediainfo_directory')
+            response = self.client.post(url, data=dict(directory=root_dir))
+            self.assert200(response)
+            r_data = response.get_json(False, True, False)
+            self.assertEqual(list(r_data), [video])
+            self.assertEqual(r_data[video]['width'], 1920)
+            # only asked for one video at a time
+            self.assertNotIn('seek_index', r_data[video])
+            self.assertEqual(media_index.hits, hits + 2)
+
+            # a forked worker opens a connection of its own
+            connection = media_index.connection
+            media_index._pid = -1
+            response = self.client.post(url, data=dict(directory=root_dir))
+            self.assertEqual(media_index.hits, hits + 3)
+            self.assertIsNot(media_index.connection, connection)
+            connection.close()
+
+            response = self.client.post(url, data=dict(directory=self.disallow_dir))
+            self.assert403(response)
+
+            # rewritten in place, even when the ShellFile's stat is older
+            where = tempfile.mkdtemp(prefix='flfm-media-')
+            try:
+                copied = os.path.join(where, video)
+                shutil.copy(os.path.join(root_dir, video), copied)
+                listed = ShellFile(pathlib.Path(copied), os.stat(copied))
+                misses = media_index.misses
+                media_index.get_info(listed)
+                self.assertEqual(media_index.misses, misses + 1)
+                with open(copied, 'ab') as f:
+                    f.write(bytes(8))
+                media_index.get_info(listed)
+                self.assertEqual(media_index.misses, misses + 2)
+            finally:
+                shutil.rmtree(where)
+        finally:
+            media_index.index_file = None
+            media_index.finish_setup()
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(index_file + suffix):
+                    os.remove(index_file + suffix)
+
+    def test_media_types(self):
+        print("\n\nTEST FILE TYPE DETECTION:\n")
+        where = tempfile.mkdtemp(prefix='flfm-types-')
+        png_header = b'\x89PNG\r\n\x1a\n' + bytes(32)
+        contents = {
+            'picture.png': png_header,
+            # the extension wins, the contents aren't read
+            'liar.txt': png_header,
+            'no_extension': png_header,
+            'unknown.bin': b'nothing to see here',
+        }
+        try:
+            for name, data in contents.items():
+                with open(os.path.join(where, name), 'wb') as f:
+                    f.write(data)
+
+            type_detector.finish_setup()
+            the_files = sorted(ShellPath(where).files, key=lambda f: f.name)
+            self.assertEqual(type_detector.classify(the_files),
+                             ['text/plain', 'image/png',
+                              'image/png', 'application/octet-stream'])
+            # only the ambiguous two were sniffed
+            self.assertEqual(len(type_detector.cache), 2)
+            self.assertEqual(type_detector.mimetype(the_files[1]), 'image/png')
+            self.assertEqual(len(type_detector.cache), 2)
+
+            # ShellFile asks the detector once, then remembers
+            sniffs, hits = type_detector.sniffs, type_detector.extension_hits
+            sniff_hits = type_detector.sniff_hits
+            self.assertEqual(the_files[2].mimetype, 'image/png')
+            self.assertTrue(the_files[2].is_mimetype_family('image'))
+            self.assertFalse(the_files[3].is_mimetype_family('image'))
+            self.assertEqual(type_detector.extension_hits, hits + 1)
+            self.assertEqual(type_detector.sniffs, sniffs)
+            self.assertEqual(type_detector.sniff_hits, sniff_hits + 1)
+
+            # changed files get sniffed again
+            with open(os.path.join(where, 'no_extension'), 'wb') as f:
+                f.write(b'GIF89a' + bytes(64))
+            the_files = sorted(ShellPath(where).files, key=lambda f: f.name)
+            self.assertEqual(type_detector.mimetype(the_files[1]), 'image/gif')
+
+            current_app.config['RULES_FILE'] = self.sample_rules
+            response = self.client.post(url_for('shell.medialist'),
+                                        data=dict(directory=self.faketree_dir,
+                                                  whatkind='text'))
+            self.assert200(response)
+            r_data = response.get_json(False, True, False)
+            self.assertEqual(len(r_data), 1)
+        finally:
+            for name in contents:
+                os.remove(os.path.join(where, name))
+            os.rmdir(where)
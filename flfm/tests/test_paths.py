@@ -0,0 +1,155 @@
+import os
+import pathlib
+import shutil
+import tempfile
+from flask import current_app, url_for
+from flask_testing import TestCase
+from flfm import create_app
+from flfm.shell.paths import (
+    ShellPath, ShellFile, ShellDirectory, ListingCache, ListingPage,
+    create_proper_shellitem, listing_cache
+)
+from .config import Config
+
+class TestConfig(Config):
+    TESTING = True
+    PROPAGATE_EXCEPTIONS = True
+    MEDIA_INDEX_FILE = None
+
+class ShellPathTest(TestConfig, TestCase):
+    def __init__(self, *args, **kwargs):
+        super(ShellPathTest, self).__init__(*args, **kwargs)
+
+        our_path = os.path.abspath(os.path.dirname(__file__))
+        self.faketree = os.path.join(
+            our_path,
+            'faketree'
+        )
+        self.faketree_dir = ShellDirectory.from_str_loc(self.faketree).path
+
+    def create_app(self):
+        return create_app(self)
+
+    def test_scandir_listing(self):
+        print("\n\nTEST SHELLPATH LISTING")
+        shell_path = ShellPath(self.faketree_dir)
+
+        on_fs = list(pathlib.Path(self.faketree_dir).iterdir())
+        fs_files = sorted(p.name for p in on_fs if p.is_file())
+        fs_dirs = sorted(p.name for p in on_fs if p.is_dir())
+
+        self.assertEqual(sorted(f.name for f in shell_path.files), fs_files)
+        self.assertEqual(sorted(d.name for d in shell_path.directories), fs_dirs)
+        self.assertEqual(shell_path.children,
+                         shell_path.directories + shell_path.files)
+        self.assertTrue(shell_path.has_files)
+        self.assertTrue(shell_path.has_subdirectories)
+
+        # Same attributes as when created one at a time
+        for child in shell_path.children:
+            single = create_proper_shellitem(child.path)
+            self.assertEqual(type(child), type(single))
+            self.assertEqual(child.name, single.name)
+            self.assertEqual(child.path, single.path)
+            self.assertEqual(child.uri_path, single.uri_path)
+            self.assertEqual(child.size, single.size)
+            self.assertEqual(child.parent_directory(), self.faketree_dir)
+
+        self.assertTrue(all(isinstance(f, ShellFile) for f in shell_path.files))
+
+    def test_missing_directory(self):
+        shell_path = ShellPath(self.faketree_dir + '/not_here')
+
+        self.assertEqual(shell_path.children, [])
+        self.assertFalse(shell_path.has_files)
+        self.assertFalse(shell_path.has_subdirectories)
+
+    def test_listing_cache(self):
+        print("\n\nTEST LISTING CACHE")
+        cache = ListingCache(self.app)
+        where = tempfile.mkdtemp(prefix='flfm-listing-')
+
+        try:
+            first = cache.get_listing(where)
+            second = cache.get_listing(where)
+            self.assertIs(first, second)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            # the directory changes, its mtime/inode no longer match
+            with open(os.path.join(where, 'listing_cache.txt'), 'w') as f:
+                f.write('hello')
+            os.utime(where, ns=(0, 0))
+            third = cache.get_listing(where)
+            self.assertIsNot(third, second)
+            self.assertIn('listing_cache.txt', [f.name for f in third[1]])
+
+            # explicit invalidation forces a rescan
+            cache.invalidate(where + '/')
+            self.assertIsNot(cache.get_listing(where), third)
+            self.assertEqual(cache.misses, 3)
+        finally:
+            shutil.rmtree(where)
+
+        # the shared listing still produces per-request ShellPaths
+        self.assertEqual(ShellPath.cached(self.faketree_dir).str_path,
+                         self.faketree_dir)
+
+    def test_listing_page(self):
+        print("\n\nTEST PAGINATED LISTING")
+        subdir1 = self.faketree_dir + '/subdir1'
+        by_name = [item.name for item in ListingPage(subdir1)]
+        self.assertEqual(by_name, ['File1.txt', 'File2.txt', 'File3.txt'])
+
+        page = ListingPage(subdir1, 1, 1, 'name', True)
+        self.assertEqual(page.total, 3)
+        self.assertEqual([item.name for item in page], ['File2.txt'])
+
+        # directories always come first
+        shell_path = ShellPath.paginated(self.faketree_dir, 0, 2, 'size')
+        self.assertEqual(shell_path.total, 3)
+        self.assertEqual(len(shell_path.children), 2)
+        self.assertTrue(all(c.directory for c in shell_path.children))
+
+        with self.assertRaises(ValueError):
+            ListingPage(subdir1, sort_by='color')
+
+        # paging thru a directory scans it once
+        misses = listing_cache.misses
+        listing_cache.invalidate(subdir1)
+        for offset in range(3):
+            self.assertEqual(len(ListingPage(subdir1, offset, 1)), 1)
+        self.assertEqual(listing_cache.misses, misses + 1)
+
+    def test_listing_route(self):
+        print("\n\nTEST LISTING ROUTE")
+        rules_file = os.path.join(os.path.dirname(self.faketree), 'samples',
+                                  'sample_rules')
+        with open(rules_file, 'w') as f:
+            f.write('Allowed={}'.format(self.faketree_dir))
+        current_app.config['RULES_FILE'] = rules_file
+
+        try:
+            url = url_for('shell.listing')
+            response = self.client.get(url, query_string=dict(
+                d=self.faketree_dir + '/subdir1', offset=1, limit=5,
+                sort='name', order='desc'))
+            self.assert200(response)
+            r_data = response.get_json(False, True, False)
+            self.assertEqual(r_data['total'], 3)
+            self.assertEqual([e['name'] for e in r_data['entries']],
+                             ['File2.txt', 'File1.txt'])
+
+            response = self.client.get(url, query_string=dict(
+                d=self.faketree_dir, sort='color'))
+            self.assert400(response)
+
+            response = self.client.get(url, query_string=dict(d='/var'))
+            self.assert403(response)
+
+            response = self.client.get(url_for('shell.shell_view',
+                                               view_path=self.faketree_dir.lstrip('/')),
+                                       query_string=dict(sort='size', page=1))
+            self.assert200(response)
+            self.assertEqual(self.get_context_variable('total_contents'), 3)
+        finally:
+            os.remove(rules_file)
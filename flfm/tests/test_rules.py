@@ -8,13 +8,15 @@ from flask_testing import TestCase
 from flfm import create_app
 from flfm.shell.paths import ShellPath, ShellDirectory
 from flfm.shell.rules import (
-    Rules, VirtualRules, MappedDirectories, enforce_mapped
+    Rules, VirtualRules, MappedDirectories, MappedDirectory, RuleTrie,
+    RulesRegistry, enforce_mapped
 )
 from .config import Config
 
 class TestConfig(Config):
     TESTING = True
     PROPAGATE_EXCEPTIONS = True
+    MEDIA_INDEX_FILE = None
 
 class RulesTest(TestConfig, TestCase):
     def __init__(self, *args, **kwargs):
@@ -353,3 +355,201 @@ class VirtualRulesTest(TestConfig, TestCase):
         self.assertEqual(map1, map2)
         self.assertNotEqual(map1, map3)
         self.assertNotEqual(map2, map3)
+
+# apply_rule_map() as it was before being compiled into a RuleTrie.
+# Kept as the reference for RuleTrieTest.
+def legacy_apply_rule_map(self, rule_map):
+    def length_paths(other_map):
+        for md in other_map:
+            yield len(md.dir_path)
+    def difference_length(my_length, all_lengths):
+        for length in all_lengths:
+            yield abs(length-my_length)
+
+    rule_map_lens = list(length_paths(rule_map))
+
+    for my_dir in self:
+        if my_dir in rule_map:
+            self[my_dir.dir_path] = rule_map.get_mapped_dir(my_dir.dir_path)
+            continue
+        for rule_dir in rule_map:
+            if rule_dir.is_in_tree(my_dir.dir_path):
+                if not rule_dir.dir_allowed:
+                    self[my_dir.dir_path] = rule_dir
+                    break
+                my_length = len(my_dir.dir_path)
+                rd_length = len(rule_dir.dir_path)
+                rule_map_lens = list(filter(lambda x, l=rd_length: x <= l,
+                                            rule_map_lens))
+                if my_length == min(difference_length(my_length, rule_map_lens))+rd_length:
+                    self[my_dir.dir_path] = rule_dir
+        rule_map_lens = list(length_paths(rule_map))
+
+    return self
+
+class RuleTrieTest(TestConfig, TestCase):
+    components = ('a', 'b', 'c', 'ab', '.', '')
+
+    def create_app(self):
+        return create_app(self)
+
+    def random_path(self, rng, max_depth):
+        depth = rng.randint(0, max_depth)
+        path = '/' + '/'.join(rng.choice(self.components) for _ in range(depth))
+        if rng.random() < 0.1:
+            path += '/'
+        return path
+
+    def random_rules(self, rng):
+        virt_rules = VirtualRules()
+        for _ in range(rng.randint(0, 12)):
+            rule = rng.choice((virt_rules.allowed, virt_rules.allow_uploads,
+                               virt_rules.disallowed))
+            rule(self.random_path(rng, 4))
+        return virt_rules
+
+    def test_equivalence_with_apply_rule_map(self):
+        print("\n\nTEST RULETRIE == LEGACY apply_rule_map()")
+        rng = random.Random(0x666c666d)
+
+        for _ in range(3000):
+            rule_map = MappedDirectories.from_rules(self.random_rules(rng))
+            dirs = dict((self.random_path(rng, 5), (False, False))
+                        for _ in range(rng.randint(1, 16)))
+
+            expected = legacy_apply_rule_map(MappedDirectories(dict(dirs)),
+                                             rule_map)
+            actual = MappedDirectories(dict(dirs)).apply_rule_map(rule_map)
+            self.assertEqual(expected, actual,
+                             msg='{} on {}'.format(rule_map.D, dirs))
+
+    def test_resolve(self):
+        rule_map = MappedDirectories(dict({
+            '/srv/pub': (True, False),
+            '/srv/pub/up': (True, True),
+            '/srv/pub/private': (False, False),
+        }))
+        rule_trie = RuleTrie(rule_map)
+
+        self.assertEqual(rule_trie.resolve('/srv/pub/up'), (True, True))
+        self.assertEqual(rule_trie.resolve('/srv/pub/x/y'), (True, False))
+        # the outermost allowed directory applies to subdirectories
+        self.assertEqual(rule_trie.resolve('/srv/pub/up/x'), (True, False))
+        self.assertEqual(rule_trie.resolve('/srv/pub/private/x'), (False, False))
+        self.assertIsNone(rule_trie.resolve('/srv'))
+        self.assertIsNone(rule_trie.resolve('/srv/public'))
+
+        # recompiled after a change
+        self.assertIs(rule_map.compiled, rule_map.compiled)
+        rule_map['/srv'] = MappedDirectory('/srv', False, False)
+        self.assertEqual(rule_map.compiled.resolve('/srv/pub/x'), (False, False))
+
+class RulesRegistryTest(TestConfig, TestCase):
+    def __init__(self, *args, **kwargs):
+        super(RulesRegistryTest, self).__init__(*args, **kwargs)
+
+        our_path = os.path.abspath(os.path.dirname(__file__))
+        self.registry_rules = os.path.join(
+            our_path,
+            'output',
+            'registry_rules'
+        )
+
+    def setUp(self):
+        with open(self.registry_rules, 'w') as f:
+            f.write('Allowed=/fake/path\n')
+
+    def tearDown(self):
+        if os.path.exists(self.registry_rules):
+            os.remove(self.registry_rules)
+
+    def create_app(self):
+        return create_app(self)
+
+    def test_rules_parsed_once(self):
+        print("\n\nTEST RULES REGISTRY")
+        registry = RulesRegistry(current_app)
+        registry.check_interval = 0
+
+        first = registry.get_rules(self.registry_rules)
+        self.assertIs(registry.get_rules(self.registry_rules), first)
+        self.assertEqual(registry.reloads, 1)
+        self.assertEqual(first.num_rules, 1)
+        self.assertGreater(registry.total_parse_time, 0.0)
+
+        # changed on disk, swapped in
+        with open(self.registry_rules, 'a') as f:
+            f.write('Disallowed=/fake/path/private\n')
+        os.utime(self.registry_rules, ns=(0, 0))
+        second = registry.get_rules(self.registry_rules)
+        self.assertIsNot(second, first)
+        self.assertEqual(second.num_rules, 2)
+        self.assertEqual(registry.reloads, 2)
+
+        # within the check interval, the file is not even stat()'d
+        registry.check_interval = 3600
+        os.remove(self.registry_rules)
+        self.assertIs(registry.get_rules(self.registry_rules), second)
+
+        # a different rules file is always loaded
+        self.assertEqual(registry.get_rules(None).num_rules, 0)
+        self.assertEqual(registry.reloads, 3)
+
+    def test_mapped_dirs_cached(self):
+        virt_rules = VirtualRules()
+        virt_rules.allowed('/fake/path')
+        mapped = virt_rules.mapped_dirs
+        self.assertIs(virt_rules.mapped_dirs, mapped)
+
+        virt_rules.disallowed('/fake/path/private')
+        self.assertIsNot(virt_rules.mapped_dirs, mapped)
+        self.assertEqual(virt_rules.mapped_dirs,
+                         MappedDirectories.from_rules(virt_rules))
+
+    def test_user_rules_cached(self):
+        class FakeQuery:
+            def __init__(self, shares):
+                self.shares = shares
+                self.queries = 0
+            def all(self):
+                self.queries += 1
+                return self.shares
+
+        class FakeUser:
+            def __init__(self, user_id, home_folder, shares=()):
+                self.id = user_id
+                self.home_folder = home_folder
+                self.shares_received = FakeQuery(list(shares))
+
+        class FakeShare:
+            def __init__(self, owner):
+                self.owner = owner
+
+        registry = RulesRegistry(current_app)
+        base_rules = registry.get_rules(self.registry_rules)
+        owner = FakeUser(1, '/homes/owner')
+        user = FakeUser(2, '/homes/user', [FakeShare(owner)])
+
+        users_rules = registry.get_user_rules(user, base_rules)
+        self.assertIs(registry.get_user_rules(user, base_rules), users_rules)
+        self.assertEqual(user.shares_received.queries, 1)
+        self.assertEqual(users_rules.num_rules, base_rules.num_rules + 3)
+        self.assertEqual(users_rules.mapped_dirs.compiled.resolve('/homes/owner/x'),
+                         (True, False))
+        self.assertEqual(users_rules.mapped_dirs.compiled.resolve('/homes/user/x'),
+                         (True, True))
+        # the base rules weren't touched
+        self.assertEqual(base_rules.num_rules, 1)
+
+        # shares changed
+        user.shares_received.shares = []
+        registry.invalidate_user(user.id)
+        no_shares = registry.get_user_rules(user, base_rules)
+        self.assertIsNot(no_shares, users_rules)
+        self.assertIsNone(no_shares.mapped_dirs.compiled.resolve('/homes/owner/x'))
+
+        # base rules reloaded
+        registry.invalidate()
+        new_base = registry.get_rules(self.registry_rules)
+        self.assertIsNot(registry.get_user_rules(user, new_base), no_shares)
+        self.assertEqual(user.shares_received.queries, 3)
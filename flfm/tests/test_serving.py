@@ -0,0 +1,276 @@
+import io
+import os
+import shutil
+import tempfile
+from flask import current_app, url_for
+from PIL import Image
+from flask_testing import TestCase
+from flfm import create_app
+from flfm.shell.paths import ShellDirectory
+from flfm.shell.serving import map_offload_path
+from flfm.shell.thumbnails import thumbnails
+from .config import Config
+
+class TestConfig(Config):
+    TESTING = True
+    PROPAGATE_EXCEPTIONS = True
+    MEDIA_INDEX_FILE = None
+
+class ServingTest(TestConfig, TestCase):
+    def __init__(self, *args, **kwargs):
+        super(ServingTest, self).__init__(*args, **kwargs)
+
+        our_path = os.path.abspath(os.path.dirname(__file__))
+        self.sample_rules = os.path.join(
+            our_path,
+            'samples',
+            'sample_rules'
+        )
+        self.allow_root = os.path.join(
+            our_path,
+            'faketree'
+        )
+
+        self.faketree_dir = ShellDirectory.from_str_loc(self.allow_root).path
+        self.test_file = self.faketree_dir + '/subdir1/File2.txt'
+
+    def setUp(self):
+        rule_contents = 'Allowed={}'.format(self.faketree_dir)
+
+        if os.path.exists(self.sample_rules):
+            os.remove(self.sample_rules)
+
+        with open(self.sample_rules, 'w') as f:
+            f.write(rule_contents)
+
+    def tearDown(self):
+        if os.path.exists(self.sample_rules):
+            os.remove(self.sample_rules)
+
+    def create_app(self):
+        return create_app(self)
+
+    def test_offload_mapping(self):
+        offload_map = dict({
+            '/srv/files': '/_internal/files/',
+            '/srv/files/big/': '/_internal/big',
+        })
+
+        self.assertEqual(map_offload_path('/srv/files/a/b.txt', offload_map),
+                         '/_internal/files/a/b.txt')
+        self.assertEqual(map_offload_path('/srv/files/big/c.iso', offload_map),
+                         '/_internal/big/c.iso')
+        self.assertIsNone(map_offload_path('/srv/filesystem/d', offload_map))
+        self.assertIsNone(map_offload_path('/srv/files/../e', offload_map))
+
+    def test_serve_offloaded(self):
+        current_app.config['RULES_FILE'] = self.sample_rules
+        serve_url = url_for('shell.serve_file')
+
+        print("\n\nTEST SERVE W/O OFFLOADING")
+        response = self.client.get(serve_url,
+                                   query_string=dict(f=self.test_file))
+        self.assert200(response)
+        self.assertNotIn('X-Accel-Redirect', response.headers)
+        with open(self.test_file, 'rb') as f:
+            self.assertEqual(response.data, f.read())
+        response.close()
+
+        print("TEST SERVE W/ X-ACCEL-REDIRECT")
+        current_app.config['SERVE_OFFLOAD'] = 'x-accel-redirect'
+        current_app.config['SERVE_OFFLOAD_MAP'] = dict({
+            self.faketree_dir: '/_flfm_files/faketree/',
+        })
+        response = self.client.get(serve_url,
+                                   query_string=dict(f=self.test_file))
+        self.assert200(response)
+        self.assertEqual(response.headers['X-Accel-Redirect'],
+                         '/_flfm_files/faketree/subdir1/File2.txt')
+        self.assertIn('File2.txt', response.headers['Content-Disposition'])
+        self.assertEqual(response.data, b'')
+
+        print("TEST SERVE W/ X-SENDFILE")
+        current_app.config['SERVE_OFFLOAD'] = 'x-sendfile'
+        current_app.config['SERVE_OFFLOAD_MAP'] = dict()
+        response = self.client.get(serve_url,
+                                   query_string=dict(f=self.test_file))
+        self.assert200(response)
+        self.assertEqual(response.headers['X-Sendfile'], self.test_file)
+        self.assertEqual(response.data, b'')
+
+    def test_serve_conditional(self):
+        current_app.config['RULES_FILE'] = self.sample_rules
+        serve_url = url_for('shell.serve_file')
+        with open(self.test_file, 'rb') as f:
+            contents = f.read()
+
+        print("\n\nTEST SERVE W/ ETAG & RANGE")
+        response = self.client.get(serve_url,
+                                   query_string=dict(f=self.test_file))
+        self.assert200(response)
+        etag = response.headers['ETag']
+        self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+        self.assertIn('no-cache', response.headers['Cache-Control'])
+        self.assertNotIn('no-store', response.headers['Cache-Control'])
+        self.assertIn('Cookie', response.headers['Vary'])
+        response.close()
+
+        # unchanged
+        response = self.client.get(serve_url, headers={'If-None-Match': etag},
+                                   query_string=dict(f=self.test_file))
+        self.assertStatus(response, 304)
+        self.assertEqual(response.data, b'')
+        response.close()
+
+        # resume from byte 4
+        response = self.client.get(serve_url, headers={'Range': 'bytes=4-'},
+                                   query_string=dict(f=self.test_file))
+        self.assertStatus(response, 206)
+        self.assertEqual(response.data, contents[4:])
+        self.assertEqual(response.headers['Content-Range'],
+                         'bytes 4-{}/{}'.format(len(contents)-1, len(contents)))
+        response.close()
+
+        # stale If-Range sends the whole file
+        response = self.client.get(serve_url, headers={'Range': 'bytes=4-',
+                                                       'If-Range': '"stale"'},
+                                   query_string=dict(f=self.test_file))
+        self.assert200(response)
+        self.assertEqual(response.data, contents)
+        response.close()
+
+        # the viewer redirect is still never stored
+        self.client.set_cookie('localhost', 'flfm_viewer', 'enabled')
+        response = self.client.get(serve_url,
+                                   query_string=dict(f=self.test_file))
+        self.assertStatus(response, 302)
+        self.assertEqual(response.headers['Cache-Control'], 'no-store')
+
+    def test_serve_sniffed_type(self):
+        current_app.config['RULES_FILE'] = self.sample_rules
+        serve_url = url_for('shell.serve_file')
+        no_extension = self.faketree_dir + '/sniffed'
+        dir_stat = os.stat(self.faketree_dir)
+
+        print("\n\nTEST SERVE SNIFFED TYPE")
+        try:
+            with open(no_extension, 'wb') as f:
+                f.write(b'\x89PNG\r\n\x1a\n' + bytes(32))
+            response = self.client.get(serve_url,
+                                       query_string=dict(f=no_extension))
+            self.assertEqual(response.mimetype, 'image/png')
+            response.close()
+
+            # rewritten in place, the directory's listing is still cached
+            listed_stat = os.stat(self.faketree_dir)
+            with open(no_extension, 'wb') as f:
+                f.write(b'%PDF-1.4\n' + bytes(64))
+            os.utime(self.faketree_dir,
+                     ns=(listed_stat.st_atime_ns, listed_stat.st_mtime_ns))
+            response = self.client.get(serve_url,
+                                       query_string=dict(f=no_extension))
+            self.assertEqual(response.mimetype, 'application/pdf')
+            response.close()
+        finally:
+            if os.path.exists(no_extension):
+                os.remove(no_extension)
+            os.utime(self.faketree_dir,
+                     ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+
+    def test_thumbnails(self):
+        current_app.config['RULES_FILE'] = self.sample_rules
+        thumb_url = url_for('shell.thumbnail')
+        photo = self.faketree_dir + '/subdir1/photo.jpg'
+        icon = self.faketree_dir + '/subdir1/icon.png'
+        broken = self.faketree_dir + '/subdir1/broken.png'
+        small = self.faketree_dir + '/subdir1/small.jpg'
+        animated = self.faketree_dir + '/subdir1/animated.gif'
+
+        Image.new('RGB', (1200, 900), (200, 10, 10)).save(photo)
+        Image.new('RGBA', (800, 800), (0, 0, 0, 0)).save(icon)
+        Image.new('RGB', (200, 150), (10, 200, 10)).save(small)
+        frames = [Image.new('P', (1200, 900), i) for i in range(2)]
+        frames[0].save(animated, save_all=True, append_images=frames[1:])
+        with open(broken, 'wb') as f:
+            f.write(b'not a png')
+        thumbnails.directory = tempfile.mkdtemp(prefix='flfm-thumbs-')
+
+        print("\n\nTEST THUMBNAILS")
+        try:
+            renders, hits = thumbnails.renders, thumbnails.hits
+            response = self.client.get(thumb_url,
+                                       query_string=dict(f=photo, w=300))
+            self.assert200(response)
+            self.assertEqual(response.mimetype, 'image/jpeg')
+            self.assertNotIn('attachment', response.headers.get('Content-Disposition', ''))
+            with Image.open(io.BytesIO(response.data)) as variant:
+                # rounded up to 320 & keeps its aspect
+                self.assertEqual(variant.size, (320, 240))
+            response.close()
+            self.assertEqual(thumbnails.renders, renders + 1)
+
+            # the second time, it comes from the disk
+            response = self.client.get(thumb_url,
+                                       query_string=dict(f=photo, w=320))
+            self.assert200(response)
+            response.close()
+            self.assertEqual(thumbnails.renders, renders + 1)
+            self.assertEqual(thumbnails.hits, hits + 1)
+
+            # transparency is kept
+            response = self.client.get(thumb_url,
+                                       query_string=dict(f=icon, w=640))
+            self.assert200(response)
+            self.assertEqual(response.mimetype, 'image/png')
+            with Image.open(io.BytesIO(response.data)) as variant:
+                self.assertEqual(variant.size, (640, 640))
+            response.close()
+
+            # small images & animations are served as they are
+            renders = thumbnails.renders
+            for original in (small, animated):
+                response = self.client.get(thumb_url,
+                                           query_string=dict(f=original, w=320))
+                self.assertStatus(response, 302)
+                self.assertIn(url_for('shell.serve_file'), response.location)
+                self.assertNotIn('dl=', response.location)
+            self.assertIsNone(thumbnails.get_thumbnail(icon, 1920))
+            self.assertEqual(thumbnails.renders, renders)
+
+            # unreadable images fall back to the original
+            response = self.client.get(thumb_url,
+                                       query_string=dict(f=broken, w=320))
+            self.assertStatus(response, 302)
+            self.assertIn(url_for('shell.serve_file'), response.location)
+
+            response = self.client.get(thumb_url,
+                                       query_string=dict(f=self.test_file))
+            self.assertStatus(response, 415)
+            response = self.client.get(thumb_url,
+                                       query_string=dict(f=photo, w='big'))
+            self.assert400(response)
+
+            # over budget, the least recently used variants go first
+            photo_variant = thumbnails.get_thumbnail(photo, 320)[0]
+            icon_variant = thumbnails.get_thumbnail(icon, 640)[0]
+            os.utime(photo_variant, (0, 0))
+            # ... as do renders that never finished
+            unfinished = os.path.join(thumbnails.directory, '.thumb-unfinished')
+            with open(unfinished, 'wb') as f:
+                f.write(bytes(64))
+            os.utime(unfinished, (0, 0))
+            evictions = thumbnails.evictions
+            thumbnails.max_bytes = os.path.getsize(icon_variant)
+            self.assertEqual(thumbnails.trim(), os.path.getsize(icon_variant))
+            self.assertEqual(thumbnails.evictions, evictions + 1)
+            self.assertFalse(os.path.exists(photo_variant))
+            self.assertFalse(os.path.exists(unfinished))
+            self.assertTrue(os.path.exists(icon_variant))
+        finally:
+            for path in (photo, icon, broken, small, animated):
+                os.remove(path)
+            shutil.rmtree(thumbnails.directory)
+            thumbnails.directory = None
+            thumbnails.max_bytes = current_app.config['THUMB_MAX_BYTES']
+            thumbnails.finish_setup()
+            thumbnails.finish_setup()
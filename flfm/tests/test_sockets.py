@@ -1,9 +1,13 @@
 import os
 import json
+import shutil
+import tempfile
+from unittest import mock
 from flask import current_app, request
 from flask_testing import TestCase
 from flask_socketio import SocketIOTestClient, send
 from flfm import create_app, socketio
+from flfm.viewer.staging import StagingJob, video_staging
 from .config import Config
 
 class SocketIOClientContext(SocketIOTestClient):
@@ -26,6 +30,7 @@ class SocketIOClientContext(SocketIOTestClient):
 class TestConfig(Config):
     TESTING = True
     PROPAGATE_EXCEPTIONS = True
+    MEDIA_INDEX_FILE = None
 
 class SocketsWorkingTest(TestConfig, TestCase):
     def __init__(self, *args, **kwargs):
@@ -53,3 +58,101 @@ class SocketsWorkingTest(TestConfig, TestCase):
             self.assertEqual(len(sent_data), 2)
             self.assertEqual(sent_data[0]['args'], 'connected')
             self.assertEqual(sent_data[1]['args'], '{}')
+
+    def test_prepare_video(self):
+        our_path = os.path.abspath(os.path.dirname(__file__))
+        source_video = os.path.join(our_path, 'samples', 'test_mp4_file2.mp4')
+        video_staging.directory = tempfile.mkdtemp(prefix='flfm-videos-')
+        video_staging.chunk_size = 4096
+        video_staging.progress_interval = 0
+        prepare = dict({
+            'data': {
+                'filename': 'test_mp4_file2.mp4',
+                'shell_location': source_video,
+            }
+        })
+
+        def wait_for(client, event):
+            for _ in range(200):
+                received = [r for r in client.get_received() if r['name'] == event]
+                if received:
+                    return received
+                socketio.sleep(0.05)
+            return []
+
+        print("\n\nTEST PREPARE VIDEO")
+        try:
+            # can't symlink, so it's copied in the background
+            with mock.patch('os.symlink', side_effect=OSError), \
+                 SocketIOClientContext(current_app, self.sio_instance,
+                                       flask_test_client=self.client) as client1, \
+                 SocketIOClientContext(current_app, self.sio_instance,
+                                       flask_test_client=self.client) as client2:
+                client1.emit('prepare video', prepare)
+                client2.emit('prepare video', prepare)
+
+                client1_all = []
+                for _ in range(200):
+                    client1_all += client1.get_received()
+                    if any(r['name'] == 'video ready' for r in client1_all):
+                        break
+                    socketio.sleep(0.05)
+                progress = [json.loads(r['args'][0]) for r in client1_all
+                            if r['name'] == 'video progress']
+                self.assertTrue(progress)
+                self.assertTrue(all(p['total'] == os.path.getsize(source_video)
+                                    for p in progress))
+                self.assertTrue(any(r['name'] == 'video ready' for r in client1_all))
+                self.assertTrue(wait_for(client2, 'video ready'))
+
+            staged_name = video_staging.staged_name(source_video)
+            self.assertTrue(staged_name.endswith('.mp4'))
+            stream_video = os.path.join(video_staging.directory, staged_name)
+            self.assertFalse(os.path.islink(stream_video))
+            with open(stream_video, 'rb') as f1, open(source_video, 'rb') as f2:
+                self.assertEqual(f1.read(), f2.read())
+            self.assertEqual(os.listdir(video_staging.directory), [staged_name])
+            self.assertFalse(video_staging.jobs)
+            os.remove(stream_video)
+
+            # clients preparing the same video wait on the one copy
+            with mock.patch('os.symlink', side_effect=OSError):
+                _, job, is_new = video_staging.stage(source_video, 'sid1')
+                self.assertTrue(is_new)
+                self.assertEqual(video_staging.stage(source_video, 'sid2'),
+                                 (staged_name, job, False))
+            self.assertEqual(job.clients, set(['sid1', 'sid2']))
+
+            # nobody waiting anymore, so the copy stops & is cleaned up
+            video_staging.cancel('sid1')
+            self.assertFalse(job.cancelled)
+            video_staging.cancel('sid2')
+            self.assertTrue(job.cancelled)
+            self.assertFalse(video_staging.run(job))
+            self.assertEqual(os.listdir(video_staging.directory), [])
+
+            # a video that isn't there fails instead of hanging the client
+            missing = dict({'data': dict(prepare['data'],
+                                         shell_location=source_video + '.gone')})
+            with SocketIOClientContext(current_app, self.sio_instance,
+                                       flask_test_client=self.client) as client:
+                client.emit('prepare video', missing)
+                failed = wait_for(client, 'video failed')
+                self.assertTrue(failed)
+                self.assertIn('.gone', json.loads(failed[0]['args'][0])['error'])
+
+            # ... as does a copy going wrong in some unexpected way
+            with mock.patch('os.symlink', side_effect=OSError), \
+                 mock.patch.object(StagingJob, '_copy_chunk',
+                                   side_effect=ValueError('unexpected')), \
+                 SocketIOClientContext(current_app, self.sio_instance,
+                                       flask_test_client=self.client) as client:
+                client.emit('prepare video', prepare)
+                failed = wait_for(client, 'video failed')
+                self.assertTrue(failed)
+                self.assertIn('unexpected', json.loads(failed[0]['args'][0])['error'])
+            self.assertFalse(video_staging.jobs)
+            self.assertEqual(os.listdir(video_staging.directory), [])
+        finally:
+            shutil.rmtree(video_staging.directory)
+            video_staging.init_app(current_app)
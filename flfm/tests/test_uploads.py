@@ -1,17 +1,21 @@
+import errno
 import os
 import pathlib as pl
+import shutil
+from unittest import mock
 import werkzeug.exceptions
 from flask import current_app, url_for
 from flask_testing import TestCase
 from flfm import create_app
 from flfm.misc import make_filepond_id
-from flfm.shell.paths import ShellDirectory
-from flfm.shell.uploads import UploadedFile
+from flfm.shell.paths import ShellDirectory, ShellPath
+from flfm.shell.uploads import UploadedFile, upload_staging
 from .config import Config
 
 class TestConfig(Config):
     TESTING = True
     PROPAGATE_EXCEPTIONS = True
+    MEDIA_INDEX_FILE = None
 
 class UploadsTest(TestConfig, TestCase):
     def __init__(self, *args, **kwargs):
@@ -50,6 +54,10 @@ class UploadsTest(TestConfig, TestCase):
         if os.path.exists(self.sample_rules):
             os.remove(self.sample_rules)
 
+        for dirpath, dirnames, _ in os.walk(os.path.dirname(self.output)):
+            if '.flfm-staging' in dirnames:
+                shutil.rmtree(os.path.join(dirpath, '.flfm-staging'))
+
     def create_app(self):
         return create_app(self)
 
@@ -119,3 +127,229 @@ class UploadsTest(TestConfig, TestCase):
         response = self.client.post(url, headers=dict({'X-Uploadto': ul_to_3}),
                                     data=dict(filepond=open(self.sample, 'rb')))
         self.assert403(response)
+
+    def test_chunked_uploading(self):
+        current_app.config['RULES_FILE'] = self.sample_rules
+        ul_to = self.test_rule_dir
+
+        print("\nTesting chunked uploading through the web interface.")
+
+        with open(self.sample, 'rb') as f:
+            test_buffer = f.read()
+        half = len(test_buffer) // 2
+
+        url = url_for('shell.process')
+        response = self.client.post(url, headers=dict({
+            'X-Uploadto': ul_to,
+            'Upload-Length': str(len(test_buffer)),
+        }), data=dict(filepond='{}'), content_type='multipart/form-data')
+        self.assert200(response)
+        transfer_id = int(response.data)
+
+        patch_url = url_for('shell.patch', transfer_id=transfer_id)
+        response = self.client.head(patch_url)
+        self.assert200(response)
+        self.assertEqual(response.headers['Upload-Offset'], '0')
+
+        chunk_headers = dict({
+            'Content-Type': 'application/offset+octet-stream',
+            'Upload-Length': str(len(test_buffer)),
+            'Upload-Name': os.path.basename(self.output),
+        })
+        response = self.client.patch(patch_url, data=test_buffer[:half],
+                                     headers=dict(chunk_headers,
+                                                  **{'Upload-Offset': '0'}))
+        self.assert200(response)
+
+        # the upload was interrupted; resume where the server left off
+        response = self.client.head(patch_url)
+        self.assertEqual(response.headers['Upload-Offset'], str(half))
+
+        # a chunk past the end would leave a hole in the file
+        response = self.client.patch(patch_url, data=test_buffer[half:],
+                                     headers=dict(chunk_headers,
+                                                  **{'Upload-Offset': str(half+1)}))
+        self.assertStatus(response, 409)
+
+        # finishing early doesn't commit half a file
+        response = self.client.post(url, data=dict(id=transfer_id))
+        self.assertEqual(response.data, b'NOUPLOAD')
+        self.assertFalse(os.path.exists(self.output))
+
+        # more than Upload-Length is refused, and none of the chunk is kept
+        response = self.client.patch(patch_url, data=test_buffer[half:] + b'extra',
+                                     headers=dict(chunk_headers,
+                                                  **{'Upload-Offset': str(half)}))
+        self.assertStatus(response, 413)
+        response = self.client.head(patch_url)
+        self.assertEqual(response.headers['Upload-Offset'], str(half))
+
+        response = self.client.patch(patch_url, data=test_buffer[half:],
+                                     headers=dict(chunk_headers,
+                                                  **{'Upload-Offset': str(half)}))
+        self.assert200(response)
+        self.assertEqual(response.headers['Upload-Offset'], str(len(test_buffer)))
+
+        response = self.client.post(url, data=dict(id=transfer_id))
+        self.assertEqual(response.data, b'SUCCESS')
+
+        with open(self.output, 'rb') as f:
+            self.assertEqual(f.read(), test_buffer)
+
+        os.remove(self.output)
+
+    def test_staging(self):
+        output_dir = os.path.dirname(self.output)
+        with open(self.sample, 'rb') as f:
+            test_buffer = f.read()
+
+        print("\nTesting upload staging.")
+
+        test_file = UploadedFile(make_filepond_id(), output_dir,
+                                 os.path.basename(self.output))
+        # staged beside the destination, but never listed
+        self.assertEqual(os.path.dirname(test_file.temporary_dir),
+                         os.path.join(output_dir, '.flfm-staging'))
+        # ... and only created once something is written
+        self.assertFalse(os.path.exists(os.path.dirname(test_file.temporary_dir)))
+        test_file.create_temporary()
+        test_file.file.write(test_buffer)
+        test_file.file.close()
+        names = [c.name for c in ShellPath(output_dir).children]
+        self.assertNotIn('.flfm-staging', names)
+
+        renames = upload_staging.renames
+        test_file.make_permanent()
+        self.assertEqual(upload_staging.renames, renames + 1)
+        self.assertFalse(os.path.exists(os.path.dirname(test_file.temporary_dir)))
+        os.remove(self.output)
+
+        # a staging area on another filesystem falls back to copying
+        test_file = UploadedFile(make_filepond_id(), output_dir,
+                                 os.path.basename(self.output))
+        test_file.create_temporary()
+        test_file.file.write(test_buffer)
+        test_file.file.close()
+
+        real_rename = os.rename
+        def cross_device(src, dest):
+            if src.startswith(test_file.temporary_dir):
+                raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+            return real_rename(src, dest)
+
+        copies = upload_staging.copies
+        copied = upload_staging.bytes_copied
+        with mock.patch('flfm.shell.uploads.os.rename', cross_device):
+            test_file.make_permanent()
+        self.assertEqual(upload_staging.copies, copies + 1)
+        self.assertEqual(upload_staging.bytes_copied, copied + len(test_buffer))
+
+        with open(self.output, 'rb') as f:
+            self.assertEqual(f.read(), test_buffer)
+        # nothing is left behind from the copy
+        leftovers = [n for n in os.listdir(output_dir) if n.startswith('.flfm-')]
+        self.assertEqual(leftovers, [])
+
+        os.remove(self.output)
+
+    def test_streamed_uploading(self):
+        current_app.config['RULES_FILE'] = self.sample_rules
+        ul_to = self.test_rule_dir
+        url = url_for('shell.process')
+
+        print("\nTesting streamed uploads.")
+
+        with open(self.sample, 'rb') as f:
+            test_buffer = f.read()
+
+        received = upload_staging.uploads_received
+        response = self.client.post(url, headers=dict({'X-Uploadto': ul_to}),
+                                    data=dict(filepond=open(self.sample, 'rb')))
+        self.assert200(response)
+        self.assertEqual(upload_staging.uploads_received, received + 1)
+        self.assertIsNotNone(upload_staging.throughput)
+        # it wasn't a chunked upload, there's nothing to resume
+        response_head = self.client.head(url_for('shell.patch',
+                                                 transfer_id=int(response.data)))
+        self.assert404(response_head)
+
+        response = self.client.post(url, data=dict(id=int(response.data)))
+        self.assertEqual(response.data, b'SUCCESS')
+        with open(self.output, 'rb') as f:
+            self.assertEqual(f.read(), test_buffer)
+
+        # already exists; refused before the file is written anywhere
+        response = self.client.post(url, headers=dict({'X-Uploadto': ul_to}),
+                                    data=dict(filepond=open(self.sample, 'rb')))
+        self.assert400(response)
+        os.remove(self.output)
+
+        current_app.config['UPLOAD_MAX_SIZE'] = 16
+        response = self.client.post(url, headers=dict({'X-Uploadto': ul_to}),
+                                    data=dict(filepond=open(self.sample, 'rb')))
+        self.assertStatus(response, 413)
+        staging = os.path.join(ul_to, '.flfm-staging')
+        self.assertFalse(os.path.exists(staging))
+
+        # uploads in progress can't be downloaded by anyone
+        test_file = UploadedFile(make_filepond_id(), ul_to,
+                                 os.path.basename(self.output))
+        test_file.create_temporary()
+        test_file.close()
+        staged_path = os.path.join(test_file.temporary_dir, test_file.filename)
+        response = self.client.get(url_for('shell.serve_file', f=staged_path))
+        self.assert404(response)
+        response = self.client.get(url_for('shell.thumbnail', f=staged_path))
+        self.assert404(response)
+        response = self.client.get(url_for('viewer.view_file', f=staged_path,
+                                           mt='text/plain'))
+        self.assert404(response)
+        test_file.discard()
+        self.assertFalse(os.path.exists(staging))
+
+    def test_staging_hidden(self):
+        current_app.config['RULES_FILE'] = self.sample_rules
+        ul_to = self.test_rule_dir
+
+        print("\nTesting that staging directories can't be reached.")
+
+        test_file = UploadedFile(make_filepond_id(), ul_to,
+                                 os.path.basename(self.output))
+        test_file.create_temporary()
+        test_file.close()
+        staging = os.path.dirname(test_file.temporary_dir)
+        try:
+            response = self.client.get(url_for('shell.shell_view',
+                                               view_path=staging[1:]))
+            self.assert404(response)
+            response = self.client.get(url_for('shell.listing', d=staging))
+            self.assert404(response)
+            response = self.client.post(url_for('shell.medialist'),
+                                        data=dict(directory=test_file.temporary_dir,
+                                                  whatkind='text'))
+            self.assert404(response)
+            response = self.client.post(url_for('shell.process'),
+                                        headers=dict({'X-Uploadto': staging}),
+                                        data=dict(filepond=open(self.sample, 'rb')))
+            self.assert404(response)
+
+            # not even by an admin
+            admin = mock.Mock(is_admin=True)
+            current_app.config['LOGIN_DISABLED'] = True
+            with mock.patch('flfm.shell.routes.current_user', admin):
+                response = self.client.post(url_for('shell.perform'), data=dict({
+                    'action': 'delete', 'p1': staging,
+                }))
+                self.assert404(response)
+                response = self.client.post(url_for('shell.perform'), data=dict({
+                    'action': 'delete', 'p1': test_file.temporary_dir,
+                }))
+                self.assert404(response)
+                response = self.client.post(url_for('shell.newdir'), data=dict({
+                    'where': ul_to, 'name': '.flfm-staging',
+                }))
+                self.assert404(response)
+            self.assertTrue(test_file.temporary)
+        finally:
+            current_app.config['LOGIN_DISABLED'] = False
+            test_file.discard()
@@ -1,12 +1,59 @@
+import io
 import os
+import shutil
+import struct
+import tempfile
 from flask_testing import TestCase
 from flfm import create_app
-from flfm.shell.video import MP4File
+from flfm.shell.video import (
+    MP4File, fast_start_plan, find_box, iter_boxes, make_box,
+    needs_fast_start, read_payload, read_seek_index, relocate_chunks
+)
+from flfm.viewer.staging import VideoStaging
 from .config import Config
 
+def make_tkhd(width, height, version=0, rotated=False):
+    if version == 1:
+        times = struct.pack('>QQIIQ', 0, 0, 1, 0, 0)
+    else:
+        times = struct.pack('>IIIII', 0, 0, 1, 0, 0)
+    if rotated:
+        matrix = struct.pack('>9i', 0, 0x10000, 0, -0x10000, 0, 0, 0, 0, 0x40000000)
+    else:
+        matrix = struct.pack('>9i', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+    payload = bytes([version, 0, 0, 3]) + times + bytes(16) + matrix + \
+              struct.pack('>II', width << 16, height << 16)
+    return make_box(b'tkhd', payload)
+
+def make_trak(handler, codec, width, height, seconds, tkhd_version=0,
+              rotated=False, sample_tables=b''):
+    mdhd = make_box(b'mdhd', bytes(12) + struct.pack('>II', 1000, seconds * 1000) +
+                    bytes(4))
+    hdlr = make_box(b'hdlr', bytes(8) + handler + bytes(12) + b'\x00')
+    stsd = make_box(b'stsd', struct.pack('>II', 0, 1) + make_box(codec, bytes(78)))
+    minf = make_box(b'minf', make_box(b'stbl', stsd + sample_tables))
+    return make_box(b'trak', make_tkhd(width, height, tkhd_version, rotated) +
+                    make_box(b'mdia', mdhd + hdlr + minf))
+
+def make_mp4(path, width, height, brand=b'isom', moov_at_end=False,
+             largesize=False, tkhd_version=0, mdat_size=4096, audio_first=False,
+             rotated=False, seconds=2, sample_tables=b''):
+    ftyp = make_box(b'ftyp', brand + struct.pack('>I', 0x200) + brand + b'mp41')
+    mvhd = make_box(b'mvhd', bytes(12) + struct.pack('>II', 600, seconds * 600) +
+                    bytes(80))
+    traks = [make_trak(b'vide', b'avc1', width, height, seconds, tkhd_version,
+                       rotated, sample_tables)]
+    if audio_first:
+        traks.insert(0, make_trak(b'soun', b'mp4a', 0, 0, seconds))
+    moov = make_box(b'moov', mvhd + b''.join(traks))
+    mdat = make_box(b'mdat', bytes(mdat_size), largesize)
+    with open(path, 'wb') as f:
+        f.write(ftyp + (mdat + moov if moov_at_end else moov + mdat))
+
 class TestConfig(Config):
     TESTING = True
     PROPAGATE_EXCEPTIONS = True
+    MEDIA_INDEX_FILE = None
 
 class VideoFormatTests(TestConfig, TestCase):
     def __init__(self, *args, **kwargs):
@@ -47,3 +94,200 @@ class VideoFormatTests(TestConfig, TestCase):
 
         with self.assertRaises(ValueError):
             bad_file = MP4File(self.non_video_sample)
+
+    def test_mp4_box_walker(self):
+        print("\n\nTESTING MP4 BOX WALKER")
+        fd, path = tempfile.mkstemp(suffix='.mp4')
+        os.close(fd)
+        try:
+            # moov after a 64-bit sized mdat, with a brand that's not common
+            make_mp4(path, 1280, 720, brand=b'M4V ', moov_at_end=True,
+                     largesize=True)
+            self.assertEqual(MP4File(path).video_wxh, (1280, 720))
+
+            make_mp4(path, 640, 480, tkhd_version=1)
+            self.assertEqual(MP4File(path).video_wxh, (640, 480))
+
+            # no moov at all
+            with open(path, 'wb') as f:
+                f.write(make_box(b'ftyp', b'isom\x00\x00\x02\x00isom') +
+                        make_box(b'mdat', bytes(64)))
+            self.assertEqual(MP4File(path).video_wxh, (-1, -1))
+        finally:
+            os.remove(path)
+
+    def test_mp4_metadata(self):
+        print("\n\nTESTING MP4 METADATA")
+        fd, path = tempfile.mkstemp(suffix='.mp4')
+        os.close(fd)
+        try:
+            # the audio track comes first, it mustn't be mistaken for the video
+            make_mp4(path, 1280, 720, audio_first=True, rotated=True,
+                     mdat_size=100000, seconds=4)
+            video = MP4File(path)
+            self.assertEqual(video.video_wxh, (1280, 720))
+            self.assertEqual([t.handler for t in video.tracks], ['soun', 'vide'])
+            self.assertEqual(video.video_codec, 'avc1')
+            self.assertEqual(video.video_duration, 4)
+            self.assertEqual(video.video_bitrate, 200000)
+            self.assertEqual(video.video_rotation, 90)
+            self.assertEqual(video.tracks[0].codec, 'mp4a')
+
+            good_file2 = MP4File(self.mp4_sample_2)
+            self.assertEqual(good_file2.video_codec, 'avc1')
+            self.assertAlmostEqual(good_file2.video_duration, 1.03)
+            self.assertEqual(good_file2.video_rotation, 90)
+        finally:
+            os.remove(path)
+
+    def test_mp4_fast_start(self):
+        print("\n\nTEST MP4 FAST START")
+        chunks = [b'first chunk!', b'second chunk', b'third chunk.']
+        ftyp = make_box(b'ftyp', b'isom' + struct.pack('>I', 0x200) + b'isommp41')
+        mdat_payload = b''.join(c + bytes(20) for c in chunks)
+        chunk_offsets = [len(ftyp) + 8 + i * 32 for i in range(len(chunks))]
+
+        def make_moov(offsets):
+            stco = make_box(b'stco', struct.pack('>II', 0, len(offsets)) +
+                            struct.pack('>{}I'.format(len(offsets)), *offsets))
+            stbl = make_box(b'stbl', stco)
+            trak = make_box(b'trak', make_tkhd(64, 48) + make_box(b'mdia',
+                            make_box(b'minf', stbl)))
+            return make_box(b'moov', make_box(b'mvhd', bytes(100)) + trak)
+
+        where = tempfile.mkdtemp(prefix='flfm-faststart-')
+        try:
+            late = os.path.join(where, 'late.mp4')
+            with open(late, 'wb') as f:
+                f.write(ftyp + make_box(b'mdat', mdat_payload) +
+                        make_box(b'free', bytes(16)) + make_moov(chunk_offsets))
+            early = os.path.join(where, 'early.mp4')
+            make_mp4(early, 64, 48)
+
+            self.assertTrue(needs_fast_start(late))
+            self.assertFalse(needs_fast_start(early))
+            self.assertFalse(needs_fast_start(self.non_video_sample))
+            self.assertIsNone(fast_start_plan(early))
+
+            with open(late, 'rb') as f:
+                original = f.read()
+            remuxed = b''.join(p if isinstance(p, bytes) else
+                               original[p[0]:p[0]+p[1]]
+                               for p in fast_start_plan(late))
+            self.assertEqual(len(remuxed), len(original))
+
+            handle = io.BytesIO(remuxed)
+            top_level = [b.type for b in iter_boxes(handle, 0, len(remuxed))]
+            self.assertEqual(top_level, [b'ftyp', b'moov', b'mdat', b'free'])
+            stco = find_box(handle, 0, len(remuxed), b'moov', b'trak', b'mdia',
+                            b'minf', b'stbl', b'stco')
+            payload = read_payload(handle, stco)
+            offsets = struct.unpack('>3I', payload[8:])
+            # the offsets still point at the same chunks
+            for offset, chunk in zip(offsets, chunks):
+                self.assertEqual(remuxed[offset:offset+len(chunk)], chunk)
+
+            # offsets past 4 GiB need a co64
+            moved = relocate_chunks(b'moov', make_moov(chunk_offsets)[8:],
+                                    lambda o: o + 0x100000000)
+            co64 = find_box(io.BytesIO(moved), 0, len(moved), b'moov', b'trak',
+                            b'mdia', b'minf', b'stbl', b'co64')
+            self.assertIsNotNone(co64)
+            self.assertEqual(struct.unpack('>3Q', read_payload(io.BytesIO(moved),
+                                                               co64)[8:]),
+                             tuple(o + 0x100000000 for o in chunk_offsets))
+
+            # staging remuxes instead of symlinking
+            staging = VideoStaging()
+            staging.directory = os.path.join(where, 'videos')
+            os.mkdir(staging.directory)
+            name, job, is_new = staging.stage(late, 'sid')
+            self.assertTrue(is_new)
+            self.assertIsNotNone(job)
+            self.assertTrue(staging.run(job))
+            staged = os.path.join(staging.directory, name)
+            self.assertFalse(os.path.islink(staged))
+            with open(staged, 'rb') as f:
+                self.assertEqual(f.read(), remuxed)
+            self.assertEqual(job.copied, job.total)
+
+            # which is only done once
+            self.assertEqual(staging.stage(late, 'sid'), (name, None, False))
+            name, job, _ = staging.stage(early, 'sid')
+            self.assertIsNone(job)
+            self.assertTrue(os.path.islink(os.path.join(staging.directory, name)))
+        finally:
+            shutil.rmtree(where)
+
+    def test_mp4_seek_index(self):
+        print("\n\nTEST MP4 SEEK INDEX")
+        # 6 one second samples: 2 in the first chunk, 4 in the second
+        stts = make_box(b'stts', struct.pack('>II', 0, 1) +
+                        struct.pack('>II', 6, 1000))
+        stss = make_box(b'stss', struct.pack('>II', 0, 2) +
+                        struct.pack('>2I', 1, 4))
+        stsc = make_box(b'stsc', struct.pack('>II', 0, 2) +
+                        struct.pack('>6I', 1, 2, 1, 2, 4, 1))
+        stsz = make_box(b'stsz', struct.pack('>III', 0, 0, 6) +
+                        struct.pack('>6I', 10, 20, 30, 40, 50, 60))
+        stco = make_box(b'stco', struct.pack('>II', 0, 2) +
+                        struct.pack('>2I', 100, 1000))
+
+        def index_of(stbl_payload, min_interval=1.0):
+            handle = io.BytesIO(make_box(b'stbl', stbl_payload))
+            stbl = next(iter_boxes(handle, 0, len(handle.getvalue())))
+            return read_seek_index(handle, stbl, 1000, min_interval)
+
+        seek_index = index_of(stts + stss + stsc + stsz + stco)
+        self.assertEqual(list(seek_index.times), [0.0, 3.0])
+        self.assertEqual(list(seek_index.offsets), [100, 1030])
+        self.assertEqual(seek_index.lookup(2.5), (0.0, 100))
+        self.assertEqual(seek_index.lookup(3.5), (3.0, 1030))
+        self.assertEqual(seek_index.to_dict(), dict({
+            'times': [0, 3000], 'offsets': [100, 1030],
+        }))
+
+        # without an stss every sample is a keyframe
+        seek_index = index_of(stts + stsc + stsz + stco, 0)
+        self.assertEqual(list(seek_index.times), [0.0, 1.0, 2.0, 3.0, 4.0, 5.0])
+        self.assertEqual(list(seek_index.offsets), [100, 110, 1000, 1030, 1070, 1120])
+        # ... but they're thinned out
+        seek_index = index_of(stts + stsc + stsz + stco, 2.0)
+        self.assertEqual(list(seek_index.times), [0.0, 2.0, 4.0])
+
+        # no chunk offsets, no index
+        self.assertIsNone(index_of(stts + stss + stsc + stsz))
+
+        good_file = MP4File(self.mp4_sample_2)
+        self.assertEqual(good_file.seek_index.to_dict(), dict({
+            'times': [0], 'offsets': [1063],
+        }))
+
+        # tables holding fewer entries than they claim are read as far as
+        # they go: here, sizes for 3 of the 6 samples & part of a 4th
+        short_stsz = make_box(b'stsz', struct.pack('>III', 0, 0, 6) +
+                              struct.pack('>3I', 10, 20, 30) + b'\x00\x00')
+        seek_index = index_of(stts + stss + stsc + short_stsz + stco)
+        self.assertEqual(list(seek_index.times), [0.0])
+        self.assertEqual(list(seek_index.offsets), [100])
+        short_stsc = make_box(b'stsc', struct.pack('>II', 0, 2) +
+                              struct.pack('>4I', 1, 2, 1, 2))
+        seek_index = index_of(stts + stss + short_stsc + stsz + stco)
+        self.assertEqual(list(seek_index.offsets), [100, 1030])
+
+        # a file cut short, partway through the tables at its end
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, 'cut_short.mp4')
+            make_mp4(path, 64, 48, moov_at_end=True,
+                     sample_tables=stts + stss + stsc + stsz + stco)
+            self.assertEqual(list(MP4File(path).seek_index.offsets), [100, 1030])
+            full_size = os.path.getsize(path)
+            for cut in range(1, 31):
+                with open(path, 'r+b') as f:
+                    f.truncate(full_size - cut)
+                seek_index = MP4File(path).seek_index
+                if seek_index is not None:
+                    self.assertLessEqual(len(seek_index.offsets), 2)
+        finally:
+            shutil.rmtree(temp_dir)
@@ -1,15 +1,22 @@
 import os
+import shutil
+import tempfile
+from wsgiref.validate import validator
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
 from flask import current_app, url_for
 from flask_testing import TestCase
 from flfm import create_app
 from flfm.misc import make_arg_url
 from flfm.shell.paths import ShellDirectory
-from flfm.viewer.vcache import VCFile, vcache
+from flfm.viewer.staging import VideoStaging
+from flfm.viewer.vcache import VCFile, ViewerCache, vcache
 from .config import Config
 
 class TestConfig(Config):
     TESTING = True
     PROPAGATE_EXCEPTIONS = True
+    MEDIA_INDEX_FILE = None
 
 class ViewerTest(TestConfig, TestCase):
     def __init__(self, *args, **kwargs):
@@ -181,3 +188,222 @@ class ViewerTest(TestConfig, TestCase):
         vc_inst2 = vcache.view_file(self.cacheable_file)
 
         self.assertEqual(vc_inst1, vc_inst2)
+
+    def test_viewer_fetch_conditional(self):
+        current_app.config['RULES_FILE'] = self.sample_rules
+        test_file = self.faketree_dir + '/subdir1/File3.txt'
+
+        print("\n\nTEST VIEWER FETCH W/ ETAG & RANGE")
+        response = self.client.get(url_for('viewer.view_file'),
+                                   query_string=dict(f=test_file,
+                                                     mt='text/plain'))
+        self.assert200(response)
+        cache_id = self.get_context_variable('cache_id')
+        with open(test_file, 'rb') as f:
+            contents = f.read()
+
+        fetch_url = url_for('viewer.fetch', cacheid=cache_id)
+        response = self.client.get(fetch_url)
+        self.assert200(response)
+        self.assertEqual(response.data, contents)
+        etag = response.headers['ETag']
+
+        response = self.client.get(fetch_url, headers={'If-None-Match': etag})
+        self.assertStatus(response, 304)
+
+        response = self.client.get(fetch_url, headers={'Range': 'bytes=0-3'})
+        self.assertStatus(response, 206)
+        self.assertEqual(response.data, contents[0:4])
+
+        # what WSGI servers are given is valid, e.g. bytes & not memoryviews
+        strict_client = Client(validator(current_app.wsgi_app), BaseResponse)
+        response = strict_client.get(fetch_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, contents)
+        response.close()
+
+    def test_viewer_byte_budget(self):
+        budget = ViewerCache()
+        budget.max_file_size = self.VCACHE_MAX_FILESIZE
+        budget.max_bytes = self.VCACHE_MAX_FILESIZE
+        budget.finish_setup()
+
+        print("\n\nTEST VIEWER CACHE BYTE BUDGET")
+        vc_file = budget.view_file(self.cacheable_file)
+        contents = vc_file.read_contents()
+        self.assertTrue(isinstance(contents, memoryview))
+        self.assertTrue(contents.readonly)
+        with open(self.cacheable_file, 'rb') as f:
+            self.assertEqual(f.read(), contents)
+        self.assertEqual(b''.join(vc_file.iter_contents(4096)), contents)
+
+        # two of them don't fit in the budget
+        other_file = self.cacheable_file + '.2'
+        with open(other_file, 'wb') as f:
+            f.seek(self.VCACHE_MAX_FILESIZE//2 + 1)
+            f.write(b'\x20')
+        try:
+            budget.view_file(other_file)
+            self.assertEqual(len(budget.backend.cache), 1)
+            self.assertTrue(budget.backend.cache.currsize <= budget.max_bytes)
+        finally:
+            os.remove(other_file)
+
+    def test_viewer_old_budget(self):
+        print("\n\nTEST VIEWER CACHE VCACHE_MAX_FILES")
+        current_app.config['VCACHE_MAX_FILES'] = 16
+        try:
+            with self.assertLogs(current_app.logger, 'WARNING') as logged:
+                budget = ViewerCache(current_app)
+        finally:
+            del current_app.config['VCACHE_MAX_FILES']
+        self.assertIn('VCACHE_MAX_FILES', logged.output[0])
+        self.assertEqual(budget.max_bytes, self.VCACHE_MAX_BYTES)
+
+    def test_viewer_cache_id_index(self):
+        budget = ViewerCache()
+        budget.max_file_size = self.VCACHE_MAX_FILESIZE
+        budget.max_bytes = self.VCACHE_MAX_FILESIZE
+        budget.finish_setup()
+
+        print("\n\nTEST VIEWER CACHE ID INDEX")
+        vc_file = budget.view_file(self.cacheable_file)
+        self.assertIs(budget.by_cache_id(vc_file.cache_id), vc_file)
+        self.assertIsNone(budget.by_cache_id(vc_file.cache_id + 1))
+
+        # evicted entries leave the index too
+        other_file = self.cacheable_file + '.2'
+        with open(other_file, 'wb') as f:
+            f.seek(self.VCACHE_MAX_FILESIZE//2 + 1)
+            f.write(b'\x21')
+        try:
+            other = budget.view_file(other_file)
+            self.assertIsNone(budget.by_cache_id(vc_file.cache_id))
+            self.assertIs(budget.by_cache_id(other.cache_id), other)
+            self.assertEqual(list(budget.backend.cache.by_cache_id), [other.cache_id])
+        finally:
+            os.remove(other_file)
+
+    def test_viewer_stale_entries(self):
+        budget = ViewerCache()
+        budget.max_file_size = self.VCACHE_MAX_FILESIZE
+        budget.max_bytes = self.VCACHE_MAX_FILESIZE
+        budget.finish_setup()
+
+        print("\n\nTEST VIEWER CACHE STALE ENTRIES")
+        vc_file = budget.view_file(self.cacheable_file)
+        self.assertIs(budget.view_file(self.cacheable_file), vc_file)
+
+        # replaced with something of the same size
+        with open(self.cacheable_file, 'r+b') as f:
+            f.write(b'\x21')
+        stat = os.stat(self.cacheable_file)
+        os.utime(self.cacheable_file, ns=(stat.st_atime_ns,
+                                          stat.st_mtime_ns + 1000000000))
+
+        new_file = budget.view_file(self.cacheable_file)
+        self.assertIsNot(new_file, vc_file)
+        self.assertEqual(new_file.read_contents()[0:1], b'\x21')
+        # the stale entry is gone
+        self.assertEqual(len(budget.backend.cache), 1)
+        self.assertIsNone(budget.by_cache_id(vc_file.cache_id))
+
+    def test_viewer_disk_backend(self):
+        cache_dir = tempfile.mkdtemp(prefix='flfm-vcache-')
+
+        def make_worker():
+            worker = ViewerCache()
+            worker.max_file_size = self.VCACHE_MAX_FILESIZE
+            worker.max_bytes = self.VCACHE_MAX_FILESIZE
+            worker.backend_name = 'disk'
+            worker.directory = cache_dir
+            worker.finish_setup()
+            return worker
+
+        print("\n\nTEST VIEWER DISK BACKEND")
+        try:
+            worker1, worker2 = make_worker(), make_worker()
+            vc_file = worker1.view_file(self.cacheable_file)
+
+            # what one worker cached, the others can fetch
+            shared = worker2.by_cache_id(vc_file.cache_id)
+            self.assertIsNotNone(shared)
+            self.assertEqual(shared.read_contents(), vc_file.read_contents())
+            self.assertEqual(worker2.view_file(self.cacheable_file), vc_file)
+
+            # two of them don't fit in the budget
+            other_file = self.cacheable_file + '.2'
+            with open(other_file, 'wb') as f:
+                f.seek(self.VCACHE_MAX_FILESIZE//2 + 1)
+                f.write(b'\x21')
+            try:
+                other = worker2.view_file(other_file)
+                self.assertIsNone(worker1.by_cache_id(vc_file.cache_id))
+                self.assertEqual(worker1.by_cache_id(other.cache_id), other)
+                self.assertEqual(len(os.listdir(os.path.join(cache_dir, 'index'))), 1)
+            finally:
+                os.remove(other_file)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_video_staging_budget(self):
+        print("\n\nTEST VIDEO STAGING BUDGET")
+        where = tempfile.mkdtemp(prefix='flfm-videos-')
+        sources = tempfile.mkdtemp(prefix='flfm-sources-')
+        staging = VideoStaging()
+        staging.directory = where
+        try:
+            # two paths to the same video share one name
+            source = os.path.join(sources, 'a.MP4')
+            with open(source, 'wb') as f:
+                f.write(b'\x00' * 10)
+            os.link(source, os.path.join(sources, 'b.mp4'))
+            name = staging.staged_name(source)
+            self.assertTrue(name.endswith('.mp4'))
+            self.assertEqual(staging.staged_name(os.path.join(sources, 'b.mp4')),
+                             name)
+
+            # oldest first: old.mp4, mid.mp4, new.mp4, then the link
+            for i, video in enumerate(('old.mp4', 'mid.mp4', 'new.mp4')):
+                path = os.path.join(where, video)
+                with open(path, 'wb') as f:
+                    f.write(b'\x00' * 100)
+                os.utime(path, (1000 + i, 1000 + i))
+            os.symlink(source, os.path.join(where, 'link.mp4'))
+            os.symlink(os.path.join(sources, 'gone.mp4'),
+                       os.path.join(where, 'broken.mp4'))
+            with open(os.path.join(where, '.staging-abc'), 'wb') as f:
+                f.write(b'\x00' * 1000)
+
+            self.assertEqual(staging.usage(), dict({
+                'videos': 5, 'copies': 3, 'links': 2, 'bytes': 300,
+            }))
+
+            # the broken link always goes, then the oldest copies
+            self.assertEqual(staging.trim(max_bytes=150, max_files=None),
+                             (3, 200))
+            self.assertEqual(sorted(os.listdir(where)),
+                             ['.staging-abc', 'link.mp4', 'new.mp4'])
+
+            # preparing a video makes it the most recently used
+            self.assertEqual(staging.stage(source, 'sid'), (name, None, True))
+            os.utime(os.path.join(where, 'link.mp4'), (1, 1),
+                     follow_symlinks=False)
+            self.assertEqual(staging.trim(max_bytes=None, max_files=2), (1, 0))
+            self.assertEqual(sorted(os.listdir(where)),
+                             ['.staging-abc', name, 'new.mp4'])
+
+            # room is made for a copy about to start
+            self.assertEqual(staging.trim(max_bytes=150, max_files=None,
+                                          reserve=100), (1, 100))
+            self.assertEqual(sorted(os.listdir(where)), ['.staging-abc', name])
+
+            # partial copies nobody's writing to anymore are collected
+            os.utime(os.path.join(where, '.staging-abc'), (1000, 1000))
+            with open(os.path.join(where, '.staging-def'), 'wb') as f:
+                f.write(b'\x00' * 10)
+            staging.trim()
+            self.assertEqual(sorted(os.listdir(where)), ['.staging-def', name])
+        finally:
+            shutil.rmtree(where)
+            shutil.rmtree(sources)
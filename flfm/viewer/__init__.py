@@ -1,2 +1,3 @@
 from .routes import viewer
 from .vcache import vcache
+from .staging import video_staging
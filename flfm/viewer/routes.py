@@ -1,9 +1,11 @@
 import os
 from flask import (
-    Blueprint, render_template, g, request, current_app, abort, make_response
+    Blueprint, render_template, g, request, current_app, abort
 )
 from flfm.shell.paths import ShellPath
-from flfm.shell.rules import enforce_mapped, needs_rules, MappedDirectories
+from flfm.shell.rules import (
+    enforce_mapped, enforce_visible, needs_rules, MappedDirectories
+)
 from flfm.misc import get_banner_string
 from .vcache import vcache
 
@@ -26,17 +28,20 @@ def view_file():
     input_file = request.args['f']
     if_mimetype = request.args['mt']
     current_dir = os.path.dirname(input_file)
-    mapped_dirs = MappedDirectories.from_shell_path(ShellPath(current_dir)).\
-                  apply_rule_map(MappedDirectories.from_rules(g.fm_rules))
+    mapped_dirs = MappedDirectories.from_shell_path(ShellPath.cached(current_dir)).\
+                  apply_rule_map(g.fm_rules.mapped_dirs)
     enforce_mapped(mapped_dirs, current_dir)
+    enforce_visible(input_file)
 
     # If the file is not cacheable (ie: too large), we'll send the path
     # instead in order to generate a serve_file link instead later on
-    was_cacheable = vcache.is_file_cacheable(input_file)
+    # Images are fetched as screen-sized thumbnails instead
+    was_cacheable = not if_mimetype.startswith('image/') and \
+                    vcache.is_file_cacheable(input_file)
     cache_id = -1
     if was_cacheable:
         file_to_view = vcache.view_file(input_file)
-        cache_id = hash(file_to_view)
+        cache_id = file_to_view.cache_id
     else:
         file_to_view = input_file
 
@@ -49,17 +54,17 @@ def view_file():
 def fetch(cacheid):
     mimetype = request.args.get('mimetype', 'application/octet-stream')
 
-    the_key = None
-    # apparently, the key is the filename instead of its hash. whatever -_-
-    for i, k in enumerate(vcache.cache):
-        k_hash = hash(vcache.view_file(k[0]))
-        if k_hash == cacheid:
-            the_key = k[0]
-            break
-
-    if the_key is None:
+    cached = vcache.by_cache_id(cacheid)
+    if cached is None:
         abort(404)
 
-    cached_file = make_response(vcache.view_file(the_key).read_contents())
-    cached_file.mimetype = mimetype
-    return cached_file
+    # the response is streamed out of the cache a chunk at a time
+    cached_file = current_app.response_class(cached.iter_contents(),
+                                             mimetype=mimetype)
+    cached_file.content_length = cached.file_bytes
+    # the id is a digest of the contents, they can't change under it
+    cached_file.set_etag(str(cacheid))
+    cached_file.cache_control.private = True
+    cached_file.cache_control.max_age = 3600
+    return cached_file.make_conditional(request, accept_ranges=True,
+                                        complete_length=cached.file_bytes)
@@ -0,0 +1,457 @@
+"""
+    Video Staging
+    ~~~~~~~~~~~~~
+
+    Getting videos into ``VIEWER_VIDEO_DIRECTORY`` for the player, without
+    holding up everybody else while they're copied, & keeping that directory
+    within its budget.
+
+"""
+import hashlib
+import logging
+import os
+import struct
+import tempfile
+import threading
+import time
+from flfm.shell.video import fast_start_plan, needs_fast_start
+
+log = logging.getLogger(__name__)
+
+def run_directly(func, *args):
+    """Run ``func`` right here, for servers with a thread per client.
+    """
+    return func(*args)
+
+def run_in_tpool(func, *args):
+    """Run ``func`` in one of **eventlet**'s real OS threads, so blocking disk
+    I/O doesn't stall the hub & every other connected client.
+
+    :param func: The function to call.
+    :returns: Whatever ``func`` returns.
+    """
+    from eventlet import tpool
+    return tpool.execute(func, *args)
+
+class StagingJob:
+    """A video being copied into the staging directory.
+
+    :param source: The path of the video.
+    :type source: str
+    :param destination: Where it's being copied to.
+    :type destination: str
+    :param plan: Works out what to copy, like
+                 :func:`~flfm.shell.video.fast_start_plan`. *None*, or a plan
+                 returning *None*, copies the video as it is.
+    :type plan: callable
+    """
+    def __init__(self, source, destination, plan=None):
+        self.source = source
+        self.destination = destination
+        self.plan = plan
+        #: Socket.IO session ids of the clients waiting on this video.
+        self.clients = set()
+        #: Bytes copied so far.
+        self.copied = 0
+        #: Size of the video.
+        self.total = os.stat(source).st_size
+        #: Set once no client is waiting on this video anymore.
+        self.cancelled = False
+        #: Set once the copy has ended, successfully or not.
+        self.finished = threading.Event()
+        #: What ended the copy, if it failed.
+        self.error = None
+
+    @property
+    def progress(self):
+        """The fraction of the video copied so far.
+        """
+        if self.total == 0:
+            return 1.0
+        return self.copied / self.total
+
+    def _open(self):
+        # the copy lands under a hidden name & is renamed once complete, so a
+        # partial video is never handed to a player
+        temp_fd, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(self.destination), prefix='.staging-'
+        )
+        return open(self.source, 'rb'), os.fdopen(temp_fd, 'wb'), temp_path
+
+    def _pieces(self, src):
+        pieces = None
+        if self.plan is not None:
+            try:
+                pieces = self.plan(self.source)
+            except (ValueError, struct.error):
+                # can't be remuxed, the copy will do
+                pieces = None
+        if pieces is None:
+            pieces = [(0, os.fstat(src.fileno()).st_size)]
+        return pieces
+
+    @staticmethod
+    def _copy_chunk(src, dst, piece, chunk_size):
+        if isinstance(piece, bytes):
+            dst.write(piece)
+            return len(piece)
+        offset, length = piece
+        src.seek(offset)
+        buffer = src.read(min(chunk_size, length))
+        if not buffer:
+            raise EOFError
+        dst.write(buffer)
+        return len(buffer)
+
+    def run(self, chunk_size, progress_interval, on_progress=None,
+            blocking=run_directly):
+        """Copy the video a chunk at a time.
+
+        :param chunk_size: Bytes per chunk.
+        :type chunk_size: int
+        :param progress_interval: Seconds between calls to ``on_progress``.
+        :type progress_interval: float
+        :param on_progress: Called with this job, every so often.
+        :type on_progress: callable
+        :param blocking: Runs each blocking call, e.g. :func:`run_in_tpool`.
+        :type blocking: callable
+        :returns: bool -- *True* if the video was copied.
+        """
+        temp_path = None
+        try:
+            src, dst, temp_path = blocking(self._open)
+            completed = False
+            with src, dst:
+                pieces = blocking(self._pieces, src)
+                self.total = sum(len(p) if isinstance(p, bytes) else p[1]
+                                 for p in pieces)
+                last_progress = time.monotonic()
+                while pieces and not self.cancelled:
+                    copied = blocking(self._copy_chunk, src, dst, pieces[0],
+                                      chunk_size)
+                    if isinstance(pieces[0], bytes) or copied == pieces[0][1]:
+                        pieces.pop(0)
+                    else:
+                        pieces[0] = (pieces[0][0] + copied, pieces[0][1] - copied)
+                    self.copied += copied
+                    if on_progress is not None and \
+                       time.monotonic() - last_progress >= progress_interval:
+                        last_progress = time.monotonic()
+                        on_progress(self)
+                completed = not pieces
+                if completed:
+                    blocking(os.fsync, dst.fileno())
+            if not completed:
+                os.remove(temp_path)
+                return False
+            os.replace(temp_path, self.destination)
+            return True
+        except Exception as err:
+            # EOFError: the video got shorter while being copied. Anything
+            # else is a bug, but the clients waiting still need to hear
+            if not isinstance(err, (OSError, EOFError)):
+                log.exception('Staging %s failed.', self.source)
+            self.error = err
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+            return False
+        finally:
+            self.finished.set()
+
+class VideoStaging:
+    """Puts videos into ``VIEWER_VIDEO_DIRECTORY``, named by a digest of their
+    device, inode, size & modification time, so every path to the same video
+    shares what's staged for it. Symlinks are made on the spot, except for
+    MP4s needing a fast-start remux. Copies & remuxes become a
+    :class:`StagingJob`, run away from the event loop, shared by every client
+    preparing the same video, and cancelled once all of those clients have
+    disconnected.
+
+    The directory is kept within a budget by :meth:`trim`, evicting the least
+    recently prepared or served videos first, along with the partial copies
+    of jobs that never finished.
+
+    +-----------------------------+-----------------------------------------------+
+    | Configuration Variables     | Description                                   |
+    +=============================+===============================================+
+    |``VIEWER_VIDEO_DIRECTORY``   | Where videos are staged.                      |
+    +-----------------------------+-----------------------------------------------+
+    |``VIDEO_STAGING_CHUNK_SIZE`` | Bytes copied per chunk.                       |
+    +-----------------------------+-----------------------------------------------+
+    |``VIDEO_FAST_START``         | Stage MP4s whose ``moov`` is at the end as a  |
+    |                             | remuxed copy with the ``moov`` up front.      |
+    +-----------------------------+-----------------------------------------------+
+    |``VIDEO_STAGING_MAX_BYTES``  | Max bytes of copies to keep. *None* for no    |
+    |                             | limit.                                        |
+    +-----------------------------+-----------------------------------------------+
+    |``VIDEO_STAGING_MAX_FILES``  | Max videos, copied or linked, to keep.        |
+    +-----------------------------+-----------------------------------------------+
+    |``VIDEO_PROGRESS_INTERVAL``  | Seconds between ``video progress`` events.    |
+    +-----------------------------+-----------------------------------------------+
+
+    :param app: The Flask application
+    :type app: Flask
+    """
+    directory = None
+    chunk_size = 4194304
+    fast_start = True
+    max_bytes = None
+    max_files = 1024
+    progress_interval = 0.5
+    blocking = staticmethod(run_directly)
+    #: Seconds before a partial copy nobody's writing to is removed.
+    stale_after = 3600
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        #: Copies in progress, by destination.
+        self.jobs = dict()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.directory = app.config.get('VIEWER_VIDEO_DIRECTORY', None)
+        self.chunk_size = app.config.get('VIDEO_STAGING_CHUNK_SIZE', 4194304)
+        self.fast_start = app.config.get('VIDEO_FAST_START', True)
+        self.max_bytes = app.config.get('VIDEO_STAGING_MAX_BYTES', None)
+        self.max_files = app.config.get('VIDEO_STAGING_MAX_FILES', 1024)
+        self.progress_interval = app.config.get('VIDEO_PROGRESS_INTERVAL', 0.5)
+        # under eventlet, every client shares the one hub
+        socketio = app.extensions.get('socketio', None)
+        if socketio is not None and socketio.async_mode == 'eventlet':
+            self.blocking = run_in_tpool
+        else:
+            self.blocking = run_directly
+        self.finish_setup()
+
+    def finish_setup(self):
+        with self.lock:
+            for job in self.jobs.values():
+                job.cancelled = True
+            self.jobs = dict()
+
+    @staticmethod
+    def staged_name(source):
+        """The name a video is staged as.
+
+        :param source: The path of the video.
+        :type source: str
+        :returns: str
+        """
+        the_stat = os.stat(source)
+        digest = hashlib.sha1('{}:{}:{}:{}'.format(
+            the_stat.st_dev, the_stat.st_ino, the_stat.st_size,
+            the_stat.st_mtime_ns
+        ).encode('ascii')).hexdigest()
+        return digest[0:24] + os.path.splitext(source)[1].lower()
+
+    def stage(self, source, client):
+        """Stage a video for ``client``. The filesystem is only touched
+        outside of :attr:`lock`, thru :attr:`blocking`.
+
+        :param source: The path of the video.
+        :type source: str
+        :param client: The Socket.IO session id of the client.
+        :type client: str
+        :raises OSError: ``source`` can't be read.
+        :returns: tuple -- (the staged name, :class:`StagingJob` or *None* if
+                  the video is ready, *True* if something new was staged)
+        """
+        name = self.blocking(self.staged_name, source)
+        destination = os.path.join(self.directory, name)
+
+        with self.lock:
+            job = self._join(destination, client)
+        if job is not None:
+            return name, job, False
+
+        remux = self.fast_start and self.blocking(needs_fast_start, source)
+        ready, is_new = self.blocking(self._link, source, destination, remux)
+        if ready:
+            return name, None, is_new
+
+        # a remuxed copy plays before the whole video has been fetched
+        job = self.blocking(StagingJob, source, destination,
+                            fast_start_plan if remux else None)
+        with self.lock:
+            # somebody else may have started it in the meantime
+            running = self._join(destination, client)
+            if running is not None:
+                return name, running, False
+            job.clients.add(client)
+            self.jobs[destination] = job
+        return name, job, True
+
+    def _join(self, destination, client):
+        # call with the lock held
+        job = self.jobs.get(destination)
+        if job is None or job.cancelled:
+            return None
+        job.clients.add(client)
+        return job
+
+    @staticmethod
+    def _link(source, destination, remux):
+        # (whether the video's ready, whether it was just linked)
+        if os.path.exists(destination):
+            # now the most recently used
+            os.utime(destination, follow_symlinks=False)
+            return True, False
+        if os.path.lexists(destination):
+            # its video went away & came back as the same file
+            try:
+                os.remove(destination)
+            except FileNotFoundError:
+                pass
+        if not remux:
+            try:
+                os.symlink(source, destination)
+                return True, True
+            except FileExistsError:
+                return True, False
+            except (OSError, NotImplementedError, AttributeError):
+                pass
+        return False, False
+
+    def run(self, job, on_progress=None):
+        """Run a job returned by :meth:`stage`, making room for it first. See
+        :meth:`StagingJob.run`.
+
+        :returns: bool -- *True* if the video was copied.
+        """
+        try:
+            self.trim(reserve=job.total)
+            return job.run(self.chunk_size, self.progress_interval, on_progress,
+                           self.blocking)
+        except Exception as err:
+            # job.run handles its own, this is making room going wrong
+            log.exception('Staging %s failed.', job.source)
+            job.error = err
+            job.finished.set()
+            return False
+        finally:
+            with self.lock:
+                if self.jobs.get(job.destination) is job:
+                    del self.jobs[job.destination]
+
+    def cancel(self, client):
+        """Stop waiting for videos on behalf of ``client``, cancelling the jobs
+        nobody else is waiting on.
+
+        :param client: The Socket.IO session id of the client.
+        :type client: str
+        """
+        with self.lock:
+            for job in self.jobs.values():
+                job.clients.discard(client)
+                if not job.clients:
+                    job.cancelled = True
+
+    def staged(self):
+        """The staged videos, least recently used first. Copies in progress
+        are left out.
+
+        :returns: list -- (path, ``lstat()``, *True* if it's a symlink)
+        """
+        videos = []
+        if not self.directory or not os.path.isdir(self.directory):
+            return videos
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    videos.append((entry.path, entry.stat(follow_symlinks=False),
+                                   entry.is_symlink()))
+                except FileNotFoundError:
+                    continue
+        # players reading a video update its atime, preparing it its mtime
+        videos.sort(key=lambda v: max(v[1].st_atime_ns, v[1].st_mtime_ns))
+        return videos
+
+    def usage(self):
+        """Report on what's staged.
+
+        :returns: dict -- *videos*, *copies*, *links* & *bytes* (of copies).
+        """
+        videos = self.staged()
+        copies = [v for v in videos if not v[2]]
+        return dict({
+            'videos': len(videos),
+            'copies': len(copies),
+            'links': len(videos) - len(copies),
+            'bytes': sum(v[1].st_size for v in copies),
+        })
+
+    def trim(self, max_bytes=None, max_files=None, reserve=0):
+        """Remove broken symlinks & stale partial copies, then the least
+        recently used videos until what's staged fits in the budget.
+
+        :param max_bytes: Bytes of copies to keep. **Default:**
+                          ``VIDEO_STAGING_MAX_BYTES``
+        :type max_bytes: int
+        :param max_files: Videos to keep. **Default:**
+                          ``VIDEO_STAGING_MAX_FILES``
+        :type max_files: int
+        :param reserve: Bytes to make room for, e.g. a copy about to start.
+        :type reserve: int
+        :returns: tuple -- (videos removed, bytes freed)
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        if max_files is None:
+            max_files = self.max_files
+
+        with self.lock:
+            busy = set(self.jobs)
+        return self.blocking(self._trim, busy, max_bytes, max_files, reserve)
+
+    def _trim(self, busy, max_bytes, max_files, reserve):
+        videos = []
+        removed, freed = 0, 0
+        self._remove_stale()
+        for path, the_stat, is_link in self.staged():
+            if is_link and not os.path.exists(path):
+                os.remove(path)
+                removed += 1
+            else:
+                videos.append((path, the_stat, is_link))
+
+        total_bytes = sum(v[1].st_size for v in videos if not v[2]) + reserve
+        total_files = len(videos) + (1 if reserve else 0)
+        for path, the_stat, is_link in videos:
+            over_bytes = max_bytes is not None and total_bytes > max_bytes
+            over_files = max_files is not None and total_files > max_files
+            if not over_bytes and not over_files:
+                break
+            if path in busy:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            removed += 1
+            total_files -= 1
+            if not is_link:
+                total_bytes -= the_stat.st_size
+                freed += the_stat.st_size
+        return removed, freed
+
+    def _remove_stale(self):
+        # copies left behind when a worker died; running ones keep writing
+        if not self.directory or not os.path.isdir(self.directory):
+            return
+        stale = time.time() - self.stale_after
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.name.startswith('.staging-'):
+                    continue
+                try:
+                    if entry.stat(follow_symlinks=False).st_mtime < stale:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    continue
+
+###############################################################################
+video_staging = VideoStaging()
@@ -7,25 +7,65 @@
 """
 import base64
 import hashlib
+import mmap
 import os
-from io import BytesIO, SEEK_SET, SEEK_END
-import operator
+import tempfile as tf
 import threading
-from cachetools import LFUCache, cachedmethod
-from cachetools.keys import hashkey
+from cachetools import Cache, LFUCache
+
+def file_identity(stat_result):
+    """The device, inode, size & modification time of a file. A file that's
+    edited or replaced has a different identity.
+
+    :param stat_result: The ``stat()`` of the file.
+    :type stat_result: os.stat_result
+    :returns: tuple
+    """
+    return (stat_result.st_dev, stat_result.st_ino, stat_result.st_size,
+            stat_result.st_mtime_ns)
 
 class VCFile:
     """A File that has been cached.
 
+    The contents live in an anonymous memory map, outside of the Python heap,
+    and are handed out as ``memoryview``'s so reading them copies nothing.
+    The file itself isn't mapped, unless ``mapped``: truncating a mapped file
+    makes reading the truncated pages fault.
+
     :param filepath: The path to said file.
     :type filepath: str
+    :param cache_id: The :attr:`cache_id`, if it's already known.
+    :type cache_id: int
+    :param mapped: Map the file itself. Only for files that are never
+                   rewritten, like those of :class:`DiskBackend`.
+    :type mapped: bool
     """
-    def __init__(self, filepath):
+    def __init__(self, filepath, cache_id=None, mapped=False):
         with open(filepath, 'rb') as file:
-            self.buffer = BytesIO(file.read())
-            self.buffer.seek(0, SEEK_END)
-            self.file_bytes = self.buffer.tell()
-            self.buffer.seek(0, SEEK_SET)
+            the_stat = os.fstat(file.fileno())
+            #: What the file was when read, see :func:`file_identity`.
+            self.identity = file_identity(the_stat)
+            self.file_bytes = the_stat.st_size
+            self._map = None
+            if self.file_bytes > 0 and mapped:
+                self._map = mmap.mmap(file.fileno(), self.file_bytes,
+                                      access=mmap.ACCESS_READ)
+                self.buffer = memoryview(self._map)
+            elif self.file_bytes > 0:
+                self._map = mmap.mmap(-1, self.file_bytes)
+                # the file may have shrunk since fstat
+                self.file_bytes = file.readinto(self._map)
+                self.buffer = memoryview(self._map)[:self.file_bytes]
+            else:
+                self.buffer = memoryview(b'')
+
+        if cache_id is None:
+            # digested once, it identifies the contents for as long as they're cached
+            md5 = hashlib.md5()
+            md5.update(self.buffer)
+            cache_id = int(md5.hexdigest()[0:16], 16)
+        #: Identifies the contents in ``/viewer/fetch`` URLs.
+        self.cache_id = cache_id
 
     # pylint: disable=anomalous-backslash-in-string
 
@@ -38,6 +78,7 @@ class VCFile:
             * *decode_as* --
               Can be: ``none``, ``base64`` , or ``utf-8``
 
+        :returns: A read-only ``memoryview`` of the contents, unless decoded.
         """
         encoding = kwargs.get('decode_as', '')
 
@@ -46,22 +87,241 @@ class VCFile:
 
         if encoding:
             if 'none' in encoding or not encoding:
-                return self.buffer.getvalue()
+                return self.buffer.toreadonly()
             elif 'base64' in encoding:
-                return base64.b64encode(self.buffer.getvalue())
+                return base64.b64encode(self.buffer)
+
+            return str(self.buffer, encoding)
+        return self.buffer.toreadonly()
 
-            return self.buffer.getvalue().decode(encoding)
-        return self.buffer.getvalue()
+    def iter_contents(self, chunk_size=262144):
+        """Iterate over the contents a chunk at a time, e.g. for a response.
+        WSGI servers only accept ``bytes``, so only one chunk is ever copied
+        out of the cache at once.
+
+        :param chunk_size: The size of each chunk.
+        :type chunk_size: int
+        """
+        contents = self.buffer.toreadonly()
+        for offset in range(0, self.file_bytes, chunk_size):
+            yield bytes(contents[offset:offset+chunk_size])
 
     def __hash__(self):
-        md5 = hashlib.md5()
-        md5.update(self.buffer.getvalue())
-        return int(md5.hexdigest()[0:16], 16)
+        return hash(self.cache_id)
 
     def __eq__(self, other):
         if not isinstance(other, VCFile):
             return False
-        return hash(self) == hash(other)
+        return self.cache_id == other.cache_id
+
+class _IndexedLFUCache(LFUCache):
+    # Keyed on (path,) + file identity. Also indexes the cached VCFile's by
+    # their cache id, and each path's current key.
+    def __init__(self, maxsize, getsizeof=None):
+        super(_IndexedLFUCache, self).__init__(maxsize, getsizeof)
+        self.by_cache_id = dict()
+        self.by_path = dict()
+
+    def __setitem__(self, key, value):
+        stale = self.by_path.get(key[0])
+        if stale is not None and stale != key and stale in self:
+            del self[stale]
+        LFUCache.__setitem__(self, key, value)
+        self.by_cache_id[value.cache_id] = key
+        self.by_path[key[0]] = key
+
+    def __delitem__(self, key):
+        # Cache.__getitem__ doesn't count as a use
+        value = Cache.__getitem__(self, key)
+        LFUCache.__delitem__(self, key)
+        if self.by_cache_id.get(value.cache_id) == key:
+            del self.by_cache_id[value.cache_id]
+        if self.by_path.get(key[0]) == key:
+            del self.by_path[key[0]]
+
+class MemoryBackend:
+    """Keeps the viewer cache in the memory of this process. Cached files are
+    evicted least frequently used first.
+
+    :param max_bytes: The total size of all cached files.
+    :type max_bytes: int
+    """
+    def __init__(self, max_bytes):
+        self.lock = threading.RLock()
+        self.cache = _IndexedLFUCache(max_bytes, self.getsizeof)
+
+    @staticmethod
+    def getsizeof(obj):
+        return getattr(obj, 'file_bytes', 1)
+
+    def get(self, key):
+        """Get a cached file.
+
+        :param key: The path of the file & its :func:`file_identity`.
+        :type key: tuple
+        :returns: :class:`VCFile` -- or *None* if it's not cached.
+        """
+        with self.lock:
+            return self.cache.get(key)
+
+    def put(self, key, vc_file):
+        """Cache a file, replacing what's cached for the same path.
+
+        :param key: The path of the file & its :func:`file_identity`.
+        :type key: tuple
+        :param vc_file: The file.
+        :type vc_file: :class:`VCFile`
+        """
+        with self.lock:
+            try:
+                self.cache[key] = vc_file
+            except ValueError:
+                pass # too large for the cache
+
+    def by_cache_id(self, cache_id):
+        """Get a cached file by its :attr:`VCFile.cache_id`.
+
+        :param cache_id: The cache id.
+        :type cache_id: int
+        :returns: :class:`VCFile` -- or *None* if it's not cached.
+        """
+        with self.lock:
+            key = self.cache.by_cache_id.get(cache_id)
+            if key is None:
+                return None
+            vc_file = self.cache.get(key)
+        if vc_file is None or vc_file.cache_id != cache_id:
+            return None
+        return vc_file
+
+class DiskBackend:
+    """Keeps the viewer cache in a directory that every worker on the host
+    shares, so a ``cache_id`` handed out by one worker can be fetched from
+    any other.
+
+    Contents are stored once under ``objects/``, named by their cache id, and
+    never rewritten; they're mapped straight from there. ``index/`` holds a
+    small file per cached path with the :func:`file_identity` & cache id it
+    was cached with. Everything is written to a temporary file & renamed into
+    place. Once over ``max_bytes``, the least recently used contents are
+    removed.
+
+    :param directory: The cache directory.
+    :type directory: str
+    :param max_bytes: The total size of all cached files.
+    :type max_bytes: int
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(directory, 'objects')
+        self.index_dir = os.path.join(directory, 'index')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.index_dir, exist_ok=True)
+
+    def _object_path(self, cache_id):
+        return os.path.join(self.objects_dir, '{:016x}'.format(cache_id))
+
+    def _index_path(self, filepath):
+        name = hashlib.sha1(filepath.encode('utf-8', 'surrogateescape'))
+        return os.path.join(self.index_dir, name.hexdigest())
+
+    def _write_atomically(self, where, contents):
+        fd, temp_path = tf.mkstemp(dir=os.path.dirname(where), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                temp_file.write(contents)
+            os.rename(temp_path, where)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def _read_index(self, filepath):
+        try:
+            with open(self._index_path(filepath), 'r') as index_file:
+                fields = index_file.read().split()
+            return tuple(int(f) for f in fields[:4]), int(fields[4], 16)
+        except (FileNotFoundError, ValueError, IndexError):
+            return None, None
+
+    def _open_object(self, cache_id):
+        object_path = self._object_path(cache_id)
+        try:
+            vc_file = VCFile(object_path, cache_id, mapped=True)
+        except FileNotFoundError:
+            return None
+        # the modification time orders the least recently used
+        try:
+            os.utime(object_path)
+        except FileNotFoundError:
+            pass
+        return vc_file
+
+    def get(self, key):
+        """See :meth:`MemoryBackend.get`.
+        """
+        identity, cache_id = self._read_index(key[0])
+        if identity != key[1:]:
+            return None
+        return self._open_object(cache_id)
+
+    def put(self, key, vc_file):
+        """See :meth:`MemoryBackend.put`.
+        """
+        if vc_file.file_bytes > self.max_bytes:
+            return
+        object_path = self._object_path(vc_file.cache_id)
+        if not os.path.exists(object_path):
+            self._write_atomically(object_path, vc_file.buffer)
+        index_line = '{} {} {} {} {:016x}\n'.format(*(key[1:] + (vc_file.cache_id,)))
+        self._write_atomically(self._index_path(key[0]),
+                               index_line.encode('ascii'))
+        self.evict()
+
+    def by_cache_id(self, cache_id):
+        """See :meth:`MemoryBackend.by_cache_id`.
+        """
+        return self._open_object(cache_id)
+
+    def evict(self):
+        """Remove the least recently used contents until the cache is within
+        its budget, and the index entries pointing to them.
+        """
+        objects = []
+        total_bytes = 0
+        with os.scandir(self.objects_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    the_stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                objects.append((the_stat.st_mtime_ns, entry.name, the_stat.st_size))
+                total_bytes += the_stat.st_size
+        if total_bytes <= self.max_bytes:
+            return
+
+        removed = set()
+        for _, name, size in sorted(objects):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.objects_dir, name))
+            except FileNotFoundError:
+                pass
+            removed.add(name)
+            total_bytes -= size
+
+        with os.scandir(self.index_dir) as entries:
+            for entry in entries:
+                try:
+                    with open(entry.path, 'r') as index_file:
+                        fields = index_file.read().split()
+                    if fields[4] in removed:
+                        os.remove(entry.path)
+                except (OSError, IndexError):
+                    continue
 
 class ViewerCache:
     """The viewer cache.
@@ -71,48 +331,87 @@ class ViewerCache:
     +=========================+===================================================+
     |``VCACHE_MAX_FILESIZE``  | This controls the maximum size of the file.       |
     +-------------------------+---------------------------------------------------+
-    |``VCACHE_MAX_FILES``     | This controls the max cacheable files at one time.|
+    |``VCACHE_MAX_BYTES``     | The total size of all cached files. It replaces   |
+    |                         | ``VCACHE_MAX_FILES``, which is ignored.           |
+    +-------------------------+---------------------------------------------------+
+    |``VCACHE_BACKEND``       | ``memory`` (per worker, the default) or ``disk``  |
+    |                         | (shared by the workers on a host).                |
+    +-------------------------+---------------------------------------------------+
+    |``VCACHE_DIRECTORY``     | Where the ``disk`` backend keeps the cache.       |
     +-------------------------+---------------------------------------------------+
 
     :param app: The Flask application
     :type app: Flask
     """
+    #: The available values of ``VCACHE_BACKEND``.
+    BACKENDS = ('memory', 'disk')
+
     been_setup = False
     max_file_size = 0
-    max_files = 0
-
-    @staticmethod
-    def getsizeof(obj):
-        return getattr(obj, 'file_bytes', 1)
+    max_bytes = 0
+    backend_name = 'memory'
+    directory = None
 
     def __init__(self, app=None):
         if app is not None:
             self.init_app(app)
 
-        self.lock = threading.RLock()
-        self.cache = None
+        self.backend = None
         if self.been_setup:
             self.finish_setup()
 
     def init_app(self, app):
         self.max_file_size = app.config['VCACHE_MAX_FILESIZE']
-        self.max_files = app.config['VCACHE_MAX_FILES']
+        self.max_bytes = app.config.get('VCACHE_MAX_BYTES', 67108864)
+        if 'VCACHE_MAX_FILES' in app.config:
+            app.logger.warning('VCACHE_MAX_FILES is ignored, the viewer cache is '
+                               'limited by VCACHE_MAX_BYTES (%d bytes) instead.',
+                               self.max_bytes)
+        self.backend_name = app.config.get('VCACHE_BACKEND', 'memory').lower()
+        if self.backend_name not in self.BACKENDS:
+            raise ValueError("Unknown VCACHE_BACKEND '{}'.".format(self.backend_name))
+        self.directory = app.config.get('VCACHE_DIRECTORY', None)
 
         self.been_setup = True
         self.finish_setup()
 
     def finish_setup(self):
-        self.cache = LFUCache(self.max_file_size*self.max_files, self.getsizeof)
+        if self.backend_name == 'disk':
+            self.backend = DiskBackend(self.directory, self.max_bytes)
+        else:
+            self.backend = MemoryBackend(self.max_bytes)
 
     def is_file_cacheable(self, filepath):
-        if os.stat(filepath).st_size > self.max_file_size:
+        file_size = os.stat(filepath).st_size
+        if file_size > self.max_file_size or file_size > self.max_bytes:
             return False
         return True
 
-    @cachedmethod(operator.attrgetter('cache'), hashkey,
-                  operator.attrgetter('lock'))
     def view_file(self, filepath):
-        return VCFile(filepath)
+        """Get a file from the cache, reading it in if it isn't there or has
+        changed since it was cached. Every hit costs a ``stat()``.
+
+        :param filepath: The path of the file.
+        :type filepath: str
+        :returns: :class:`VCFile`
+        """
+        vc_file = self.backend.get((filepath,) + file_identity(os.stat(filepath)))
+        if vc_file is not None:
+            return vc_file
+
+        vc_file = VCFile(filepath)
+        # it may have changed again since the stat()
+        self.backend.put((filepath,) + vc_file.identity, vc_file)
+        return vc_file
+
+    def by_cache_id(self, cache_id):
+        """Get a cached file by its :attr:`VCFile.cache_id`.
+
+        :param cache_id: The cache id.
+        :type cache_id: int
+        :returns: :class:`VCFile` -- or *None* if it's not cached.
+        """
+        return self.backend.by_cache_id(cache_id)
 
 ###############################################################################
 vcache = ViewerCache()
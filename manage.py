@@ -1,6 +1,7 @@
 from flask_script import Manager, prompt, prompt_bool, prompt_pass
 from flask_migrate import Migrate, MigrateCommand
 from flfm import create_app, db
+from flfm.viewer import video_staging
 from flfm.models import User
 from config import Config
 
@@ -50,5 +51,18 @@ def createuser(username=None, password=None, admin=None):
     db.session.commit()
     print("Successfully created '{}' with ID: {}.".format(user.name, user.id))
 
+@manager.option('-t', '--trim', dest='trim', action='store_true')
+@manager.option('-b', '--max-bytes', dest='max_bytes', type=int, required=False)
+@manager.option('-f', '--max-files', dest='max_files', type=int, required=False)
+def videos(trim=False, max_bytes=None, max_files=None):
+    """Report on the videos staged for the viewer, and optionally trim them.
+    """
+    print("{videos} videos: {copies} copies ({bytes} bytes), {links} links.".\
+          format(**video_staging.usage()))
+
+    if trim:
+        removed, freed = video_staging.trim(max_bytes, max_files)
+        print("Removed {} videos, freeing {} bytes.".format(removed, freed))
+
 if __name__ == '__main__':
     manager.run()